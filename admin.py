@@ -15,19 +15,23 @@
 # limitations under the License.
 
 """Defines the routing for the app's admin request handlers
-(those that require administrative access)."""
-
-from admin_handlers import *
+(those that require administrative access).  As in main.py, handlers are
+given by name and imported on first use."""
 
 import webapp2
 
 application = webapp2.WSGIApplication(
     [
-        ('/admin/manage', AdminHandler),
-        ('/admin/create_product', CreateProductHandler),
-        ('/admin/delete_product', DeleteProductHandler),
-        ('/admin/user_profile', UserProfileHandler),
-        ('/admin/view_transactions', ViewTransactionsHandler)
+        ('/admin/manage', 'admin_handlers.AdminHandler'),
+        ('/admin/create_product', 'admin_handlers.CreateProductHandler'),
+        ('/admin/delete_product', 'admin_handlers.DeleteProductHandler'),
+        ('/admin/user_profile', 'admin_handlers.UserProfileHandler'),
+        ('/admin/view_transactions', 'admin_handlers.ViewTransactionsHandler'),
+        ('/admin/my_listings', 'admin_handlers.ListingsDashboardHandler'),
+        ('/admin/transaction_maintenance',
+         'admin_handlers.TransactionMaintenanceHandler'),
+        ('/admin/reconcile', 'admin_handlers.ReconcileHandler'),
+        ('/admin/moderation_queue', 'admin_handlers.ModerationQueueHandler'),
+        ('/admin/moderate_reviews', 'admin_handlers.ModerateReviewsHandler')
     ],
     debug=True)
-
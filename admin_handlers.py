@@ -26,41 +26,144 @@ import uuid
 import webapp2
 
 from base_handler import BaseHandler
-import categories
+import bookings
+import category_schemas
 import config
 import docs
 import errors
+import index_jobs
 import models
+import product_images
+import rating_jobs
+import review_moderation
+import transaction_jobs
 import utils
+import view_counts
 
-from google.appengine.api import users
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext.deferred import defer
 from google.appengine.ext import ndb
 from google.appengine.api import search
+from google.appengine.api import taskqueue
 from google.appengine.api import urlfetch
 from datetime import datetime
 
 
+_WIPE_JOB = 'deleteData'
+# the kinds deleted by the wipe, by stage
+_WIPE_MODELS = {
+    'reviews': models.Review,
+    'products': models.Product,
+    'product_images': models.ProductImage,
+    'view_counts': models.ProductViewShard,
+    'saved_searches': models.SavedSearch,
+    'saved_search_matches': models.SavedSearchMatch,
+    'booked_intervals': models.BookedInterval,
+    'product_bookings': models.ProductBookings,
+    'transaction_archives': models.TransactionArchive,
+    'vocabulary': models.SearchVocabulary,
+    'job_statuses': models.JobStatus,
+    'index_rebuilds': models.IndexRebuild,
+    'index_aliases': models.IndexAlias,
+}
+# The index aliases are deleted after the product index shards, which are
+# found through them.
+_WIPE_STAGES = ['categories', 'reviews', 'products', 'product_index',
+                'store_index', 'product_images', 'view_counts',
+                'saved_searches', 'saved_search_matches', 'booked_intervals',
+                'product_bookings', 'transaction_archives', 'vocabulary',
+                'job_statuses', 'index_rebuilds', 'index_aliases']
+
+
 def deleteData(sample_data=True):
+  """Start deleting all the product data: the categories, the product and
+  review entities and the documents in the product and store indexes, then
+  the entities derived from them (images, view counts, saved searches,
+  bookings, archived transactions, the search vocabulary, the background
+  jobs' statuses and the index aliases).  The work is done in chunks of config.WIPE_BATCH_SIZE, one chained deferred task
+  per chunk, checkpointed in a models.JobStatus entity; see _deleteDataChunk.
+  """
+  status = models.JobStatus.start(_WIPE_JOB, _WIPE_STAGES)
+  _deferWipeChunk(status)
+
+
+def resumeDeleteData():
+  """Restart the chain of the current wipe from its last checkpoint, e.g.
+  after a task failed permanently."""
+  status = models.JobStatus.get_by_id(_WIPE_JOB)
+  if status and not status.done:
+    # not named: the name of the stalled chunk's task is already used.
+    defer(_deleteDataChunk, status.run_id)
+
+
+def _deferWipeChunk(status):
+  # Naming the task after the run and chunk number ensures that a chunk
+  # retried after chaining its successor doesn't start a second chain.
+  try:
+    defer(_deleteDataChunk, status.run_id,
+          _name='wipe-%s-%d' % (status.run_id, status.chunks))
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _deleteDataChunk(run_id):
+  """Delete one chunk of the current stage of the wipe, checkpoint the
+  progress and chain the next chunk."""
+  status = models.JobStatus.getRun(_WIPE_JOB, run_id)
+  if not status:
+    return
+  stage = status.stage
+  cursor = None
+  if stage == 'categories':
+    # also reinstantiate categories list
+    models.Category.deleteCategories()
+    count = 0
+  elif stage in _WIPE_MODELS:
+    # delete a batch of the stage's entities
+    keys, next_cursor, more = _WIPE_MODELS[stage].query().fetch_page(
+        config.WIPE_BATCH_SIZE, keys_only=True,
+        start_cursor=Cursor(urlsafe=status.cursor) if status.cursor else None)
+    # the wipe's own checkpoint is kept.
+    keys = [key for key in keys if key != status.key]
+    ndb.delete_multi(keys)
+    count = len(keys)
+    if more and next_cursor:
+      cursor = next_cursor.urlsafe()
+  else:
+    # delete a batch of the associated product documents in the doc and
+    # store indexes.  Deleted documents drop out of the range, so each
+    # batch starts from the beginning of the index.  The product index
+    # shards are emptied in turn.
+    if stage == 'product_index':
+      indexes = docs.Product.getIndexes()
+    else:
+      indexes = [docs.Store.getIndex()]
+    for index in indexes:
+      doc_ids = [d.doc_id for d in index.get_range(
+          ids_only=True,
+          limit=min(config.WIPE_BATCH_SIZE,
+                    search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST))]
+      if doc_ids:
+        break
+    if doc_ids:
+      index.delete(doc_ids)
+      cursor = doc_ids[-1]  # not used to resume; marks the stage unfinished
+    count = len(doc_ids)
+  status.advance(count, cursor)
+  status.put()
+  if status.done:
+    logging.info('delete data done: %s', status.counts)
+  else:
+    _deferWipeChunk(status)
 
-  # also reinstantiate categories list
-  models.Category.deleteCategories()
-  # delete all the product and review entities
-  review_keys = models.Review.query().fetch(keys_only=True)
-  ndb.delete_multi(review_keys)
-  prod_keys = models.Product.query().fetch(keys_only=True)
-  ndb.delete_multi(prod_keys)
-  # delete all the associated product documents in the doc and
-  # store indexes
-  docs.Product.deleteAllInProductIndex()
-  docs.Store.deleteAllInIndex()
 
 class UserProfileHandler(BaseHandler):
   """Displays the user page."""
 
   def buildUserProfilePage(self, notification=None):
-    user = users.get_current_user()
-    userinfo = ndb.Key(models.UserInfo, user.user_id()).get()
+    user = self.user_context.user
+    userinfo = self.user_context.profile
     if userinfo is not None:
         userInfo = {
             'user_id': userinfo.key.id(),
@@ -89,11 +192,10 @@ class UserProfileHandler(BaseHandler):
     self.user_profile()
 
   def user_profile(self):
-    user = users.get_current_user()
-    userinfo = ndb.Key(models.UserInfo, user.user_id()).get()
+    userinfo = self.user_context.profile
     if userinfo is None:
         userinfo = models.UserInfo(
-            id = users.get_current_user().user_id(),
+            id = self.user_context.user_id,
             nickname = self.request.get('nickname'),
             email = self.request.get('email'),
             phoneNumber = self.request.get('phone_number'),
@@ -108,6 +210,9 @@ class UserProfileHandler(BaseHandler):
         userinfo.meetPoint = self.request.get('meet_point')
         userinfo.put()
         Notification = "Updated succesfully"
+    # put() has written the profile through to memcache (see
+    # models.UserInfo); also update this request's copy.
+    self.user_context.profile = userinfo
 
     self.buildUserProfilePage(notification=Notification)
 
@@ -125,6 +230,17 @@ class AdminHandler(BaseHandler):
         'update_sample': config.DEMO_UPDATE_BOOKS_DATA}
     if notification:
       tdict['notification'] = notification
+    tdict['wipe_status'] = models.JobStatus.get_by_id(_WIPE_JOB)
+    tdict['reshard_status'] = models.JobStatus.get_by_id(
+        index_jobs.RESHARD_JOB)
+    tdict['backfill_status'] = models.JobStatus.get_by_id(
+        index_jobs.BACKFILL_JOB)
+    tdict['rebuild_status'] = models.IndexRebuild.get_by_id(
+        index_jobs.REBUILD_JOB)
+    tdict['recompute_status'] = models.JobStatus.get_by_id(
+        rating_jobs.RECOMPUTE_JOB)
+    tdict['reconcile_statuses'] = [
+        s for s in index_jobs.getReconcileStatuses() if s]
     self.render_template('admin.html', tdict)
 
   @BaseHandler.logged_in
@@ -132,8 +248,27 @@ class AdminHandler(BaseHandler):
     action = self.request.get('action')
     if action == 'deleteData':
       # delete data
-      defer(deleteData)
-      self.buildAdminPage(notification="Delete performed.")
+      deleteData()
+      self.buildAdminPage(notification="Delete started.")
+    elif action == 'resumeDeleteData':
+      resumeDeleteData()
+      self.buildAdminPage(notification="Delete resumed.")
+    elif action == 'backfillProducts':
+      index_jobs.backfillProducts()
+      self.buildAdminPage(notification="Product backfill started.")
+    elif action == 'reshardProducts':
+      index_jobs.reshardProducts(
+          self.request.get('old_indexes').split(',')
+          if self.request.get('old_indexes') else None)
+      self.buildAdminPage(notification="Index re-partition started.")
+    elif action == 'rebuildIndexes':
+      if index_jobs.startRebuild():
+        self.buildAdminPage(notification="Index rebuild started.")
+      else:
+        self.buildAdminPage(notification="An index rebuild is already running.")
+    elif action == 'recomputeRatings':
+      rating_jobs.startRecompute()
+      self.buildAdminPage(notification="Rating recompute started.")
     else:
       self.buildAdminPage()
 
@@ -146,6 +281,115 @@ class AdminHandler(BaseHandler):
     models.Product.updateProdDocsWithNewRating(pkeys)
 
 
+class ListingsDashboardHandler(BaseHandler):
+  """Shows the user's listings, with each listing's rating, review count,
+  views and pending bookings.  Listings come a page at a time from a
+  projection query on the owner, and the views and bookings of a page are
+  each read in one batch, so no product documents are fetched."""
+
+  _PAGE_SIZE = 50
+
+  @BaseHandler.logged_in
+  def get(self):
+    cursor = None
+    if self.request.get('cursor'):
+      try:
+        cursor = Cursor(urlsafe=self.request.get('cursor'))
+      except datastore_errors.BadValueError:
+        logging.warn('bad cursor: %s', self.request.get('cursor'))
+    products, next_cursor, more = models.Product.getOwnerPage(
+        self.user_context.user_id, self._PAGE_SIZE, cursor)
+    pids = [p.key.id() for p in products]
+    views = view_counts.getViewCounts(pids)
+    pending = bookings.countPending(pids)
+    listings = []
+    for prod in products:
+      pid = prod.key.id()
+      listings.append({
+          'pid': pid,
+          'link': '/product?' + urllib.urlencode(
+              {'pid': pid, 'category': (prod.category or '').encode('utf-8')}),
+          'name': prod.name,
+          'category': prod.category,
+          'price': prod.price,
+          'avg_rating': prod.avg_rating,
+          'num_reviews': prod.num_reviews,
+          'views': views.get(pid, 0),
+          'pending_bookings': pending.get(pid, 0)})
+    next_link = None
+    if more and next_cursor:
+      next_link = '/admin/my_listings?' + urllib.urlencode(
+          {'cursor': next_cursor.urlsafe()})
+    self.render_template(
+        'my_listings.html', {'listings': listings, 'next_link': next_link})
+
+
+class ReconcileHandler(BaseHandler):
+  """Continues the product entity / document reconciliation job; run from
+  cron."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    index_jobs.startReconciliation()
+    self.response.write('Reconciliation continued.')
+
+
+class ModerationQueueHandler(BaseHandler):
+  """Moderates the queued new reviews; run from cron."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    defer(review_moderation.moderateQueuedReviews)
+    self.response.write('Review moderation started.')
+
+
+class ModerateReviewsHandler(BaseHandler):
+  """Lists the latest reviews, active or inactive, and activates or
+  deactivates the selected ones."""
+
+  _PAGE_SIZE = 100
+
+  def buildModerationPage(self, show_inactive, notification=None):
+    query = models.Review.query()
+    if show_inactive:
+      query = query.filter(models.Review.active == False)
+    reviews = query.order(-models.Review.date_added).fetch(self._PAGE_SIZE)
+    self.render_template(
+        'moderate_reviews.html',
+        {'reviews': reviews, 'show_inactive': show_inactive,
+         'notification': notification})
+
+  @BaseHandler.logged_in
+  def get(self):
+    self.buildModerationPage(bool(self.request.get('inactive')))
+
+  @BaseHandler.logged_in
+  def post(self):
+    action = self.request.get('action')
+    review_keys = []
+    for rid in self.request.get_all('review_id'):
+      try:
+        review_keys.append(ndb.Key(models.Review, int(rid)))
+      except ValueError:
+        logging.warn('bad review id: %s', rid)
+    notification = None
+    if action in ('activate', 'deactivate') and review_keys:
+      num_changed = review_moderation.setReviewsActive(
+          review_keys, action == 'activate')
+      notification = '%s reviews %sd.' % (num_changed, action)
+    self.buildModerationPage(
+        bool(self.request.get('inactive')), notification=notification)
+
+
+class TransactionMaintenanceHandler(BaseHandler):
+  """Starts the transaction expiry and archival job; run from cron."""
+
+  @BaseHandler.logged_in
+  def get(self):
+    transaction_jobs.startMaintenance()
+    self.response.write('Transaction maintenance started.')
+
+
 class DeleteProductHandler(BaseHandler):
   """Remove data for the product with the given pid, including that product's
   reviews and its associated indexed document."""
@@ -172,6 +416,7 @@ class DeleteProductHandler(BaseHandler):
       if prod:
         prod.key.delete()
         defer(models.Review.deleteReviews, prod.key.id(), _transactional=True)
+        defer(product_images.deleteImages, prod.key.id(), _transactional=True)
         defer(
             docs.Product.removeProductDocByPid,
             prod.key.id(), _transactional=True)
@@ -196,14 +441,9 @@ class CreateProductHandler(BaseHandler):
   def parseParams(self):
     """Filter the param set to the expected params."""
     pid = self.request.get('pid')
-    doc = docs.Product.getDocFromPid(pid)
+    doc = docs.Product.getDocFromPid(pid, self.request.get('category') or None)
 
-    user = users.get_current_user()
-    userinfo = ndb.Key(models.UserInfo, user.user_id()).get()
-    logging.info("user is: %s", userinfo)
-    isProfileCreated = True
-    if userinfo is None:
-        isProfileCreated = False
+    isProfileCreated = self.user_context.has_profile
     logging.info("isProfileCreated: %s", isProfileCreated)
     params = {}
 
@@ -216,7 +456,7 @@ class CreateProductHandler(BaseHandler):
       params = {
           'pid': uuid.uuid4().hex,  # auto-generate default UID
           'name': '',
-          'user_id': users.get_current_user().user_id(), #give id automatically to product
+          'user_id': self.user_context.user_id, #give id automatically to product
           'description': '',
           'category': '',
           'image_url': '',
@@ -225,23 +465,25 @@ class CreateProductHandler(BaseHandler):
           'cat_info': models.Category.getCategoryInfo(),
           'user_profile_not_created': isProfileCreated
           }
-      pf = categories.product_dict
-      # add the fields specific to the categories
-      for _, cdict in pf.iteritems():
-        temp = {}
-        for elt in cdict.keys():
-          temp[elt] = ''
-        params.update(temp)
+    # add the fields specific to the selected category
+    schema = category_schemas.getSchema(
+        self.request.get('category', params['category']))
+    if schema:
+      for k, v in schema.getDefaultParams().iteritems():
+        params.setdefault(k, v)
 
     for k, v in params.iteritems():
       # Process the request params. Possibly replace default values.
       params[k] = self.request.get(k, v)
     return params
 
+  def renderForm(self, params):
+    params['category_forms'] = category_schemas.getFormSchemas(params)
+    self.render_template('create_product.html', params)
+
   @BaseHandler.logged_in
   def get(self):
-    params = self.parseParams()
-    self.render_template('create_product.html', params)
+    self.renderForm(self.parseParams())
 
   @BaseHandler.logged_in
   def post(self):
@@ -251,6 +493,15 @@ class CreateProductHandler(BaseHandler):
     """Create a product entity and associated document from the given params
     dict."""
     try:
+      upload = self.request.POST.get('image_file')
+      if hasattr(upload, 'file'):
+        # store the uploaded image, and use it in place of the image url.
+        urls = product_images.storeUpload(params['pid'], upload.file.read())
+        params['image_url'] = urls[product_images.DISPLAY]
+        params['thumbnail_url'] = urls[product_images.THUMBNAIL]
+      elif not params.get('image_url', '').startswith('/image?'):
+        # an external image url has no thumbnail; the image itself is used.
+        params.pop('thumbnail_url', None)
       product = docs.Product.buildProduct(params)
       self.redirect(
           '/product?' + urllib.urlencode(
@@ -260,12 +511,12 @@ class CreateProductHandler(BaseHandler):
     except errors.Error as e:
       logging.exception('Error:')
       params['error_message'] = e.error_message
-      self.render_template('create_product.html', params)
+      self.renderForm(params)
 
 
 class ViewTransactionsHandler(BaseHandler):
         def buildViewTransactionsPage(self, notification=None):
-            stuff = models.Transaction.get_by_doc_id(users.get_current_user().user_id())
+            stuff = models.Transaction.get_by_doc_id(self.user_context.user_id)
             logging.info(stuff)
             if not stuff.get():
                 stuff = None
@@ -286,7 +537,7 @@ class ViewTransactionsHandler(BaseHandler):
             action = self.request.get('action')
             if action == 'add':
                 transaction = models.Transaction()
-                transaction.doc_id = users.get_current_user().user_id()
+                transaction.doc_id = self.user_context.user_id
                 transaction.product = 'Product XXXXXXX'
                 transaction.rentee_id = 'John Carter'
                 transaction.email = 'johncarter@mail.com'
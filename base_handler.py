@@ -18,13 +18,93 @@
 """
 
 
-import webapp2
-from webapp2_extras import jinja2
+import hashlib
 import json
+import os
+
+import webapp2
+
+import config
+import models
+import rate_limit
+import template_env
 
 from google.appengine.api import users
 
 
+class UserContext(object):
+  """Information about the client's user, computed once per request.  The
+  users API lookups, the UserInfo profile fetch and the sidebar link set are
+  all memoized here, so that templates and handlers can share them instead of
+  each going back to the users API."""
+
+  # The sidebar links shown to a logged-in user.  Only the login/logout link
+  # depends on the request.
+  _USER_LINKS = {
+      'admin_create_url': '/admin/create_product',
+      'admin_create_text': 'Create new Posting',
+      'admin_url': '/admin/manage',
+      'admin_text': 'Admin Data Handling',
+      'admin_user_profile_url': '/admin/user_profile',
+      'admin_user_profile_text': 'My Profile',
+      'admin_view_transactions_url': '/admin/view_transactions',
+      'admin_view_transactions_text': 'My Transactions',
+      'my_listings_url': '/admin/my_listings',
+      'my_listings_text': 'My Listings',
+      'saved_searches_url': '/saved_searches',
+      'saved_searches_text': 'My Saved Searches'
+      }
+  _ANONYMOUS_LINKS = dict((k, None) for k in _USER_LINKS)
+
+  def __init__(self, request_uri):
+    self.user = users.get_current_user()
+    self.user_id = self.user.user_id() if self.user else None
+    self._request_uri = request_uri
+    self._sidebar_links = None
+    self._profile = None
+    self._profile_fetched = False
+    # models.UserInfo profiles read in this request, by user id
+    self.userinfo_memo = {}
+
+  def __nonzero__(self):
+    return self.user is not None
+
+  @property
+  def profile(self):
+    """The models.UserInfo entity of the current user, or None."""
+    if not self._profile_fetched:
+      self._profile = models.UserInfo.getCached(
+          self.user_id, memo=self.userinfo_memo)
+      self._profile_fetched = True
+    return self._profile
+
+  @profile.setter
+  def profile(self, userinfo):
+    self._profile = userinfo
+    self._profile_fetched = True
+    self.userinfo_memo[self.user_id] = userinfo
+
+  @property
+  def has_profile(self):
+    return self.profile is not None
+
+  @property
+  def sidebar_links(self):
+    """Login/logout and admin links, included in the sidebar for all app
+    pages."""
+    if self._sidebar_links is None:
+      if self.user:
+        links = dict(self._USER_LINKS)
+        links['url'] = users.create_logout_url(self._request_uri)
+        links['url_linktext'] = 'Logout'
+      else:
+        links = dict(self._ANONYMOUS_LINKS)
+        links['url'] = users.create_login_url(self._request_uri)
+        links['url_linktext'] = 'Login'
+      self._sidebar_links = links
+    return self._sidebar_links
+
+
 class BaseHandler(webapp2.RequestHandler):
   """The other handlers inherit from this class.  Provides some helper methods
   for rendering a template and generating template links."""
@@ -35,86 +115,89 @@ class BaseHandler(webapp2.RequestHandler):
     This decorator requires a logged-in user, and returns 403 otherwise.
     """
     def auth_required(self, *args, **kwargs):
-      if (users.get_current_user() or
+      if (self.user_context or
           self.request.headers.get('X-AppEngine-Cron')):
         handler_method(self, *args, **kwargs)
       else:
         self.error(403)
     return auth_required
 
+  @classmethod
+  def rate_limited(cls, route):
+    """
+    This decorator limits the rate of requests per client IP address and per
+    user to the route's budget in config.RATE_LIMITS, and returns 429
+    otherwise.
+    """
+    def decorator(handler_method):
+      def rate_limit_required(self, *args, **kwargs):
+        clients = ['ip:' + (self.request.remote_addr or '')]
+        if self.user_context.user_id:
+          clients.append('user:' + self.user_context.user_id)
+        retry_after = rate_limit.allow(route, clients)
+        if retry_after:
+          self.response.set_status(429, 'Too Many Requests')
+          self.response.headers['Retry-After'] = str(retry_after)
+          self.response.write('Too many requests; please retry later.')
+        else:
+          handler_method(self, *args, **kwargs)
+      return rate_limit_required
+    return decorator
+
   @webapp2.cached_property
-  def jinja2(self):
-    return jinja2.get_jinja2(app=self.app)
+  def user_context(self):
+    return UserContext(self.request.uri)
+
+  def getUserInfo(self, user_id):
+    """Return the profile of the given user, or None."""
+    return models.UserInfo.getCached(
+        user_id, memo=self.user_context.userinfo_memo)
+
+  def getUserInfos(self, user_ids):
+    """Return a dict of the profiles (or None) of the given users, fetched
+    in one batch."""
+    return models.UserInfo.getCachedMulti(
+        user_ids, memo=self.user_context.userinfo_memo)
 
   def render_template(self, filename, template_args):
     template_args.update(self.generateSidebarLinksDict())
-    self.response.write(self.jinja2.render_template(filename, **template_args))
+    template_args['user_context'] = self.user_context
+    self.response.write(template_env.render(filename, template_args))
+
+  def checkNotModified(self, *validators):
+    """Set the HTTP caching headers for a page built from the given
+    validators (e.g. document rank and modified date, review counts), and
+    answer a matching If-None-Match with a 304.  Returns True if the 304 was
+    sent, in which case the caller should not render the page.
+
+    The sidebar differs between anonymous and logged-in clients, so the
+    current user id is folded into the ETag, and only anonymous pages are
+    marked cacheable by shared caches."""
+    user_id = self.user_context.user_id
+    parts = [os.environ.get('CURRENT_VERSION_ID', '')]
+    parts.extend(unicode(v) for v in validators)
+    if user_id:
+      parts.append(user_id)
+    etag = hashlib.md5(u'|'.join(parts).encode('utf-8')).hexdigest()
+
+    headers = self.response.headers
+    headers['ETag'] = '"%s"' % etag
+    headers['Vary'] = 'Cookie'
+    if user_id:
+      headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    else:
+      headers['Cache-Control'] = 'public, max-age=%d' % (
+          config.PAGE_CACHE_MAX_AGE,)
+    if etag in self.request.if_none_match:
+      self.response.set_status(304)
+      return True
+    return False
 
   def render_json(self, response):
     self.response.write("%s(%s);" % (self.request.GET['callback'],
                                      json.dumps(response)))
 
-  def getLoginLink(self):
-    """Generate login or logout link and text, depending upon the logged-in
-    status of the client."""
-    if users.get_current_user():
-      url = users.create_logout_url(self.request.uri)
-      url_linktext = 'Logout'
-    else:
-      url = users.create_login_url(self.request.uri)
-      url_linktext = 'Login'
-    return (url, url_linktext)
-
-  def getAdminManageLink(self):
-    """Build link to the admin management page, if the user is logged in."""
-    if users.get_current_user():
-      admin_url = '/admin/manage'
-      return (admin_url, 'Admin Data Handling')
-    else:
-      return (None, None)
-
-  def getUserProfileLink(self):
-    """Build link to the admin management page, if the user is logged in."""
-    if users.get_current_user():
-      user_profile_url = '/admin/user_profile'
-      return (user_profile_url, 'My Profile')
-    else:
-      return (None, None)
-
-  def getViewTransactionsLink(self):
-    """Build link to the admin management page, if the user is logged in."""
-    if users.get_current_user():
-      user_profile_url = '/admin/view_transactions'
-      return (user_profile_url, 'My Transactions')
-    else:
-      return (None, None)
-
-  def createProductAdminLink(self):
-    if users.get_current_user():
-      admin_create_url = '/admin/create_product'
-      return (admin_create_url, 'Create new Posting')
-    else:
-      return (None, None)
-
   def generateSidebarLinksDict(self):
     """Build a dict containing login/logout and admin links, which will be
     included in the sidebar for all app pages."""
-
-    url, url_linktext = self.getLoginLink()
-    admin_create_url, admin_create_text = self.createProductAdminLink()
-    admin_url, admin_text = self.getAdminManageLink()
-    admin_user_profile_url, admin_user_profile_text = self.getUserProfileLink()
-    admin_view_transactions_url, admin_view_transactions_text = self.getViewTransactionsLink()
-    return {
-        'admin_create_url': admin_create_url,
-        'admin_create_text': admin_create_text,
-        'admin_url': admin_url,
-        'admin_text': admin_text,
-        'url': url,
-        'url_linktext': url_linktext,
-        'admin_user_profile_url': admin_user_profile_url,
-        'admin_user_profile_text': admin_user_profile_text,
-        'admin_view_transactions_url': admin_view_transactions_url,
-        'admin_view_transactions_text': admin_view_transactions_text
-        }
-
+    return self.user_context.sidebar_links
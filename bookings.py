@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The booking service: prices rentals and reserves product dates.
+
+A product's reserved date intervals are held in its models.ProductBookings
+entity, which is also the parent of the product's booking Transactions.  A
+booking checks the requested dates against the reserved intervals, reserves
+them and writes its Transaction in one single-group datastore transaction, so
+concurrent bookings of the same dates can't both succeed.  The Transaction is
+keyed by the client's idempotency token, so a retried or double-clicked
+booking returns the Transaction it already created instead of adding another.
+"""
+
+import collections
+import datetime
+import logging
+
+import errors
+import models
+
+from google.appengine.ext import ndb
+
+
+def priceRental(price, pickup, return_date):
+  """Return the number of rental days and the amount to pay."""
+  days = (return_date - pickup).days
+  return days, float(price) * days
+
+
+def validateDates(pickup, return_date):
+  """Raise errors.OperationFailedError if the rental dates are not valid."""
+  if return_date <= pickup:
+    raise errors.OperationFailedError(
+        'The return date must be after the pickup date.')
+  if pickup < datetime.date.today():
+    raise errors.OperationFailedError('The pickup date has passed.')
+
+
+def bookingsKey(pid):
+  return ndb.Key(models.ProductBookings, pid)
+
+
+def transactionKey(pid, user_id, token):
+  return ndb.Key(models.Transaction, '%s:%s' % (user_id, token),
+                 parent=bookingsKey(pid))
+
+
+def countPending(pids):
+  """Return a dict of the number of current or upcoming bookings of each of
+  the given pids, read in one batch."""
+  today = datetime.date.today()
+  counts = {}
+  for pid, product_bookings in zip(
+      pids, ndb.get_multi([bookingsKey(pid) for pid in pids])):
+    counts[pid] = len([i for i in product_bookings.intervals
+                       if i.end >= today]) if product_bookings else 0
+  return counts
+
+
+def book(pid, token, user_id, pickup, return_date, **details):
+  """Reserve the product for the given dates, and return a (Transaction,
+  created) pair; created is False if the booking with this token was already
+  made.  The remaining keyword args are set on a new Transaction.  Raises
+  errors.BookingConflictError if the dates are not available."""
+  if not token:
+    raise errors.OperationFailedError('Missing booking token.')
+  validateDates(pickup, return_date)
+  key = transactionKey(pid, user_id, token)
+
+  def _tx():
+    # one get for both entities of the group.
+    transaction, bookings = ndb.get_multi([key, key.parent()])
+    if transaction:
+      return transaction, False
+    if not bookings:
+      bookings = models.ProductBookings(key=key.parent())
+    bookings.pruneBefore(datetime.date.today())
+    if bookings.overlaps(pickup, return_date):
+      raise errors.BookingConflictError(
+          'The product is already booked for some of those dates.')
+    t_id = key.id()
+    bookings.intervals.append(models.BookedInterval(
+        start=pickup, end=return_date, t_id=t_id))
+    transaction = models.Transaction(
+        key=key, t_id=t_id, product_id=pid, rentee_id=user_id,
+        doc_id=user_id, pickupD=pickup, returnD=return_date,
+        verified=False, **details)
+    ndb.put_multi([bookings, transaction])
+    return transaction, True
+
+  transaction, created = ndb.transaction(_tx, retries=3)
+  if not created:
+    logging.info('booking %s already made', key.id())
+  return transaction, created
+
+
+def cancel(transaction_key):
+  """Delete a booking Transaction and release its reserved dates."""
+
+  def _tx():
+    transaction, bookings = ndb.get_multi(
+        [transaction_key, transaction_key.parent()])
+    if bookings:
+      bookings.release(transaction_key.id())
+      bookings.put()
+    if transaction:
+      transaction_key.delete()
+
+  ndb.transaction(_tx)
+
+
+def cancelMulti(transaction_keys):
+  """Delete the given Transactions and release their reserved dates, in one
+  transaction per product.  Transactions made before bookings were recorded
+  have no parent, and are just deleted."""
+  by_product = collections.defaultdict(list)
+  for key in transaction_keys:
+    by_product[key.parent()].append(key)
+  ndb.delete_multi(by_product.pop(None, []))
+
+  def _tx(bookings_key, keys):
+    bookings = bookings_key.get()
+    if bookings:
+      for key in keys:
+        bookings.release(key.id())
+      bookings.put()
+    ndb.delete_multi(keys)
+
+  for bookings_key, keys in by_product.iteritems():
+    ndb.transaction(lambda: _tx(bookings_key, keys))
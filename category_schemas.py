@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The registry of the product categories' field schemas.
+
+The category-specific product fields given in categories.product_dict are
+compiled once, at import, into a CategorySchema per category of
+categories.ctree.  A subcategory has the fields of its ancestors as well as
+its own, and its schema holds its path in the tree, which is indexed so that
+a search can be restricted to a category's subtree.  A schema builds and
+validates the category's document fields from a product's params (see
+docs.Product._buildProductFields), and describes the category's fields for
+the product form.
+
+The supported field types are search.TextField, AtomField, NumberField,
+DateField (given as YYYY-MM-DD) and GeoField (given as 'latitude,longitude').
+"""
+
+import datetime
+import logging
+
+import categories
+import errors
+
+from google.appengine.api import search
+
+
+def _toText(value):
+  return value if isinstance(value, basestring) else str(value)
+
+
+def _toAtom(value):
+  return _toText(value).strip()
+
+
+def _toDate(value):
+  if isinstance(value, datetime.date):
+    return value
+  return datetime.datetime.strptime(value.strip(), '%Y-%m-%d').date()
+
+
+def _toGeoPoint(value):
+  if isinstance(value, search.GeoPoint):
+    return value
+  latitude, longitude = value.split(',')
+  return search.GeoPoint(float(latitude), float(longitude))
+
+
+def _formatGeoPoint(value):
+  if isinstance(value, search.GeoPoint):
+    return '%s,%s' % (value.latitude, value.longitude)
+  return value
+
+
+# For each supported field type: the function converting a param value to the
+# field's value type, the form input type, and the function formatting a
+# field value for the form.
+_FIELD_TYPES = {
+    search.TextField: (_toText, 'text', None),
+    search.AtomField: (_toAtom, 'text', None),
+    search.NumberField: (float, 'number', None),
+    search.DateField: (_toDate, 'date', None),
+    search.GeoField: (_toGeoPoint, 'text', _formatGeoPoint),
+}
+
+
+class FieldSchema(object):
+  """A category-specific product field."""
+
+  def __init__(self, name, field_type):
+    if field_type not in _FIELD_TYPES:
+      raise ValueError('unsupported type %s for field %s' % (field_type, name))
+    self.name = name
+    self.field_type = field_type
+    self.label = name.replace('_', ' ').capitalize()
+    self.convert, self.input_type, self._format = _FIELD_TYPES[field_type]
+
+  def build(self, value):
+    """Build the document field holding the given param value."""
+    return self.field_type(name=self.name, value=self.convert(value))
+
+  def formatValue(self, value):
+    if self._format and value is not None:
+      return self._format(value)
+    return value
+
+
+class CategorySchema(object):
+  """The compiled field schema of a product category."""
+
+  def __init__(self, name, fields, path):
+    self.name = name
+    self.path = path  # the names of the category's ancestors, and its own
+    self.fields = sorted(fields, key=lambda f: f.name)
+    self.field_names = frozenset(f.name for f in self.fields)
+
+  def buildFields(self, params):
+    """Build the category's document fields from the given params dict.  All
+    of the fields are required.  Raises errors.OperationFailedError if a
+    value is missing or not valid for its field type."""
+    try:
+      return [f.build(params[f.name]) for f in self.fields]
+    except (KeyError, ValueError, TypeError, AttributeError):
+      # the fast path failed; find the field at fault.
+      for f in self.fields:
+        self._checkField(f, params)
+      raise
+
+  def _checkField(self, field, params):
+    if field.name not in params:
+      error_message = ('value not given for field "%s" of field type "%s"'
+                       % (field.name, field.field_type))
+      logging.warn(error_message)
+      raise errors.OperationFailedError(error_message)
+    try:
+      field.build(params[field.name])
+    except (ValueError, TypeError, AttributeError):
+      error_message = ('bad value %s for field %s of type %s' %
+                       (params[field.name], field.name, field.field_type))
+      logging.error(error_message)
+      raise errors.OperationFailedError(error_message)
+
+  def getDefaultParams(self):
+    return dict((f.name, '') for f in self.fields)
+
+  def getFormFields(self, params):
+    """Return the category's fields for the product form, as dicts, with
+    their values taken from the given params."""
+    return [{'name': f.name, 'label': f.label, 'input_type': f.input_type,
+             'value': f.formatValue(params.get(f.name, ''))}
+            for f in self.fields]
+
+
+def _compileTree(node, inherited, path, schemas):
+  """Compile the schemas of the given category tree node and its
+  descendants, in tree order."""
+  name = node.get('name')
+  fields = dict(inherited)
+  if name and name != 'root':
+    path = path + (name,)
+    for fname, field_type in categories.product_dict.get(name, {}).iteritems():
+      fields[fname] = FieldSchema(fname, field_type)
+    schemas.append(CategorySchema(name, fields.values(), path))
+  for child in node.get('children', []):
+    _compileTree(child, fields, path, schemas)
+
+
+def _compileAll():
+  schemas = []
+  _compileTree(categories.ctree, {}, (), schemas)
+  # categories with fields that are not in the tree
+  in_tree = set(s.name for s in schemas)
+  for name in sorted(set(categories.product_dict) - in_tree):
+    _compileTree({'name': name}, {}, (), schemas)
+  return schemas
+
+
+_SCHEMAS = _compileAll()
+_SCHEMA_DICT = dict((s.name, s) for s in _SCHEMAS)
+
+
+def getSchema(category_name):
+  """Return the schema of the given category, or None if it has none."""
+  return _SCHEMA_DICT.get(category_name)
+
+
+def getCategoryPath(category_name):
+  """Return the names of the given category's ancestors in the category
+  tree, followed by its own."""
+  schema = _SCHEMA_DICT.get(category_name)
+  return schema.path if schema else (category_name,)
+
+
+def getSchemas():
+  """Return the category schemas, in category tree order."""
+  return _SCHEMAS
+
+
+def getFormSchemas(params):
+  """Return the field lists of all the categories for the product form, with
+  their values taken from the given params."""
+  return [{'category': s.name, 'fields': s.getFormFields(params)}
+          for s in _SCHEMAS]
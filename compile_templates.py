@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Precompiles templates/*.html into python modules, to be run before
+deploying the app.  The compiled modules are written to templates_compiled/,
+from where template_env loads them instead of compiling the template sources
+on each new instance."""
+
+import logging
+import shutil
+import os
+
+import template_env
+
+
+def compileTemplates():
+  target = template_env.COMPILED_TEMPLATE_DIR
+  if os.path.isdir(target):
+    shutil.rmtree(target)
+  env = template_env.createEnvironment()
+  env.compile_templates(
+      target, zip=None,
+      filter_func=lambda name: name.endswith('.html'),
+      log_function=logging.info, ignore_errors=False)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  compileTemplates()
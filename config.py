@@ -23,6 +23,17 @@ PRODUCT_INDEX_NAME = 'productsearch1'  # The document index name.
     # ASCII string not starting with '!'. Whitespace characters are
     # excluded.
 
+# The product index is sharded by top-level category (see docs.Product): the
+# products of each category listed here, and of its subcategories, are kept
+# in their own index, named after PRODUCT_INDEX_NAME and the shard name.  All
+# other products are kept in the PRODUCT_INDEX_NAME index.  After changing
+# this setting, run the re-partition job from the admin page (see
+# index_jobs.py) to move the existing documents: until it is done, searches
+# on a category whose shard is new miss its products.  Not sharded by
+# default; for example:
+#   PRODUCT_INDEX_SHARDS = {'Books': 'books', 'HD Televisions': 'tvs'}
+PRODUCT_INDEX_SHARDS = {}
+
 STORE_INDEX_NAME = 'stores1'
 
 # set BATCH_RATINGS_UPDATE to False to update documents with changed ratings
@@ -35,9 +46,129 @@ BATCH_RATINGS_UPDATE = False
 RATING_MIN = 1
 RATING_MAX = 5
 
-# the number of search results to display per page
+# the default number of search results to display per page, and the page
+# sizes a user may choose from.
 DOC_LIMIT = 3
+PAGE_SIZE_CHOICES = [3, 10, 20]
+
+# A product search fetches this many pages of results at once, and caches
+# them in memcache for SEARCH_WINDOW_CACHE_TIME seconds, so that following
+# page clicks don't need another search.
+SEARCH_PREFETCH_PAGES = 5
+SEARCH_WINDOW_CACHE_TIME = 120
+
+# How long (in seconds) shared caches, such as the App Engine edge cache, may
+# serve a public page to anonymous clients before revalidating it.  Pages
+# rendered for logged-in users are always marked private.
+PAGE_CACHE_MAX_AGE = 120
+
+# The upper bounds of the price ranges offered as search filters; the last
+# range has no upper bound.
+PRICE_FACET_BOUNDS = [10, 25, 50, 100, 250]
+# The number of documents counted to build the rating and price facets.
+FACET_SAMPLE_SIZE = 200
+# The facet counts of a query are cached for FACET_CACHE_TIME seconds, and
+# computed by one instance at a time: the others wait for up to
+# FACET_LOCK_TIME seconds for its result (see single_flight.py).
+FACET_CACHE_TIME = 120
+FACET_LOCK_TIME = 5
 
 SAMPLE_DATA_BOOKS = 'sample_data_books.csv'
 SAMPLE_DATA_TVS = 'sample_data_tvs.csv'
 DEMO_UPDATE_BOOKS_DATA = 'sample_data_books_update.csv'
+
+# Product view counting (see view_counts.py).  Views are buffered in each
+# instance for up to VIEW_LOCAL_FLUSH_INTERVAL seconds, then in memcache, and
+# written to VIEW_COUNTER_SHARDS sharded counters per product once per
+# VIEW_FLUSH_INTERVAL seconds.  The totals are folded into the product
+# documents' popularity field once per POPULARITY_FOLD_INTERVAL seconds.
+VIEW_LOCAL_FLUSH_INTERVAL = 10
+VIEW_FLUSH_INTERVAL = 60
+POPULARITY_FOLD_INTERVAL = 900
+VIEW_COUNTER_SHARDS = 8
+
+# Transaction maintenance (see transaction_jobs.py): unverified transactions
+# are expired after UNVERIFIED_TRANSACTION_TTL_HOURS, and verified ones older
+# than TRANSACTION_ARCHIVE_AGE_DAYS are moved into per-user archives.  Each
+# task of the job handles up to MAINTENANCE_BATCH_SIZE transactions.
+UNVERIFIED_TRANSACTION_TTL_HOURS = 48
+TRANSACTION_ARCHIVE_AGE_DAYS = 180
+MAINTENANCE_BATCH_SIZE = 500
+
+# The number of entities or documents deleted by each task of the admin
+# 'delete all data' job.
+WIPE_BATCH_SIZE = 500
+
+# The modules imported by the warmup request (see warmup.py), in order, and the
+# budget in milliseconds for importing all of them.  The warmup request logs a
+# per-module import time report, and a warning when the budget is exceeded.
+WARMUP_MODULES = ['models', 'docs', 'base_handler', 'handlers',
+                  'admin_handlers']
+COLD_START_IMPORT_BUDGET_MS = 1000
+
+# Query rewriting (see query_rewrite.py): each instance checks at most once per
+# VOCABULARY_REFRESH_INTERVAL seconds whether the spelling vocabulary has
+# changed.  Misspelled query terms are corrected to a vocabulary word only
+# if they are at least SPELLING_MIN_SIMILARITY (0..1) similar to it.
+VOCABULARY_REFRESH_INTERVAL = 60
+SPELLING_MIN_SIMILARITY = 0.75
+# The new terms of indexed products are added to the vocabulary in batches,
+# one batch per VOCABULARY_ADD_INTERVAL seconds.
+VOCABULARY_ADD_INTERVAL = 30
+
+# The number of documents moved by each task of the index re-partition job.
+RESHARD_BATCH_SIZE = 200
+
+# Product index rebuilds (see index_jobs.py): instances re-read the index
+# aliases at most every INDEX_ALIAS_CACHE_TIME seconds, so a rebuild starts
+# copying that long after the pending indexes are set, when every instance
+# writes to them.
+INDEX_ALIAS_CACHE_TIME = 10
+
+# The product entity / document reconciliation job (see index_jobs.py), run
+# from cron.  The pid key space is split into shards at these boundaries,
+# checked in parallel; each cron run checks up to RECONCILE_CHUNKS_PER_RUN
+# chunks of RECONCILE_BATCH_SIZE pids per shard, from the shard's checkpoint.
+# With RECONCILE_REPAIR set, orphaned documents older than
+# RECONCILE_ORPHAN_MIN_AGE_DAYS and stale doc ids are repaired; otherwise
+# drift is only reported.
+RECONCILE_SHARD_BOUNDARIES = ['4', '8', 'c']
+RECONCILE_BATCH_SIZE = 200
+RECONCILE_CHUNKS_PER_RUN = 10
+RECONCILE_REPAIR = True
+RECONCILE_ORPHAN_MIN_AGE_DAYS = 1
+
+# Rate limits (see rate_limit.py), per route: the sustained rate, in requests
+# per second, and the burst size allowed per client IP address and per user.
+RATE_LIMITS = {
+    'search': (1.0, 20),
+    'review': (0.05, 5),
+}
+
+# Review moderation (see review_moderation.py).  Queued new reviews are
+# leased MODERATION_BATCH_SIZE at a time, for MODERATION_LEASE_SECONDS, and
+# deactivated if their comment contains one of MODERATION_BLOCKED_TERMS (as
+# a whole word, ignoring case) or matches one of MODERATION_BLOCKED_PATTERNS.
+MODERATION_BATCH_SIZE = 200
+MODERATION_LEASE_SECONDS = 300
+MODERATION_BLOCKED_TERMS = ['viagra', 'casino', 'scam']
+MODERATION_BLOCKED_PATTERNS = [
+    r'https?://',  # links
+    r'(.)\1{9,}',  # a character repeated ten times or more
+]
+
+# The number of reviews aggregated per task by the product rating recompute
+# job (see rating_jobs.py).
+RATING_RECOMPUTE_BATCH_SIZE = 1000
+
+# Search result projection.  Results return a short description, computed
+# when a product is indexed, of at most SHORT_DESCRIPTION_LENGTH characters,
+# rather than the full description.  With SEARCH_SNIPPETS set, queries with
+# free-text terms also request a snippet of the description, shown instead.
+SHORT_DESCRIPTION_LENGTH = 160
+SEARCH_SNIPPETS = True
+
+# Products indexed one at a time are matched against the saved searches in
+# batches, one batch per SAVED_SEARCH_MATCH_INTERVAL seconds (see
+# saved_searches.py).
+SAVED_SEARCH_MATCH_INTERVAL = 30
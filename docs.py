@@ -19,20 +19,28 @@ BaseDocumentManager provides some common utilities, and the Product subclass
 adds some Product-document-specific helper methods.
 """
 
+import bisect
 import collections
 import copy
 import datetime
+import hashlib
 import logging
 import re
 import string
+import time
 import urllib
 
-import categories
+import category_schemas
 import config
 import errors
 import models
+import product_images
+import query_rewrite
+import saved_searches
+import single_flight
 
 from google.appengine.api import search
+from google.appengine.ext.deferred import defer
 from google.appengine.ext import ndb
 
 
@@ -83,8 +91,10 @@ class BaseDocumentManager(object):
   @classmethod
   def deleteAllInIndex(cls):
     """Delete all the docs in the given index."""
-    docindex = cls.getIndex()
+    cls._deleteAllDocs(cls.getIndex())
 
+  @classmethod
+  def _deleteAllDocs(cls, docindex):
     try:
       while True:
         # until no more documents, get a list of documents,
@@ -106,8 +116,11 @@ class BaseDocumentManager(object):
     to check for that case."""
     if not doc_id:
       return None
+    return cls.getDocFromIndex(cls.getIndex(), doc_id)
+
+  @classmethod
+  def getDocFromIndex(cls, index, doc_id):
     try:
-      index = cls.getIndex()
       response = index.get_range(
           start_id=doc_id, limit=1, include_start_object=True)
       if response.results and response.results[0].doc_id == doc_id:
@@ -117,6 +130,45 @@ class BaseDocumentManager(object):
     except search.InvalidRequest: # catches ill-formed doc ids
       return None
 
+  @classmethod
+  def getDocs(cls, doc_ids):
+    """Return a dict of the product documents with the given doc ids, by doc
+    id.  They are read from all the shards at once, with one range read per
+    shard and doc id, all issued together."""
+    futures = [(doc_id, search.Index(name=name).get_range_async(
+        start_id=doc_id, limit=1, include_start_object=True))
+               for doc_id in doc_ids for name in cls.getIndexNames()]
+    found = {}
+    for doc_id, future in futures:
+      try:
+        response = future.get_result()
+      except search.InvalidRequest:  # catches ill-formed doc ids
+        continue
+      if response.results and response.results[0].doc_id == doc_id:
+        found.setdefault(doc_id, response.results[0])
+    return found
+
+  @classmethod
+  def getShortDescriptions(cls, products):
+    """Return a dict of the short descriptions of the given products, from a
+    list of (pid, category), by pid, computed from their full documents.
+    This is for the documents indexed before they had a short description
+    field; the documents are read in parallel from their category's shard."""
+    futures = [(pid, search.Index(name=cls.getIndexName(category))
+                .get_range_async(start_id=pid, limit=1,
+                                 include_start_object=True))
+               for pid, category in products]
+    descriptions = {}
+    for pid, future in futures:
+      try:
+        response = future.get_result()
+      except search.InvalidRequest:  # catches ill-formed doc ids
+        continue
+      if response.results and response.results[0].doc_id == pid:
+        description = cls(response.results[0]).getDescription()
+        descriptions[pid] = cls._shortenDescription(description or u'')
+    return descriptions
+
   @classmethod
   def removeDocById(cls, doc_id):
     """Remove the doc with the given doc id."""
@@ -150,21 +202,35 @@ class Product(BaseDocumentManager):
   design-- each explicitly point to each other, allowing their ids to be
   decoupled-- but using the product id as the doc id allows a document to be
   reindexed given its product info, without having to fetch the
-  existing document."""
+  existing document.
+
+  The product index is sharded by top-level category (see
+  config.PRODUCT_INDEX_SHARDS).  Documents are written to the shard of their
+  category; a search restricted to a category runs on its shard only, and
+  other searches run on all the shards in parallel, their results merged by
+  the search's sort order.  Each shard is named by an alias, which resolves
+  to the index currently serving it (see getAliases), so that a shard can be
+  rebuilt into a new index and switched over (see index_jobs.py)."""
 
   _INDEX_NAME = config.PRODUCT_INDEX_NAME
 
   # 'core' product document field names
   PID = 'pid'
   DESCRIPTION = 'description'
+  # the start of the description, shown in search results
+  SHORT_DESCRIPTION = 'short_description'
   CATEGORY = 'category'
+  # the category and its ancestors: one atom field per category of the path
+  CATEGORY_PATH = 'category_path'
   PRODUCT_NAME = 'name'
   IMAGE_URL = 'image_url'
+  THUMBNAIL_URL = 'thumbnail_url'
   PRICE = 'price'
   PPACC = 'ppacc'
   AVG_RATING = 'ar' #average rating
   UPDATED = 'modified'
   USER_ID = 'user_id'
+  POPULARITY = 'popularity'  # total page views, see view_counts.py
   _SORT_OPTIONS = [
         [AVG_RATING, 'average rating', search.SortExpression(
             expression=AVG_RATING,
@@ -187,16 +253,230 @@ class Product(BaseDocumentManager):
             direction=search.SortExpression.ASCENDING, default_value='')],
         [PRODUCT_NAME, 'product name', search.SortExpression(
             expression=PRODUCT_NAME,
-            direction=search.SortExpression.ASCENDING, default_value='zzz')]
+            direction=search.SortExpression.ASCENDING, default_value='zzz')],
+        [POPULARITY, 'popularity', search.SortExpression(
+            expression=POPULARITY,
+            direction=search.SortExpression.DESCENDING, default_value=0)]
       ]
 
   _SORT_MENU = None
   _SORT_DICT = None
 
+  # text fields that are not considered when matching saved searches
+  _NON_MATCH_FIELDS = frozenset([PID, USER_ID, IMAGE_URL, THUMBNAIL_URL,
+                                 PPACC])
+  # text fields whose terms are not added to the spelling vocabulary
+  _NON_VOCABULARY_FIELDS = _NON_MATCH_FIELDS | frozenset([DESCRIPTION])
+
+  # (time loaded, aliases by shard name); see getAliases
+  _aliases = (0, None)
+
 
   @classmethod
   def deleteAllInProductIndex(cls):
-    cls.deleteAllInIndex()
+    for index in cls.getIndexes():
+      cls._deleteAllDocs(index)
+
+  @classmethod
+  def getShardNames(cls):
+    """Return the names (aliases) of all the product index shards, the
+    default shard first."""
+    return [cls._INDEX_NAME] + sorted(
+        '%s-%s' % (cls._INDEX_NAME, shard)
+        for shard in config.PRODUCT_INDEX_SHARDS.itervalues())
+
+  @classmethod
+  def getShardName(cls, category):
+    """Return the name (alias) of the index shard holding the products of the
+    given category: the shard of its top-level category, or the default
+    shard."""
+    shard = None
+    if category:
+      shard = config.PRODUCT_INDEX_SHARDS.get(
+          category_schemas.getCategoryPath(category)[0])
+    return '%s-%s' % (cls._INDEX_NAME, shard) if shard else cls._INDEX_NAME
+
+  @classmethod
+  def getAliases(cls):
+    """Return a dict mapping each shard name to its (active index name,
+    pending index name) pair, read from the models.IndexAlias entities at
+    most every config.INDEX_ALIAS_CACHE_TIME seconds.  A shard without an
+    alias entity is served by the index of the same name."""
+    loaded, aliases = cls._aliases
+    if time.time() - loaded > config.INDEX_ALIAS_CACHE_TIME:
+      names = cls.getShardNames()
+      entities = ndb.get_multi([ndb.Key(models.IndexAlias, n) for n in names])
+      aliases = dict(
+          (name, (alias.index_name, alias.pending_index_name)
+           if alias else (name, None))
+          for name, alias in zip(names, entities))
+      cls._aliases = (time.time(), aliases)
+    return aliases
+
+  @classmethod
+  def getIndexNames(cls):
+    """Return the names of the active indexes of all the shards, the default
+    shard first."""
+    aliases = cls.getAliases()
+    return [aliases[name][0] for name in cls.getShardNames()]
+
+  @classmethod
+  def getIndexes(cls):
+    return [search.Index(name=name) for name in cls.getIndexNames()]
+
+  @classmethod
+  def getIndexName(cls, category):
+    """Return the name of the active index of the shard holding the products
+    of the given category."""
+    return cls.getAliases()[cls.getShardName(category)][0]
+
+  @classmethod
+  def _getWriteIndexNames(cls, shard_name):
+    """Return the names of the indexes a shard's documents are written to: the
+    active index and, during a rebuild, the pending one."""
+    return [name for name in cls.getAliases()[shard_name] if name]
+
+  @classmethod
+  def getDoc(cls, doc_id, category=None):
+    """Return the product document with the given doc id (the pid).  If the
+    product's category is given, the document is looked for in its shard
+    first.  Otherwise, or if it isn't there (the index may not have been
+    re-partitioned since the shards were changed), it is looked for in all
+    the (other) shards in parallel."""
+    if not doc_id:
+      return None
+    names = cls.getIndexNames()
+    if category is not None:
+      first = cls.getIndexName(category)
+      doc = cls.getDocFromIndex(search.Index(name=first), doc_id)
+      if doc:
+        return doc
+      names = [n for n in names if n != first]
+    futures = [search.Index(name=name).get_range_async(
+        start_id=doc_id, limit=1, include_start_object=True)
+               for name in names]
+    for future in futures:
+      try:
+        response = future.get_result()
+      except search.InvalidRequest:  # catches ill-formed doc ids
+        return None
+      if response.results and response.results[0].doc_id == doc_id:
+        return response.results[0]
+    return None
+
+  @classmethod
+  def removeDocById(cls, doc_id, keep_category=None):
+    """Remove the doc with the given doc id from all the shards, except the
+    shard of the given category, if any."""
+    keep = cls.getShardName(keep_category) if keep_category else None
+    for shard_name in cls.getShardNames():
+      if shard_name == keep:
+        continue
+      for name in cls._getWriteIndexNames(shard_name):
+        try:
+          search.Index(name=name).delete(doc_id)
+        except search.Error:
+          logging.exception('Error removing doc id %s from %s.', doc_id, name)
+
+  @classmethod
+  def add(cls, documents):
+    """Add the given document, or list of documents, to the shards of their
+    categories, with one put per shard index; during a rebuild, documents are
+    written to both the active and the pending index.  Return the put results
+    of the active indexes, in the order of the documents, or None if a put
+    failed."""
+    if isinstance(documents, search.Document):
+      documents = [documents]
+    by_shard = collections.defaultdict(list)
+    for i, doc in enumerate(documents):
+      by_shard[cls.getShardName(cls(doc).getCategory())].append(i)
+    results = [None] * len(documents)
+    try:
+      for shard_name, positions in by_shard.iteritems():
+        shard_docs = [documents[i] for i in positions]
+        active, pending = cls.getAliases()[shard_name]
+        put_results = search.Index(name=active).put(shard_docs)
+        for i, put_result in zip(positions, put_results):
+          results[i] = put_result
+        if pending:
+          search.Index(name=pending).put(shard_docs)
+    except search.Error:
+      logging.exception("Error adding documents.")
+      return None
+    return results
+
+  @classmethod
+  def rebuildDocument(cls, doc, prod):
+    """Build a new document for the given product entity from its current
+    document, with the current document schema.  The entity's values take
+    precedence; the ratings, popularity and modification date are kept."""
+    pdoc = cls(doc)
+    params = dict((f.name, f.value) for f in doc.fields)
+    params.update(pid=prod.pid, name=prod.name or pdoc.getName(),
+                  category=prod.category or pdoc.getCategory(),
+                  user_id=prod.user_id or pdoc.getUserId(),
+                  price=prod.price if prod.price is not None
+                  else pdoc.getPrice())
+    new_doc = cls._createDocument(**cls._normalizeParams(params))
+    new_pdoc = cls(new_doc)
+    new_pdoc.setAvgRating(prod.avg_rating or 0)
+    new_pdoc.setPopularity(pdoc.getPopularity() or 0)
+    updated = pdoc.getFieldVal(cls.UPDATED)
+    if updated:
+      new_pdoc.setFirstField(search.DateField(name=cls.UPDATED, value=updated))
+    return new_doc
+
+  @classmethod
+  def searchShards(cls, build_query, limit, offset=0, category=None,
+                   sort_expressions=None):
+    """Run a search on the shard holding the given category, or on all the
+    shards if no category is given, and return the number of documents found
+    and the results from the given offset.  build_query(limit, offset)
+    returns the search.Query.  The results of a search on several shards are
+    merged by the given sort expressions, or by score if there are none, so
+    the query should return the fields sorted on."""
+    if category:
+      names = [cls.getIndexName(category)]
+    else:
+      names = cls.getIndexNames()
+    if len(names) == 1:
+      response = search.Index(name=names[0]).search(
+          build_query(limit, offset))
+      return response.number_found, list(response.results)
+    # Each shard returns its first offset + limit results, of which the
+    # merged page is taken.
+    shard_limit = min(
+        offset + limit, search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH)
+    futures = [
+        search.Index(name=name).search_async(build_query(shard_limit, 0))
+        for name in names]
+    number_found = 0
+    results = []
+    for future in futures:
+      response = future.get_result()
+      number_found += response.number_found
+      results.extend(response.results)
+    cls._sortResults(results, sort_expressions)
+    return number_found, results[offset:offset + limit]
+
+  @classmethod
+  def _sortResults(cls, results, sort_expressions):
+    """Sort merged shard results in place.  Mixed sort directions are
+    handled by sorting on each expression in turn, last first, as the sort is
+    stable."""
+    if not sort_expressions:
+      results.sort(key=lambda r: r.sort_scores[0] if r.sort_scores else 0,
+                   reverse=True)
+      return
+    for expr in reversed(sort_expressions):
+      results.sort(
+          key=lambda r, expr=expr: cls._getSortValue(r, expr),
+          reverse=expr.direction == search.SortExpression.DESCENDING)
+
+  @classmethod
+  def _getSortValue(cls, doc, expr):
+    value = cls(doc).getFieldVal(expr.expression)
+    return expr.default_value if value is None else value
 
   @classmethod
   def getSortMenu(cls):
@@ -227,10 +507,10 @@ class Product(BaseDocumentManager):
       cls._SORT_DICT[elt[0]] = elt[2]
 
   @classmethod
-  def getDocFromPid(cls, pid):
+  def getDocFromPid(cls, pid, category=None):
     """Given a pid, get its doc. We're using the pid as the doc id, so we can
     do this via a direct fetch."""
-    return cls.getDoc(pid)
+    return cls.getDoc(pid, category)
 
   @classmethod
   def removeProductDocByPid(cls, pid):
@@ -239,9 +519,9 @@ class Product(BaseDocumentManager):
     cls.removeDocById(pid)
 
   @classmethod
-  def updateRatingInDoc(cls, doc_id, avg_rating):
+  def updateRatingInDoc(cls, doc_id, avg_rating, category=None):
     # get the associated doc from the doc id in the product entity
-    doc = cls.getDoc(doc_id)
+    doc = cls.getDoc(doc_id, category)
     if doc:
       pdoc = cls(doc)
       pdoc.setAvgRating(avg_rating)
@@ -260,6 +540,19 @@ class Product(BaseDocumentManager):
     # reindex the returned updated doc
     return cls.add(ndoc)
 
+  @classmethod
+  def updatePopularity(cls, view_totals):
+    """Given a dict of pids and their total view counts, update and reindex
+    the popularity field of their documents, in batches."""
+    pids = view_totals.keys()
+    batch_size = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+    for i in range(0, len(pids), batch_size):
+      doclist = cls.getDocs(pids[i:i + batch_size]).values()
+      for doc in doclist:
+        cls(doc).setPopularity(view_totals[doc.doc_id])
+      if doclist:
+        cls.add(doclist)
+
 # 'accessor' convenience methods
 
   def getPID(self):
@@ -274,10 +567,19 @@ class Product(BaseDocumentManager):
     """Get the value of the 'description' field of a Product doc."""
     return self.getFieldVal(self.DESCRIPTION)
 
+  def getShortDescription(self):
+    """Get the value of the 'short_description' field of a Product doc."""
+    return self.getFieldVal(self.SHORT_DESCRIPTION)
+
   def getCategory(self):
     """Get the value of the 'cat' field of a Product doc."""
     return self.getFieldVal(self.CATEGORY)
 
+  def getCategoryPath(self):
+    """Get the values of the 'category_path' fields of a Product doc: its
+    category and the category's ancestors."""
+    return [f.value for f in self.doc.fields if f.name == self.CATEGORY_PATH]
+
   def setCategory(self, cat):
     """Set the value of the 'cat' (category) field of a Product doc."""
     return self.setFirstField(search.NumberField(name=self.CATEGORY, value=cat))
@@ -286,6 +588,11 @@ class Product(BaseDocumentManager):
     """Get the value of the 'image_url' field of a Product doc."""
     return self.getFieldVal(self.IMAGE_URL)
 
+  def getThumbnailUrl(self):
+    """Get the value of the 'thumbnail_url' field of a Product doc, or the
+    image url for documents indexed without one."""
+    return self.getFieldVal(self.THUMBNAIL_URL) or self.getImageUrl()
+
   def getAvgRating(self):
     """Get the value of the 'ar' (average rating) field of a Product doc."""
     return self.getFieldVal(self.AVG_RATING)
@@ -294,6 +601,17 @@ class Product(BaseDocumentManager):
     """Set the value of the 'ar' field of a Product doc."""
     return self.setFirstField(search.NumberField(name=self.AVG_RATING, value=ar))
 
+  def getPopularity(self):
+    """Get the value of the 'popularity' field of a Product doc."""
+    return self.getFieldVal(self.POPULARITY)
+
+  def setPopularity(self, views):
+    """Set the value of the 'popularity' field of a Product doc, adding the
+    field to documents indexed before it existed."""
+    field = search.NumberField(name=self.POPULARITY, value=views)
+    if not self.setFirstField(field):
+      self.doc.fields.append(field)
+
   def getPrice(self):
     """Get the value of the 'price' field of a Product doc."""
     return self.getFieldVal(self.PRICE)
@@ -308,97 +626,217 @@ class Product(BaseDocumentManager):
 
 
   @classmethod
-  def generateRatingsBuckets(cls, query_string):
-    """Builds a dict of ratings 'buckets' and their counts, based on the
-    value of the 'avg_rating" field for the documents retrieved by the given
-    query.  See the 'generateRatingsLinks' method.  This information will
-    be used to generate sidebar links that allow the user to drill down in query
-    results based on rating.
+  def getMatchRecord(cls, doc):
+    """Build the compact record of a product document that is matched
+    against the saved searches (see saved_searches.py)."""
+    pdoc = cls(doc)
+    return {
+        'pid': doc.doc_id,
+        'name': pdoc.getName(),
+        'category': pdoc.getCategory(),
+        'category_path': pdoc.getCategoryPath(),
+        'avg_rating': pdoc.getAvgRating(),
+        'text': [f.value for f in doc.fields
+                 if isinstance(f, search.TextField)
+                 and f.name not in cls._NON_MATCH_FIELDS]
+        }
+
+  @classmethod
+  def getVocabularyText(cls, doc):
+    """Return the values of the text fields of a product document whose
+    terms make up the spelling vocabulary (see query_rewrite.py): the product
+    name, category name and category-specific fields."""
+    return [f.value for f in doc.fields
+            if isinstance(f, search.TextField)
+            and f.name not in cls._NON_VOCABULARY_FIELDS and f.value]
+
+  @classmethod
+  def getPriceBuckets(cls):
+    """Return the (min, max) price ranges of the price facet, as given by
+    config.PRICE_FACET_BOUNDS.  The max of the last range is None."""
+    bounds = config.PRICE_FACET_BOUNDS
+    return zip([0] + bounds, bounds + [None])
 
-    For demonstration purposes only; this will be expensive for large data
-    sets.
+  @classmethod
+  def generateFacetBuckets(cls, query_string, rating=None,
+                           price_range=(None, None), category=None):
+    """Builds dicts of ratings 'buckets' and price range buckets (indexed as
+    in getPriceBuckets) and their counts, based on the values of the
+    'avg_rating' and 'price' fields for the documents retrieved by the given
+    query.  See the 'generateFacetLinks' method.  This information will be
+    used to generate sidebar links that allow the user to drill down in query
+    results based on rating or price.
+
+    Both sets of buckets are counted in one search, which returns only the two
+    fields.  The query should not include the rating or price filters; each
+    set of buckets is instead counted over the documents that pass the
+    other's filter, given by the rating and price_range args.
+
+    Only the first config.FACET_SAMPLE_SIZE documents are counted, so this is
+    an estimate for large result sets.  The search runs on the shard of the
+    given category, if any.  The counts are cached for config.FACET_CACHE_TIME
+    seconds, and computed by a single request at a time.
     """
+    cache_key = 'facets:' + hashlib.md5(repr((
+        cls.getIndexNames(), query_string.strip().encode('utf-8'), rating,
+        price_range, category))).hexdigest()
+    return single_flight.cached(
+        cache_key,
+        lambda: cls._countFacetBuckets(
+            query_string, rating, price_range, category),
+        config.FACET_CACHE_TIME, config.FACET_LOCK_TIME)
 
+  @classmethod
+  def _countFacetBuckets(cls, query_string, rating, price_range, category):
     # do the query on the *full* search results
     # to generate the facet information, imitating what may in future be
     # provided by the FTS API.
+    def _buildQuery(limit, offset):
+      return search.Query(
+          query_string=query_string.strip(),
+          options=search.QueryOptions(
+              limit=limit, offset=offset,
+              returned_fields=[cls.AVG_RATING, cls.PRICE]))
     try:
-      sq = search.Query(
-          query_string=query_string.strip())
-      search_results = cls.getIndex().search(sq)
+      _, search_results = cls.searchShards(
+          _buildQuery, config.FACET_SAMPLE_SIZE, category=category)
     except search.Error:
       logging.exception('An error occurred on search.')
       return None
 
+    min_price, max_price = price_range
     ratings_buckets = collections.defaultdict(int)
+    price_buckets = collections.defaultdict(int)
     # populate the buckets
     for res in search_results:
-      ratings_buckets[int((cls(res)).getAvgRating() or 0)] += 1
-    return ratings_buckets
+      pdoc = cls(res)
+      doc_rating = int(pdoc.getAvgRating() or 0)
+      price = pdoc.getPrice() or 0
+      if ((min_price is None or price >= min_price) and
+          (max_price is None or price < max_price)):
+        ratings_buckets[doc_rating] += 1
+      if not rating or doc_rating == rating:
+        price_buckets[
+            bisect.bisect_right(config.PRICE_FACET_BOUNDS, price)] += 1
+    return ratings_buckets, price_buckets
 
   @classmethod
-  def generateRatingsLinks(cls, query, phash):
-    """Given a dict of ratings 'buckets' and their counts,
-    builds a list of html snippets, to be displayed in the sidebar when
-    showing results of a query. Each is a link that runs the query, additionally
-    filtered by the indicated ratings interval."""
-
-    ratings_buckets = cls.generateRatingsBuckets(query)
-    if not ratings_buckets:
-      return None
+  def generateFacetLinks(cls, query, phash, rating=None,
+                         price_range=(None, None)):
+    """Given the query without rating and price filters, builds two lists of
+    html snippets, to be displayed in the sidebar when showing results of a
+    query.  Each is a link that runs the query, additionally filtered by the
+    indicated ratings interval or price range, and keeping the other
+    filter, if any."""
+
+    buckets = cls.generateFacetBuckets(
+        query, rating, price_range, phash.get('category'))
+    if not buckets:
+      return None, None
+    ratings_buckets, price_buckets = buckets
+
+    min_price, max_price = price_range
+    rhash = dict(phash)
+    if min_price is not None:
+      rhash['min_price'] = min_price
+    if max_price is not None:
+      rhash['max_price'] = max_price
     rlist = []
     for k in range(config.RATING_MIN, config.RATING_MAX+1):
-      try:
-        v = ratings_buckets[k]
-      except KeyError:
-        return
+      v = ratings_buckets[k]
       # build html
       if k < 5:
         htext = '%s-%s (%s)' % (k, k+1, v)
       else:
         htext = '%s (%s)' % (k, v)
-      phash['rating'] = k
-      hlink = '/psearch?' + urllib.urlencode(phash)
+      rhash['rating'] = k
+      hlink = '/psearch?' + urllib.urlencode(rhash)
       rlist.append((hlink, htext))
-    return rlist
+
+    phash = dict(phash)
+    if rating:
+      phash['rating'] = rating
+    plist = []
+    for i, (low, high) in enumerate(cls.getPriceBuckets()):
+      v = price_buckets[i]
+      if not v:
+        continue
+      if high is None:
+        htext = '%s+ (%s)' % (low, v)
+      else:
+        htext = '%s-%s (%s)' % (low, high, v)
+      phash['min_price'] = low
+      phash['max_price'] = '' if high is None else high
+      hlink = '/psearch?' + urllib.urlencode(phash)
+      plist.append((hlink, htext))
+    return rlist, plist
 
   @classmethod
   def _buildCoreProductFields(
-      cls, pid, name, user_id, description, category, category_name, image_url, price, ppacc):
+      cls, pid, name, user_id, description, category, category_name, image_url,
+      price, ppacc, thumbnail_url=None):
     """Construct a 'core' document field list for the fields common to all
     Products. The various categories (as defined in the file 'categories.py'),
     may add additional specialized fields; these will be appended to this
     core list. (see _buildProductFields)."""
+    # strip the markup from the description value, which can
+    # potentially come from user input.  We do this so that
+    # we don't need to sanitize the description in the
+    # templates, showing off the Search API's ability to mark up query
+    # terms in generated snippets.  This is done only for
+    # demonstration purposes; in an actual app,
+    # it would be preferrable to use a library like Beautiful Soup
+    # instead.
+    # We'll let the templating library escape all other rendered
+    # values for us, so this is the only field we do this for.
+    description = re.sub(r'<[^>]*?>', '', description)
     fields = [search.TextField(name=cls.PID, value=pid),
               # The 'updated' field is always set to the current date.
               search.DateField(name=cls.UPDATED,
                   value=datetime.datetime.now().date()),
               search.TextField(name=cls.PRODUCT_NAME, value=name),
               search.TextField(name=cls.USER_ID,value=user_id),
-              # strip the markup from the description value, which can
-              # potentially come from user input.  We do this so that
-              # we don't need to sanitize the description in the
-              # templates, showing off the Search API's ability to mark up query
-              # terms in generated snippets.  This is done only for
-              # demonstration purposes; in an actual app,
-              # it would be preferrable to use a library like Beautiful Soup
-              # instead.
-              # We'll let the templating library escape all other rendered
-              # values for us, so this is the only field we do this for.
-              search.TextField(
-                  name=cls.DESCRIPTION,
-                  value=re.sub(r'<[^>]*?>', '', description)),
+              search.TextField(name=cls.DESCRIPTION, value=description),
+              # an atom field, so that its terms don't count twice in
+              # matching and scoring.
+              search.AtomField(
+                  name=cls.SHORT_DESCRIPTION,
+                  value=cls._shortenDescription(description)),
               search.TextField(name=cls.IMAGE_URL, value=image_url),
+              # products without an uploaded image use the full image.
+              search.TextField(
+                  name=cls.THUMBNAIL_URL, value=thumbnail_url or image_url),
               search.AtomField(name=cls.CATEGORY, value=category),
               search.NumberField(name=cls.AVG_RATING, value=0.0),
+              search.NumberField(name=cls.POPULARITY, value=0),
               search.NumberField(name=cls.PRICE, value=price),
               search.TextField(name=cls.PPACC, value=ppacc)
              ]
+    # index the category's path in the category tree, so that a search on a
+    # category also finds the products of its subcategories.
+    fields.extend(search.AtomField(name=cls.CATEGORY_PATH, value=c)
+                  for c in category_schemas.getCategoryPath(category))
     return fields
 
+  @classmethod
+  def _shortenDescription(cls, description):
+    """Return the start of the given description, of at most
+    config.SHORT_DESCRIPTION_LENGTH characters, cut at a word boundary."""
+    if not isinstance(description, unicode):
+      description = str(description).decode('utf-8', 'ignore')
+    text = u' '.join(description.split())
+    if len(text) > config.SHORT_DESCRIPTION_LENGTH:
+      text = text[:config.SHORT_DESCRIPTION_LENGTH].rsplit(u' ', 1)[0] + u'...'
+    encoded = text.encode('utf-8')
+    if len(encoded) > search.MAXIMUM_FIELD_ATOM_LENGTH:
+      text = encoded[:search.MAXIMUM_FIELD_ATOM_LENGTH - 3].decode(
+          'utf-8', 'ignore') + u'...'
+    return text
+
   @classmethod
   def _buildProductFields(cls, pid=None, category=None, name=None, user_id=None,
-                          description=None, category_name=None, image_url=None, price=None, ppacc=None, **params):
+                          description=None, category_name=None, image_url=None, price=None, ppacc=None,
+                          thumbnail_url=None, **params):
     """Build all the additional non-core fields for a document of the given
     product type (category), using the given params dict, and the
     already-constructed list of 'core' fields.  All such additional
@@ -406,48 +844,24 @@ class Product(BaseDocumentManager):
     """
 
     fields = cls._buildCoreProductFields(
-        pid, name, user_id, description, category, category_name, image_url, price, ppacc)
-    # get the specification of additional (non-'core') fields for this category
-    pdict = categories.product_dict.get(category_name)
-    if pdict:
-      # for all fields
-      for k, field_type in pdict.iteritems():
-        # see if there is a value in the given params for that field.
-        # if there is, get the field type, create the field, and append to the
-        # document field list.
-        if k in params:
-          v = params[k]
-          if field_type == search.NumberField:
-            try:
-              val = float(v)
-              fields.append(search.NumberField(name=k, value=val))
-            except ValueError:
-              error_message = ('bad value %s for field %s of type %s' %
-                               (k, v, field_type))
-              logging.error(error_message)
-              raise errors.OperationFailedError(error_message)
-          elif field_type == search.TextField:
-            fields.append(search.TextField(name=k, value=str(v)))
-          else:
-            # you may want to add handling of other field types for generality.
-            # Not needed for our current sample data.
-            logging.warn('not processed: %s, %s, of type %s', k, v, field_type)
-        else:
-          error_message = ('value not given for field "%s" of field type "%s"'
-                           % (k, field_type))
-          logging.warn(error_message)
-          raise errors.OperationFailedError(error_message)
+        pid, name, user_id, description, category, category_name, image_url, price, ppacc,
+        thumbnail_url)
+    # get the compiled schema of additional (non-'core') fields for this
+    # category, which builds and validates them.
+    schema = category_schemas.getSchema(category_name)
+    if schema:
+      fields.extend(schema.buildFields(params))
     else:
-      # else, did not have an entry in the params dict for the given field.
       logging.warn(
           'product field information not found for category name %s',
-          params['category_name'])
+          category_name)
     return fields
 
   @classmethod
   def _createDocument(
       cls, pid=None, category=None, name=None, user_id=None, description=None,
-      category_name=None, image_url=None, price=None, ppacc=None, **params):
+      category_name=None, image_url=None, price=None, ppacc=None,
+      thumbnail_url=None, **params):
     """Create a Document object from given params."""
     # check for the fields that are always required.
     if pid and category and name and user_id:
@@ -461,7 +875,8 @@ class Product(BaseDocumentManager):
           pid=pid, category=category, name=name,
           user_id=user_id,
           description=description,
-          category_name=category_name, image_url=image_url, price=price, ppacc=ppacc, **params)
+          category_name=category_name, image_url=image_url, price=price, ppacc=ppacc,
+          thumbnail_url=thumbnail_url, **params)
       # build and index the document.  Use the pid (product id) as the doc id.
       # (If we did not do this, and left the doc_id unspecified, an id would be
       # auto-generated.)
@@ -484,6 +899,9 @@ class Product(BaseDocumentManager):
       params['category_name'] = params['category']
       params['category'] = params['category']
       params['image_url'] = params['image_url']
+      if not product_images.isValidImageUrl(params['image_url']):
+        raise errors.OperationFailedError(
+            'bad image url: %s' % params['image_url'])
       try:
         params['price'] = float(params['price'])
       except ValueError:
@@ -517,7 +935,8 @@ class Product(BaseDocumentManager):
         # create product entity, sans doc_id
         dbp = models.Product(
             id=params['pid'], price=params['price'],
-            category=params['category'])
+            category=params['category'], user_id=params['user_id'],
+            name=params['name'])
         dbps.append(dbp)
       except errors.OperationFailedError:
         logging.error('error creating document from data: %s', row)
@@ -537,6 +956,11 @@ class Product(BaseDocumentManager):
       dbp.doc_id = add_results[i].id
     # persist the entities
     ndb.put_multi(dbps)
+    # run the new products against the saved searches
+    defer(saved_searches.matchProducts,
+          [cls.getMatchRecord(doc) for doc in docs])
+    query_rewrite.queueTerms(
+        [text for doc in docs for text in cls.getVocabularyText(doc)])
 
   @classmethod
   def buildProduct(cls, params):
@@ -548,20 +972,24 @@ class Product(BaseDocumentManager):
     # check to see if doc already exists.  We do this because we need to retain
     # some information from the existing doc.  We could skip the fetch if this
     # were not the case.
-    curr_doc = cls.getDocFromPid(params['pid'])
+    curr_doc = cls.getDocFromPid(params['pid'], params['category'])
     d = cls._createDocument(**params)
-    if curr_doc:  #  retain ratings info from existing doc
+    if curr_doc:  #  retain ratings and popularity info from existing doc
       avg_rating = cls(curr_doc).getAvgRating()
       cls(d).setAvgRating(avg_rating)
+      cls(d).setPopularity(cls(curr_doc).getPopularity() or 0)
 
     # This will reindex if a doc with that doc id already exists
     logging.info(d)
     doc_ids = cls.add(d)
     try:
       doc_id = doc_ids[0].id
-    except IndexError:
+    except (IndexError, TypeError):  # no results, or the put failed
       doc_id = None
       raise errors.OperationFailedError('could not index document')
+    if curr_doc:
+      # if the category changed, the old doc may be in another shard.
+      cls.removeDocById(doc_id, keep_category=params['category'])
     logging.debug('got new doc id %s for product: %s', doc_id, params['pid'])
 
     # now update the entity
@@ -577,4 +1005,6 @@ class Product(BaseDocumentManager):
       return prod
     prod = ndb.transaction(_tx)
     logging.debug('prod: %s', prod)
+    saved_searches.queueProduct(cls.getMatchRecord(d))
+    query_rewrite.queueTerms(cls.getVocabularyText(d))
     return prod
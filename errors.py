@@ -31,3 +31,6 @@ class NotFoundError(Error):
 class OperationFailedError(Error):
   """Raised when necessary operation has failed."""
 
+
+class BookingConflictError(Error):
+  """Raised when requested booking dates overlap an existing booking."""
@@ -17,23 +17,29 @@
 """Public actions from the user"""
 
 
+import hashlib
 import logging
-import time
-import traceback
 import urllib
-import wsgiref
+import uuid
+import wsgiref.util
 
 from base_handler import BaseHandler
+import bookings
 import config
 import docs
+import errors
 import models
+import product_images
+import query_rewrite
+import review_moderation
+import saved_searches
+import single_flight
 import utils
-import uuid
-
+import view_counts
 
 from datetime import datetime
+from google.appengine.api import memcache
 from google.appengine.api import search
-from google.appengine.api import users
 from google.appengine.ext.deferred import defer
 from google.appengine.ext import ndb
 
@@ -44,9 +50,14 @@ class IndexHandler(BaseHandler):
   def get(self):
     cat_info = models.Category.getCategoryInfo()
     sort_info = docs.Product.getSortMenu()
+    # the home page only changes when the category or sort menus do.
+    if self.checkNotModified(cat_info, sort_info):
+      return
     template_values = {
         'cat_info': cat_info,
-        'sort_info': sort_info
+        'sort_info': sort_info,
+        'doc_limit': ProductSearchHandler._getDefaultDocLimit(),
+        'page_sizes': config.PAGE_SIZE_CHOICES
         }
     self.render_template('index.html', template_values)
 
@@ -92,33 +103,42 @@ class ShowProductHandler(BaseHandler):
           {'title': 'Error', 'msg': msg,
            'goto_url': url, 'linktext': linktext})
       return
-    doc = docs.Product.getDocFromPid(pid)
+    # the category, when the link gives it, saves looking in every shard.
+    doc = docs.Product.getDocFromPid(pid, params['category'] or None)
     logging.info(doc)
     if not doc:
       error_message = ('Document not found for pid %s.' % pid)
       return self.abort(404, error_message)
       logging.error(error_message)
+    view_counts.recordView(pid)
     pdoc = docs.Product(doc)
     pname = pdoc.getName()
     price = pdoc.getPrice()
     ppacc = pdoc.getMerchant()
     app_url = wsgiref.util.application_uri(self.request.environ)
     rlink = '/reviews?' + urllib.urlencode({'pid': pid, 'pname': pname})
-    olink = '/order?' + urllib.urlencode({'pid': pid, 'pname': pname})
-    userinfo = ndb.Key(models.UserInfo, pdoc.getUserId()).get()
+    olink = '/order?' + urllib.urlencode(
+        {'pid': pid, 'pname': pname,
+         'category': (pdoc.getCategory() or '').encode('utf-8')})
+    userinfo = self.getUserInfo(pdoc.getUserId())
     meetPoint = "Montreal, Qc"
+    phoneNumber = "None"
+    nickname = "Mr. X"
     if userinfo is not None:
         meetPoint = userinfo.meetPoint
         phoneNumber = userinfo.phoneNumber
         nickname = userinfo.nickname
-    user = users.get_current_user()
-    if user is not None:
-        if user.user_id() == pdoc.getUserId():
-            user_is_poster = True
-        else:
-            user_is_poster = None
+    user_id = self.user_context.user_id
+    if user_id is not None and user_id == pdoc.getUserId():
+        user_is_poster = True
     else:
-        user_is_poster = None;
+        user_is_poster = None
+    # A re-indexed document gets a new rank, and a new review changes its
+    # rating field; profile edits change the poster's contact info.
+    if self.checkNotModified(
+        doc.rank, pdoc.getFieldVal(docs.Product.UPDATED),
+        pdoc.getAvgRating(), meetPoint, phoneNumber, nickname):
+      return
     template_values = {
         'app_url': app_url,
         'pid': pid,
@@ -160,6 +180,7 @@ class CreateReviewHandler(BaseHandler):
       params[k] = self.request.get(k, v)
     return params
 
+  @BaseHandler.rate_limited('review')
   def post(self):
     """Create a new review entity from the submitted information."""
     self.createReview(self.parseParams())
@@ -167,7 +188,7 @@ class CreateReviewHandler(BaseHandler):
   def createReview(self, params):
     """Create a new review entity from the information in the params dict."""
 
-    author = users.get_current_user()
+    author = self.user_context.user
     comment = params['comment']
     pid = params['pid']
     pname = params['pname']
@@ -240,6 +261,7 @@ class CreateReviewHandler(BaseHandler):
           comment=comment)
       review.put()
       defer(utils.updateAverageRating, key, _transactional=True)
+      review_moderation.enqueueReview(key)
       return review
     return ndb.transaction(_tx)
 
@@ -249,6 +271,7 @@ class ProductSearchHandler(BaseHandler):
 
   _DEFAULT_DOC_LIMIT = 10  #default number of search results to display per page.
   _OFFSET_LIMIT = 1000
+  _doc_limit = None  # the default page size, read from the config file
 
   def parseParams(self):
     """Filter the param set to the expected params."""
@@ -258,7 +281,11 @@ class ProductSearchHandler(BaseHandler):
         'category': '',
         'sort': '',
         'rating': '',
-        'offset': '0'
+        'offset': '0',
+        'num': '',
+        'min_price': '',
+        'max_price': '',
+        'since': ''
     }
     for k, v in params.iteritems():
       # Possibly replace default values.
@@ -270,15 +297,30 @@ class ProductSearchHandler(BaseHandler):
     self.redirect('/psearch?' + urllib.urlencode(
         dict([k, v.encode('utf-8')] for k, v in params.items())))
 
-  def _getDocLimit(self):
+  @classmethod
+  def _getDefaultDocLimit(cls):
     """if the doc limit is not set in the config file, use the default."""
-    doc_limit = self._DEFAULT_DOC_LIMIT
+    if cls._doc_limit is None:
+      try:
+        cls._doc_limit = int(config.DOC_LIMIT)
+      except ValueError:
+        logging.error(
+            'DOC_LIMIT not properly set in config file; using default.')
+        cls._doc_limit = cls._DEFAULT_DOC_LIMIT
+    return cls._doc_limit
+
+  def _getDocLimit(self, params):
+    """Get the page size requested by the 'num' param, snapped to the
+    nearest of the allowed page sizes, or the default page size.  Limiting
+    the page sizes to a few choices keeps the cached result windows (see
+    _searchPage) shared between requests."""
     try:
-      doc_limit = int(config.DOC_LIMIT)
-    except ValueError:
-      logging.error('DOC_LIMIT not properly set in config file; using default.')
-    return doc_limit
+      num = int(params.get('num'))
+    except (TypeError, ValueError):
+      return self._getDefaultDocLimit()
+    return min(config.PAGE_SIZE_CHOICES, key=lambda size: abs(size - num))
 
+  @BaseHandler.rate_limited('search')
   def get(self):
     """Handle a product search request."""
 
@@ -296,14 +338,19 @@ class ProductSearchHandler(BaseHandler):
     sort_dict = docs.Product.getSortDict()
     query = params.get('query', '')
     user_query = query
-    doc_limit = self._getDocLimit()
+    doc_limit = self._getDocLimit(params)
 
     categoryq = params.get('category')
     if categoryq:
-      # add specification of the category to the query
-      # Because the category field is atomic, put the category string
+      # add specification of the category to the query.  Documents hold their
+      # category's path in the category tree, so one term matches the whole
+      # subtree; documents indexed before the path was added only have the
+      # category field.
+      # Because the category fields are atomic, put the category string
       # in quotes for the search.
-      query += ' %s:"%s"' % (docs.Product.CATEGORY, categoryq)
+      query += ' (%s:"%s" OR %s:"%s")' % (
+          docs.Product.CATEGORY_PATH, categoryq,
+          docs.Product.CATEGORY, categoryq)
 
     sortq = params.get('sort')
     try:
@@ -311,20 +358,43 @@ class ProductSearchHandler(BaseHandler):
     except ValueError:
       offsetval = 0
 
-    # Check to see if the query parameters include a ratings filter, and
-    # add that to the final query string if so.  At the same time, generate
-    # 'ratings bucket' counts and links-- based on the query prior to addition
-    # of the ratings filter-- for sidebar display.
-    query, rlinks = self._generateRatingsInfo(
-        params, query, user_query, sortq, categoryq)
+    query = self._addDateFilter(params, query)
+
+    # Check to see if the query parameters include ratings or price filters,
+    # and add them to the final query string if so.
+    facet_query = query
+    query, rating, price_range = self._addFacetFilters(params, query)
     logging.debug('query: %s', query.strip())
 
+    corrected_from = corrected_query = None
     try:
-      # build the query and perform the search
-      search_query = self._buildQuery(
-          query, sortq, sort_dict, doc_limit, offsetval)
-      search_results = docs.Product.getIndex().search(search_query)
-      returned_count = len(search_results.results)
+      # get the page of results, from a cached window of results if possible
+      number_found, search_results = self._searchPage(
+          query, sortq, sort_dict, doc_limit, offsetval, categoryq)
+      if not number_found:
+        # Nothing found: retry once with the normalized and spelling-corrected
+        # user query.  The query string starts with the user query, followed
+        # by the filters.  The rewrite is only searched: the user's text is
+        # kept in the search box and links, so every page is rewritten the
+        # same way.
+        rewritten = query_rewrite.rewriteQuery(user_query)
+        if rewritten:
+          filters = query[len(user_query):]
+          number_found, search_results = self._searchPage(
+              rewritten + filters, sortq, sort_dict, doc_limit, offsetval,
+              categoryq)
+          if number_found:
+            corrected_from = user_query
+            # shown without the stemming operators
+            corrected_query = rewritten.replace(u'~', u'')
+            query = rewritten + filters
+            facet_query = rewritten + facet_query[len(user_query):]
+      returned_count = len(search_results)
+      # generate 'ratings bucket' and price range counts and links-- based on
+      # the query prior to addition of these filters-- for sidebar display.
+      rlinks, plinks = self._generateFacetLinks(
+          params, facet_query, user_query, sortq, categoryq, rating,
+          price_range)
 
     except search.Error:
       logging.exception("Search error:")  # log the exception stack trace
@@ -339,16 +409,27 @@ class ProductSearchHandler(BaseHandler):
 
     # cat_name = models.Category.getCategoryName(categoryq)
     psearch_response = []
+    # fetch the profiles of all the posters in one batch
+    userinfos = self.getUserInfos(
+        [docs.Product(doc).getUserId() for doc in search_results])
+    # documents indexed before they had a short description (until the index
+    # is rebuilt) get one from their full document, unless they have a snippet.
+    short_descriptions = docs.Product.getShortDescriptions(
+        [(pdoc.getPID(), pdoc.getCategory())
+         for pdoc in map(docs.Product, search_results)
+         if pdoc.getShortDescription() is None and not pdoc.doc.expressions])
     # For each document returned from the search
     for doc in search_results:
       # logging.info("doc: %s ", doc)
       pdoc = docs.Product(doc)
-      # use the description field as the default description snippet, since
-      # snippeting is not supported on the dev app server.
-      description_snippet = pdoc.getDescription()
-      image_url = pdoc.getImageUrl()
-      logging.info("User ID: %s", pdoc.getUserId())
-      userinfo = ndb.Key(models.UserInfo, pdoc.getUserId()).get()
+      # use the short description when there is no snippet: if the query has
+      # no free-text terms, or on the dev app server, which doesn't support
+      # snippeting.
+      description_snippet = pdoc.getShortDescription()
+      if description_snippet is None:
+        description_snippet = short_descriptions.get(pdoc.getPID(), '')
+      image_url = pdoc.getThumbnailUrl()
+      userinfo = userinfos.get(pdoc.getUserId())
       user_nickname = "Mr. X"
       meetPoint = "Montreal, Qc"
       phoneNumber = "None"
@@ -357,37 +438,36 @@ class ProductSearchHandler(BaseHandler):
           meetPoint = userinfo.meetPoint
           phoneNumber = userinfo.phoneNumber
       price = pdoc.getPrice()
-      # on the dev app server, the doc.expressions property won't be populated.
+      # the description snippet is the only returned expression.
       for expr in doc.expressions:
         if expr.name == docs.Product.DESCRIPTION:
           description_snippet = expr.value
-        # uncomment to use 'adjusted price', which should be
-        # defined in returned_expressions in _buildQuery() below, as the
-        # displayed price.
-        # elif expr.name == 'adjusted_price':
-          # price = expr.value
+          break
 
       # get field information from the returned doc
       pid = pdoc.getPID()
       cat = catname = pdoc.getCategory()
       pname = pdoc.getName()
       avg_rating = pdoc.getAvgRating()
+      prod_link = '/product?' + urllib.urlencode(
+          {'pid': pid, 'category': (cat or '').encode('utf-8')})
       # for this result, generate a result array of selected doc fields, to
       # pass to the template renderer
       psearch_response.append(
           [doc, urllib.quote_plus(pid), cat,
            description_snippet, price, pname,
            catname, avg_rating, image_url,
-           user_nickname, meetPoint, phoneNumber])
+           user_nickname, meetPoint, phoneNumber, prod_link])
     if not query:
       print_query = 'All'
+    elif corrected_from:
+      print_query = query.replace(u'~', u'')
     else:
       print_query = query
 
     # Build the next/previous pagination links for the result set.
     (prev_link, next_link) = self._generatePaginationLinks(
-        offsetval, returned_count,
-        search_results.number_found, params)
+        offsetval, doc_limit, returned_count, number_found, params)
 
     logging.debug('returned_count: %s', returned_count)
     # construct the template values
@@ -395,28 +475,80 @@ class ProductSearchHandler(BaseHandler):
         'base_pquery': user_query, 'next_link': next_link,
         'prev_link': prev_link, 'qtype': 'product',
         'query': query, 'print_query': print_query,
+        'corrected_from': corrected_from, 'corrected_query': corrected_query,
         'pcategory': categoryq, 'sort_order': sortq, 'category_name': categoryq,
         'first_res': offsetval + 1, 'last_res': offsetval + returned_count,
         'returned_count': returned_count,
-        'number_found': search_results.number_found,
+        'number_found': number_found,
         'search_response': psearch_response,
         'cat_info': cat_info, 'sort_info': sort_info,
-        'ratings_links': rlinks}
+        'ratings_links': rlinks, 'rating': params.get('rating'),
+        'price_links': plinks, 'min_price': params.get('min_price'),
+        'max_price': params.get('max_price'), 'since': params.get('since'),
+        'doc_limit': doc_limit, 'page_sizes': config.PAGE_SIZE_CHOICES}
     # render the result page.
     self.render_template('index.html', template_values)
 
-  def _buildQuery(self, query, sortq, sort_dict, doc_limit, offsetval):
-    """Build and return a search query object."""
-
-    # computed and returned fields examples.  Their use is not required
-    # for the application to function correctly.
-    computed_expr = search.FieldExpression(name='adjusted_price',
-        expression='price * 1.08')
-    returned_fields = [docs.Product.PID, docs.Product.DESCRIPTION,
-                docs.Product.CATEGORY, docs.Product.AVG_RATING,
-                docs.Product.PRICE, docs.Product.IMAGE_URL, docs.Product.USER_ID, docs.Product.PRODUCT_NAME]
+  def _searchPage(
+      self, query, sortq, sort_dict, doc_limit, offsetval, category=None):
+    """Return the number of documents found by the query, and the page of
+    results at the given offset.  Consecutive pages are served from one
+    window of config.SEARCH_PREFETCH_PAGES pages, fetched with a single
+    search and cached in memcache.  Identical concurrent searches within the
+    instance share one search.  If a category is given, only its index shard
+    is searched."""
+    window_size = doc_limit * config.SEARCH_PREFETCH_PAGES
+    window_offset = offsetval - offsetval % window_size
+    if offsetval + doc_limit > window_offset + window_size:
+      # the page straddles two aligned windows (the page size changed), so
+      # start a window at the page.
+      window_offset = offsetval
+    if category:
+      index_names = docs.Product.getIndexName(category)
+    else:
+      index_names = ','.join(docs.Product.getIndexNames())
+    cache_key = 'psearch:' + hashlib.md5('|'.join([
+        index_names, query.strip().encode('utf-8'),
+        sortq or '', str(window_offset), str(window_size)])).hexdigest()
+
+    def _getWindow():
+      window = memcache.get(cache_key)
+      if window is None:
+        window = docs.Product.searchShards(
+            lambda limit, offset: self._buildQuery(
+                query, sortq, sort_dict, limit, offset),
+            window_size, window_offset, category=category,
+            sort_expressions=self._getSortExpressions(sortq, sort_dict))
+        try:
+          memcache.set(
+              cache_key, window, time=config.SEARCH_WINDOW_CACHE_TIME)
+        except Exception:  # e.g. too large to cache; just search next time.
+          logging.exception('could not cache search results')
+      return window
+    number_found, results = single_flight.call(cache_key, _getWindow)
+    start = offsetval - window_offset
+    return number_found, results[start:start + doc_limit]
 
-    if sortq == 'relevance':
+  def _buildQuery(self, query, sortq, sort_dict, doc_limit, offsetval):
+    """Build and return a search query object.  Only the fields shown in
+    the results are returned, and a description snippet is only requested if
+    the query has free-text terms to highlight."""
+
+    returned_fields = [docs.Product.PID, docs.Product.SHORT_DESCRIPTION,
+                       docs.Product.CATEGORY, docs.Product.AVG_RATING,
+                       docs.Product.PRICE, docs.Product.THUMBNAIL_URL,
+                       docs.Product.USER_ID, docs.Product.PRODUCT_NAME]
+    expr_list = self._getSortExpressions(sortq, sort_dict)
+    # the results of a search on several index shards are merged by the
+    # values of the sort fields, so they need to be returned.
+    for expr in expr_list or []:
+      if expr.expression not in returned_fields:
+        returned_fields.append(expr.expression)
+    snippeted_fields = []
+    if config.SEARCH_SNIPPETS and query_rewrite.hasFreeTextTerms(query):
+      snippeted_fields = [docs.Product.DESCRIPTION]
+
+    if expr_list is None:
       # If sorting on 'relevance', use the Match scorer.
       sortopts = search.SortOptions(match_scorer=search.MatchScorer())
       search_query = search.Query(
@@ -425,21 +557,10 @@ class ProductSearchHandler(BaseHandler):
               limit=doc_limit,
               offset=offsetval,
               sort_options=sortopts,
-              snippeted_fields=[docs.Product.DESCRIPTION],
-              returned_expressions=[computed_expr],
+              snippeted_fields=snippeted_fields,
               returned_fields=returned_fields
               ))
     else:
-      # Otherwise (not sorting on relevance), use the selected field as the
-      # first dimension of the sort expression, and the average rating as the
-      # second dimension, unless we're sorting on rating, in which case price
-      # is the second sort dimension.
-      # We get the sort direction and default from the 'sort_dict' var.
-      if sortq == docs.Product.AVG_RATING:
-        expr_list = [sort_dict.get(sortq), sort_dict.get(docs.Product.PRICE)]
-      else:
-        expr_list = [sort_dict.get(sortq), sort_dict.get(
-              docs.Product.AVG_RATING)]
       sortopts = search.SortOptions(expressions=expr_list)
       # logging.info("sortopts: %s", sortopts)
       search_query = search.Query(
@@ -448,18 +569,31 @@ class ProductSearchHandler(BaseHandler):
               limit=doc_limit,
               offset=offsetval,
               sort_options=sortopts,
-              snippeted_fields=[docs.Product.DESCRIPTION],
-              returned_expressions=[computed_expr],
+              snippeted_fields=snippeted_fields,
               returned_fields=returned_fields
               ))
     return search_query
 
-  def _generateRatingsInfo(
-      self, params, query, user_query, sort, category):
-    """Add a ratings filter to the query as necessary, and build the
-    sidebar ratings buckets content."""
+  def _getSortExpressions(self, sortq, sort_dict):
+    """Return the sort expressions of the search, or None if sorting on
+    relevance."""
+    if sortq == 'relevance':
+      return None
+    # Otherwise (not sorting on relevance), use the selected field as the
+    # first dimension of the sort expression, and the average rating as the
+    # second dimension, unless we're sorting on rating, in which case price
+    # is the second sort dimension.
+    # We get the sort direction and default from the 'sort_dict' var.
+    if sortq == docs.Product.AVG_RATING:
+      expr_list = [sort_dict.get(sortq), sort_dict.get(docs.Product.PRICE)]
+    else:
+      expr_list = [sort_dict.get(sortq), sort_dict.get(
+            docs.Product.AVG_RATING)]
+    return [expr for expr in expr_list if expr]
 
-    orig_query = query
+  def _addFacetFilters(self, params, query):
+    """Add the ratings and price filters to the query as necessary.  Return
+    the query, the rating, and the (min, max) price range."""
     try:
       n = int(params.get('rating', 0))
       # check that rating is not out of range
@@ -473,18 +607,53 @@ class ProductSearchHandler(BaseHandler):
                                         docs.Product.AVG_RATING, n+1)
       else:  # max rating
         query += ' %s:%s' % (docs.Product.AVG_RATING, n)
+    # the max price is exclusive, so that the price ranges don't overlap.
+    min_price = self._parsePrice(params.get('min_price'))
+    max_price = self._parsePrice(params.get('max_price'))
+    if min_price is not None:
+      query += ' %s >= %s' % (docs.Product.PRICE, min_price)
+    if max_price is not None:
+      query += ' %s < %s' % (docs.Product.PRICE, max_price)
+    return query, n, (min_price, max_price)
+
+  def _generateFacetLinks(
+      self, params, orig_query, user_query, sort, category, rating,
+      price_range):
+    """Build the sidebar ratings and price buckets content, both counted in
+    one facet search over the query prior to addition of these filters."""
     query_info = {'query': user_query.encode('utf-8'), 'sort': sort,
-             'category': category}
-    rlinks = docs.Product.generateRatingsLinks(orig_query, query_info)
-    return (query, rlinks)
+             'category': category,
+             'since': params.get('since', '').encode('utf-8'),
+             'num': params.get('num', '').encode('utf-8')}
+    return docs.Product.generateFacetLinks(
+        orig_query, query_info, rating, price_range)
+
+  def _parsePrice(self, value):
+    """Return the given price param as a float, or None if not valid."""
+    try:
+      price = float(value)
+    except (TypeError, ValueError):
+      return None
+    return price if price >= 0 else None
+
+  def _addDateFilter(self, params, query):
+    """Add a filter on the listing date to the query, if the 'since' param
+    holds a valid date."""
+    since = params.get('since')
+    if since:
+      try:
+        since_date = datetime.strptime(since, '%Y-%m-%d').date()
+        query += ' %s >= %s' % (docs.Product.UPDATED, since_date.isoformat())
+      except ValueError:
+        logging.info('bad since date: %s', since)
+    return query
 
   def _generatePaginationLinks(
-        self, offsetval, returned_count, number_found, params):
+        self, offsetval, doc_limit, returned_count, number_found, params):
     """Generate the next/prev pagination links for the query.  Detect when we're
     out of results in a given direction and don't generate the link in that
     case."""
 
-    doc_limit = self._getDocLimit()
     pcopy = params.copy()
     if offsetval - doc_limit >= 0:
       pcopy['offset'] = offsetval - doc_limit
@@ -517,6 +686,9 @@ class ShowReviewsHandler(BaseHandler):
       if prod:
         avg_rating = prod.avg_rating  # get the product's average rating, over
             # all its reviews
+        # the review list only changes when a review is counted in.
+        if self.checkNotModified(pid, pname, prod.num_reviews, avg_rating):
+          return
         # get the list of review entities for the product
         reviews = prod.reviews()
         logging.debug('reviews: %s', reviews)
@@ -537,8 +709,35 @@ class ShowReviewsHandler(BaseHandler):
       self.render_template('reviews.html', template_values)
 
 
+class ProductImageHandler(BaseHandler):
+  """Serve a stored product image.  Image urls carry the image digest, so
+  responses can be cached for as long as clients and the edge cache will
+  hold them; a url whose digest is not the stored image's is not found, so
+  that a cached url never serves a replaced image."""
+
+  _CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+  def get(self):
+    image = product_images.getImage(
+        self.request.get('pid'),
+        self.request.get('v') or product_images.ORIGINAL)
+    digest = self.request.get('h')
+    if not image or (digest and digest != image.digest):
+      self.abort(404)
+    etag = '"%s"' % image.digest
+    self.response.headers['ETag'] = etag
+    self.response.headers['Cache-Control'] = (
+        'public, max-age=%d' % self._CACHE_MAX_AGE)
+    if self.request.headers.get('If-None-Match') == etag:
+      self.response.status = 304
+      return
+    self.response.content_type = str(image.content_type)
+    self.response.out.write(image.data)
+
+
 class OrderHandler(BaseHandler):
-    """Display product details."""
+    """Quote a rental of a product (GET), and book it (POST).  See
+    bookings.py."""
 
     def parseParams(self):
         """Filter the param set to the expected params."""
@@ -552,7 +751,9 @@ class OrderHandler(BaseHandler):
             'ppacc': '',
             'pickupD': '',
             'returnD': '',
-            'amount_paid': ''
+            'amount_paid': '',
+            'token': '',
+            'category': ''
         }
         for k, v in params.iteritems():
             # Possibly replace default values.
@@ -562,80 +763,147 @@ class OrderHandler(BaseHandler):
         return params
 
     def get(self):
-        """Do a document search for the given product id,
-    and display the retrieved document fields."""
+        """Show the price of renting the product for the requested dates, and
+        a form to confirm the booking."""
+        self.buildOrderPage(self.parseParams(), book=False)
 
-        params = self.parseParams()
+    @BaseHandler.logged_in
+    def post(self):
+        """Book the product for the requested dates."""
+        self.buildOrderPage(self.parseParams(), book=True)
 
+    def buildOrderPage(self, params, book):
         pid = params['pid']
         if not pid:
             # we should not reach this
-            msg = 'Error: do not have product id.'
-            url = '/'
-            linktext = 'Go to product search page.'
-            self.render_template(
-                'notification.html',
-                {'title': 'Error', 'msg': msg,
-                 'goto_url': url, 'linktext': linktext})
+            self.renderError('Error: do not have product id.')
             return
-        doc = docs.Product.getDocFromPid(pid)
-        logging.info(doc)
+        doc = docs.Product.getDocFromPid(pid, params['category'] or None)
         if not doc:
             error_message = ('Document not found for pid %s.' % pid)
-            return self.abort(404, error_message)
             logging.error(error_message)
+            return self.abort(404, error_message)
 
         date_format = "%Y-%m-%d"
-        pickupD = (datetime.strptime(self.request.get('pickupD'), date_format))
-        returnD = (datetime.strptime(self.request.get('returnD'), date_format))
-        logging.info("pickup: %s", pickupD)
-        logging.info("return: %s", returnD)
-        c = returnD - pickupD
-        logging.info("c: %s", c)
-        c = int(c.days)
-        logging.info("days: %d", c)
+        try:
+            pickupD = datetime.strptime(params['pickupD'], date_format).date()
+            returnD = datetime.strptime(params['returnD'], date_format).date()
+            bookings.validateDates(pickupD, returnD)
+        except ValueError:
+            self.renderError('Please give valid pickup and return dates.')
+            return
+        except errors.Error as e:
+            self.renderError(e.error_message)
+            return
         pdoc = docs.Product(doc)
         pname = pdoc.getName()
         price = pdoc.getPrice()
         ppacc = pdoc.getMerchant()
-        amount_paid = float(price) * int(c)
+        days, amount_paid = bookings.priceRental(price, pickupD, returnD)
         app_url = wsgiref.util.application_uri(self.request.environ)
         template_values = {
             'app_url': app_url,
             'pid': pid,
             'pname': pname,
+            'category': pdoc.getCategory(),
             'price': price,
             'ppacc': ppacc,
-            'pickupD': pickupD.date(),
-            'returnD': returnD.date(),
+            'pickupD': pickupD,
+            'returnD': returnD,
+            'days': days,
             'amount_paid': amount_paid,
             'image_url': pdoc.getImageUrl(),
             'prod_doc': doc,
+            # a new idempotency token for the booking form; a retried or
+            # double-submitted form reuses the same one.
+            'token': uuid.uuid4().hex,
             # for this demo, 'admin' status simply equates to being logged in
-            'user_is_admin': users.get_current_user()}
-        logging.info("name: %s", pname)
-        logging.info("name: %s", pickupD.date())
-        logging.info("name: %s", returnD.date())
-        logging.info("name: %s", amount_paid)
-        user = users.get_current_user()
-        userinfo = ndb.Key(models.UserInfo, pdoc.getUserId()).get()
-        transaction = models.Transaction(
-            t_id = uuid.uuid4().hex,  # auto-generate default UID
-            rentee_id = user.user_id(),  # give id automatically to product
-            renter_id = pdoc.getUserId(),
-            amount_paid = amount_paid,
-            pickupD = pickupD.date(),
-            returnD = returnD.date(),
-            meet_point = userinfo.meetPoint,
-            doc_id = user.user_id(),
-            product = pname,
-            email = userinfo.email,
-            #dateSent = '',
-            #payment_status = ndb.StringProperty(),
-            verified = False
-        )
-        transaction.put()
-        logging.info('transaction saved')
-        logging.info('template_values :')
-        logging.info(template_values)
-        self.render_template('order.html', template_values)
\ No newline at end of file
+            'user_is_admin': self.user_context.user}
+
+        if book:
+            userinfo = self.getUserInfo(pdoc.getUserId())
+            try:
+                transaction, created = bookings.book(
+                    pid, params['token'], self.user_context.user_id,
+                    pickupD, returnD,
+                    renter_id=pdoc.getUserId(),
+                    amount_paid=amount_paid,
+                    meet_point=userinfo.meetPoint if userinfo else None,
+                    product=pname,
+                    email=userinfo.email if userinfo else None)
+            except errors.Error as e:
+                template_values['error_message'] = e.error_message
+            else:
+                logging.info('transaction %s %s', transaction.t_id,
+                             'saved' if created else 'already saved')
+                template_values['transaction'] = transaction
+        self.render_template('order.html', template_values)
+
+    def renderError(self, msg):
+        url = '/'
+        linktext = 'Go to product search page.'
+        self.render_template(
+            'notification.html',
+            {'title': 'Error', 'msg': msg,
+             'goto_url': url, 'linktext': linktext})
+
+
+class SavedSearchesHandler(BaseHandler):
+  """Lists the user's saved searches and the products that matched them, and
+  saves or deletes searches."""
+
+  _MATCHES_PER_SEARCH = 10
+
+  @BaseHandler.logged_in
+  def get(self):
+    self.buildSavedSearchesPage()
+
+  @BaseHandler.logged_in
+  def post(self):
+    action = self.request.get('action')
+    user_id = self.user_context.user_id
+    if action == 'save':
+      try:
+        min_rating = int(self.request.get('rating') or 0)
+      except ValueError:
+        min_rating = 0
+      saved_searches.saveSearch(
+          user_id, self.request.get('query'),
+          category=self.request.get('category'), min_rating=min_rating)
+      self.buildSavedSearchesPage(notification='Search saved.')
+    elif action == 'delete':
+      search_id = self.request.get('search_id')
+      if not search_id:
+        return self.abort(400, 'search_id not given')
+      key = ndb.Key(models.SavedSearch, search_id)
+      # users may only delete their own searches
+      if key.id().startswith(user_id + ':'):
+        models.SavedSearch.deleteSearch(key)
+      self.buildSavedSearchesPage(notification='Search deleted.')
+    else:
+      self.buildSavedSearchesPage()
+
+  def buildSavedSearchesPage(self, notification=None):
+    searches = saved_searches.getUserSearches(self.user_context.user_id)
+    # fetch the matches of all the searches in parallel
+    futures = [
+        models.SavedSearchMatch.query(ancestor=s.key).order(
+            -models.SavedSearchMatch.date_matched).fetch_async(
+                self._MATCHES_PER_SEARCH)
+        for s in searches]
+    slist = []
+    for saved, future in zip(searches, futures):
+      params = {'query': (saved.query or '').encode('utf-8'),
+                'category': (saved.category or '').encode('utf-8'),
+                'rating': saved.min_rating or ''}
+      slist.append({
+          'search': saved,
+          'search_link': '/psearch?' + urllib.urlencode(params),
+          'matches': [
+              (m, '/product?' + urllib.urlencode(
+                  {'pid': m.pid, 'category': (m.category or '').encode('utf-8')}))
+              for m in future.get_result()]})
+    template_values = {'saved_searches': slist}
+    if notification:
+      template_values['notification'] = notification
+    self.render_template('saved_searches.html', template_values)
@@ -0,0 +1,559 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Background jobs that maintain the product index shards.
+
+The rebuild job builds a new index for each shard from the models.Product
+entities, e.g. after a change to the document schema, while the current
+indexes keep serving.  Each shard's models.IndexAlias first gets a pending
+index, which every document write then also goes to; once every instance
+has seen it, the entities are read in key order in chunks of
+search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST, one deferred task per chunk.  Each
+chunk chains the next one as soon as it has read its entities, so that the
+chunks are processed in parallel.  A chunk rebuilds its products' documents
+from their current documents, which are read with one range read per shard
+over the chunk's pids, and writes them to the pending indexes, one put per
+shard, skipping the products deleted meanwhile, and those whose document
+can't be rebuilt (e.g. a legacy document that no longer validates), which
+are logged and counted.  It then re-reads those documents, and redoes the
+ones written meanwhile, which the put may have overwritten with an older
+copy.  Each chunk's number is recorded once it is
+done, and when every chunk is done, all the aliases are switched to their
+new indexes in one transaction.  The old indexes are left in place.
+
+The reconciliation job, run from cron, checks that the models.Product
+entities and the product documents agree.  The pid key space is split into
+ranges (config.RECONCILE_SHARD_BOUNDARIES), checked in parallel, each from
+its own models.JobStatus checkpoint.  A chunk reads the next entities of its
+range, and the next doc ids of each index shard, in pid order, and diffs
+them with a sorted merge, up to the last pid both sides have been read to.
+It reports products without a document and documents in the wrong shard,
+and (if config.RECONCILE_REPAIR is set) deletes orphaned and duplicate
+documents and fixes stale doc ids.  Each cron run checks up to
+config.RECONCILE_CHUNKS_PER_RUN chunks per range; a range that has been
+checked to its end is started over on the next run.
+
+The re-partition job moves product documents to the index shard of their
+category (see docs.Product.getIndexName), after config.PRODUCT_INDEX_SHARDS
+has changed.  It works through each shard in doc id order, in chunks of
+config.RESHARD_BATCH_SIZE documents, one chained deferred task per chunk,
+checkpointed in a models.JobStatus entity.  A moved document is written to
+its new shard before it is deleted from the old one, so it stays searchable
+throughout.
+
+The backfill job fills in the user_id and name of the models.Product
+entities written before they were string properties (older entities have a
+numeric user_id, which reads as None, and no name), from the products'
+documents, so that they show up on the owner's listings dashboard.  It works
+through the entities in key order, one chained deferred task per chunk,
+checkpointed in a models.JobStatus entity.
+"""
+
+import collections
+import datetime
+import logging
+import time
+import uuid
+
+import config
+import docs
+import errors
+import models
+
+from google.appengine.api import search
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+
+RESHARD_JOB = 'reshard_products'
+REBUILD_JOB = 'rebuild_products'
+RECONCILE_JOB = 'reconcile_products'
+BACKFILL_JOB = 'backfill_products'
+_REBUILD_CHUNK_SIZE = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+# times a rebuild chunk re-reads its documents for concurrent writes
+_RECHECK_ROUNDS = 3
+# attempts at writing the rebuilt documents that failed to be written
+_PUT_ATTEMPTS = 3
+
+
+def reshardProducts(old_index_names=None):
+  """Start re-partitioning the product documents.  Shards that are no longer
+  configured can be given, to be emptied into the current ones."""
+  stages = docs.Product.getIndexNames() + [
+      name for name in old_index_names or []
+      if name not in docs.Product.getIndexNames()]
+  status = models.JobStatus.start(RESHARD_JOB, stages)
+  _deferChunk(_reshardChunk, status)
+
+
+def _deferChunk(func, status, *args):
+  # Naming the task after the run and chunk number ensures that a chunk
+  # retried after chaining its successor doesn't start a second chain.
+  try:
+    defer(func, status.run_id, *args,
+          _name='%s-%s-%d' % (status.key.id().replace('_', '-'),
+                              status.run_id, status.chunks))
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _reshardChunk(run_id):
+  """Move the documents of one chunk of the current shard that belong in
+  another shard, checkpoint the progress and chain the next chunk."""
+  status = models.JobStatus.getRun(RESHARD_JOB, run_id)
+  if not status:
+    return
+  index = search.Index(name=status.stage)
+  batch = index.get_range(
+      start_id=status.cursor, include_start_object=False,
+      limit=config.RESHARD_BATCH_SIZE)
+  moving = [
+      doc for doc in batch
+      if docs.Product.getIndexName(docs.Product(doc).getCategory())
+      != status.stage]
+  if moving:
+    if docs.Product.add(moving) is None:
+      # raising makes the task retry the chunk.
+      raise search.Error('could not add the moved documents')
+    index.delete([doc.doc_id for doc in moving])
+  cursor = None
+  if len(batch.results) == config.RESHARD_BATCH_SIZE:
+    cursor = batch.results[-1].doc_id
+  status.advance(len(moving), cursor)
+  status.put()
+  if status.done:
+    logging.info('re-partition done: %s', status.counts)
+  else:
+    _deferChunk(_reshardChunk, status)
+
+
+def startRebuild():
+  """Start rebuilding all the product index shards into new indexes.
+  Returns False if a rebuild is already running."""
+  run_id = uuid.uuid4().hex
+  suffix = '-v%d' % time.time()
+  shard_names = docs.Product.getShardNames()
+  new_names = dict((name, name + suffix) for name in shard_names)
+
+  @ndb.transactional(xg=True)
+  def _tx():
+    rebuild = models.IndexRebuild.get_by_id(REBUILD_JOB)
+    if rebuild and not rebuild.done:
+      return False
+    aliases = ndb.get_multi(
+        [ndb.Key(models.IndexAlias, name) for name in shard_names])
+    for name, alias in zip(shard_names, aliases):
+      if not alias:
+        alias = models.IndexAlias(id=name, index_name=name)
+      alias.pending_index_name = new_names[name]
+      alias.put()
+    models.IndexRebuild(
+        id=REBUILD_JOB, run_id=run_id, new_index_names=new_names).put()
+    return True
+
+  if not _tx():
+    logging.info('a rebuild is already running')
+    return False
+  # Start copying once every instance has reloaded the aliases, and so
+  # writes to the pending indexes too.
+  defer(_rebuildChunk, run_id, None, 0,
+        _countdown=2 * config.INDEX_ALIAS_CACHE_TIME)
+  return True
+
+
+def _rebuildChunk(run_id, cursor, chunk):
+  """Rebuild the documents of one chunk of product entities into the
+  pending indexes."""
+  rebuild = models.IndexRebuild.get_by_id(REBUILD_JOB)
+  if not rebuild or rebuild.run_id != run_id or rebuild.done:
+    return
+  products, next_cursor, more = models.Product.query().order(
+      models.Product.key).fetch_page(
+          _REBUILD_CHUNK_SIZE,
+          start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+  if more and next_cursor:
+    try:
+      defer(_rebuildChunk, run_id, next_cursor.urlsafe(), chunk + 1,
+            _name='%s-%s-%d' % (REBUILD_JOB.replace('_', '-'), run_id,
+                                chunk + 1))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass
+
+  current = _getCurrentDocs(products)
+  # re-read the entities just before the put, so that the products deleted
+  # since the query aren't brought back in the new indexes.
+  products = [prod for prod in ndb.get_multi([p.key for p in products])
+              if prod]
+  missing = len([prod for prod in products if prod.pid not in current])
+  written = [prod for prod in products if prod.pid in current]
+  failed = set(_putRebuiltDocs(rebuild, written, current))
+  written = [prod for prod in written if prod.pid not in failed]
+  # A document written while the chunk ran also went to the pending index,
+  # but may have been overwritten by the put above, from the older copy.
+  # Re-read the chunk's documents, and redo those that changed meanwhile.
+  for _ in range(_RECHECK_ROUNDS):
+    latest = _getCurrentDocs(written)
+    changed = [prod for prod in written
+               if _docState(latest.get(prod.pid)) !=
+               _docState(current[prod.pid])]
+    if not changed:
+      break
+    current.update(latest)
+    written = [prod for prod in ndb.get_multi([p.key for p in changed])
+               if prod and prod.pid in latest]
+    gone = set(p.pid for p in changed) - set(p.pid for p in written)
+    for prod in changed:
+      if prod.pid in gone:  # deleted meanwhile
+        shard_name = docs.Product.getShardName(prod.category)
+        search.Index(name=rebuild.new_index_names[shard_name]).delete(
+            [prod.pid])
+    failed.update(_putRebuiltDocs(rebuild, written, current))
+    written = [prod for prod in written if prod.pid not in failed]
+  else:
+    logging.warning('chunk %s: documents still changing after %s rechecks',
+                    chunk, _RECHECK_ROUNDS)
+  _finishChunk(run_id, chunk, None if more else chunk + 1,
+               len(products) - missing - len(failed), missing, len(failed))
+
+
+def _putRebuiltDocs(rebuild, products, current):
+  """Rebuild the given products' documents from their current documents,
+  and put them to the pending indexes, one put per shard.  Return the pids
+  of the products whose document could not be rebuilt or written; they are
+  skipped, so that one bad document doesn't hold up the rebuild."""
+  failed = []
+  by_index = collections.defaultdict(list)
+  for prod in products:
+    try:
+      new_doc = docs.Product.rebuildDocument(current[prod.pid], prod)
+    except (errors.Error, ValueError, TypeError):
+      # e.g. a legacy document with a bad image url or an over-long field
+      logging.exception('could not rebuild the document of product %s',
+                        prod.pid)
+      failed.append(prod.pid)
+      continue
+    shard_name = docs.Product.getShardName(prod.category)
+    by_index[rebuild.new_index_names[shard_name]].append(new_doc)
+  for name, index_docs in by_index.iteritems():
+    failed.extend(_putDocs(search.Index(name=name), index_docs))
+  return failed
+
+
+def _putDocs(index, index_docs):
+  """Put the given documents to the given index, retrying those that fail
+  up to _PUT_ATTEMPTS times in all.  Return the ids of the documents that
+  could not be written."""
+  for _ in range(_PUT_ATTEMPTS):
+    try:
+      index.put(index_docs)
+      return []
+    except search.PutError as e:
+      index_docs = [
+          doc for doc, result in zip(index_docs, e.results)
+          if result.code != search.OperationResult.OK]
+      logging.warning('could not write %s documents to %s: %s',
+                      len(index_docs), index.name, e)
+  return [doc.doc_id for doc in index_docs]
+
+
+def _docState(doc):
+  """Return what is compared of a document to tell whether it was rewritten,
+  or None if there is no document."""
+  if doc is None:
+    return None
+  return doc.rank, [(f.name, f.value) for f in doc.fields]
+
+
+def _getCurrentDocs(products):
+  """Return a dict of the current documents of the given products, which are
+  in pid order, by pid.  They are read with one range read per shard over the
+  products' pids, so documents of other pids in the range are skipped."""
+  if not products:
+    return {}
+  pids = set(prod.pid for prod in products)
+  first, last = products[0].pid, products[-1].pid
+  found = {}
+  for index in docs.Product.getIndexes():
+    start_id, include_start = first, True
+    while True:
+      batch = index.get_range(
+          start_id=start_id, include_start_object=include_start,
+          limit=_REBUILD_CHUNK_SIZE).results
+      for doc in batch:
+        if doc.doc_id > last:
+          break
+        if doc.doc_id in pids:
+          found[doc.doc_id] = doc
+      if len(batch) < _REBUILD_CHUNK_SIZE or batch[-1].doc_id >= last:
+        break
+      start_id, include_start = batch[-1].doc_id, False
+  return found
+
+
+def _finishChunk(run_id, chunk, chunks_total, documents, missing, failed):
+  """Record a finished chunk, and swap the aliases if it was the last one to
+  finish."""
+
+  @ndb.transactional
+  def _tx():
+    rebuild = models.IndexRebuild.get_by_id(REBUILD_JOB)
+    if not rebuild or rebuild.run_id != run_id or rebuild.done:
+      return None
+    if chunk in rebuild.chunks_done:  # a retried chunk
+      return rebuild
+    rebuild.chunks_done.append(chunk)
+    rebuild.documents += documents
+    rebuild.missing += missing
+    rebuild.failed += failed
+    if chunks_total is not None:
+      rebuild.chunks_total = chunks_total
+    rebuild.put()
+    return rebuild
+
+  rebuild = _tx()
+  if (rebuild and rebuild.chunks_total is not None
+      and len(rebuild.chunks_done) >= rebuild.chunks_total):
+    _swapAliases(run_id)
+
+
+def _swapAliases(run_id):
+  """Make the rebuilt indexes the active indexes of their shards, all in one
+  transaction."""
+  shard_names = docs.Product.getShardNames()
+
+  @ndb.transactional(xg=True)
+  def _tx():
+    rebuild = models.IndexRebuild.get_by_id(REBUILD_JOB)
+    if not rebuild or rebuild.run_id != run_id or rebuild.done:
+      return None
+    aliases = [alias for alias in ndb.get_multi(
+        [ndb.Key(models.IndexAlias, name) for name in shard_names]) if alias]
+    for alias in aliases:
+      alias.index_name = rebuild.new_index_names[alias.key.id()]
+      alias.pending_index_name = None
+    rebuild.done = True
+    ndb.put_multi(aliases + [rebuild])
+    return rebuild
+
+  rebuild = _tx()
+  if rebuild:
+    logging.info('index rebuild done: %s documents, %s products without one, '
+                 '%s failed', rebuild.documents, rebuild.missing,
+                 rebuild.failed)
+
+
+def backfillProducts():
+  """Start filling in the missing user ids and names of the product
+  entities."""
+  status = models.JobStatus.start(BACKFILL_JOB, ['products'])
+  _deferChunk(_backfillChunk, status)
+
+
+def _backfillChunk(run_id):
+  """Fill in the missing user ids and names of one chunk of product
+  entities from their documents, checkpoint the progress and chain the next
+  chunk."""
+  status = models.JobStatus.getRun(BACKFILL_JOB, run_id)
+  if not status:
+    return
+  products, next_cursor, more = models.Product.query().order(
+      models.Product.key).fetch_page(
+          _REBUILD_CHUNK_SIZE,
+          start_cursor=Cursor(urlsafe=status.cursor) if status.cursor else None)
+  incomplete = [prod for prod in products if not prod.user_id or not prod.name]
+  current = _getCurrentDocs(incomplete)
+
+  @ndb.transactional_tasklet
+  def _tx(pid, user_id, name):
+    prod = yield models.Product.get_by_id_async(pid)
+    if prod and (not prod.user_id or not prod.name):
+      prod.user_id = prod.user_id or user_id
+      prod.name = prod.name or name
+      yield prod.put_async()
+
+  futures = []
+  for prod in incomplete:
+    doc = current.get(prod.pid)
+    if not doc:
+      continue  # left to the reconciliation job
+    pdoc = docs.Product(doc)
+    futures.append(_tx(prod.pid, pdoc.getUserId(), pdoc.getName()))
+  for future in futures:
+    future.check_success()
+  status.advance(len(futures),
+                 next_cursor.urlsafe() if more and next_cursor else None)
+  status.put()
+  if status.done:
+    logging.info('product backfill done: %s', status.counts)
+  else:
+    _deferChunk(_backfillChunk, status)
+
+
+def getReconcileRanges():
+  """Return the (start, end) pid ranges checked in parallel by the
+  reconciliation job; None stands for the start or end of the key space."""
+  bounds = config.RECONCILE_SHARD_BOUNDARIES
+  return zip([None] + bounds, bounds + [None])
+
+
+def getReconcileStatuses():
+  return ndb.get_multi(
+      [ndb.Key(models.JobStatus, '%s-%d' % (RECONCILE_JOB, i))
+       for i in range(len(getReconcileRanges()))])
+
+
+def startReconciliation():
+  """Continue checking each pid range from its checkpoint, or from its start
+  if it was checked to its end.  Run from cron."""
+  for i in range(len(getReconcileRanges())):
+    name = '%s-%d' % (RECONCILE_JOB, i)
+    status = models.JobStatus.get_by_id(name)
+    if not status or status.done:
+      status = models.JobStatus.start(name, ['checked'])
+    # if the range's chain from the previous run is still going, this task
+    # name is taken, and no second chain is started.
+    _deferChunk(_reconcileChunk, status, i, 0)
+
+
+def _reconcileChunk(run_id, range_num, chunk):
+  """Diff one chunk of the given pid range, repair or report the drift,
+  checkpoint the progress and chain the next chunk."""
+  status = models.JobStatus.getRun('%s-%d' % (RECONCILE_JOB, range_num), run_id)
+  if not status:
+    return
+  start, end = getReconcileRanges()[range_num]
+  after = status.cursor  # the last pid checked, if any
+  batch_size = config.RECONCILE_BATCH_SIZE
+
+  # the next entities of the range, in pid order
+  query = models.Product.query()
+  if after or start:
+    key = ndb.Key(models.Product, after or start)
+    query = query.filter(
+        models.Product.key > key if after else models.Product.key >= key)
+  if end:
+    query = query.filter(models.Product.key < ndb.Key(models.Product, end))
+  products = query.order(models.Product.key).fetch(batch_size)
+  # Everything up to 'last' has been read from both sides, if the reads
+  # were full; None stands for the end of the range.
+  last = products[-1].pid if len(products) == batch_size else None
+
+  # the next doc ids of the range in each index shard, in pid order
+  doc_ids = []
+  for index in docs.Product.getIndexes():
+    ids = [doc.doc_id for doc in index.get_range(
+        start_id=after or start, include_start_object=not after,
+        ids_only=True, limit=batch_size)]
+    in_range = [doc_id for doc_id in ids if not end or doc_id < end]
+    if len(in_range) == batch_size and (last is None or in_range[-1] < last):
+      last = in_range[-1]
+    doc_ids.append((index.name, in_range))
+
+  def _upToLast(pid):
+    return last is None or pid <= last
+
+  products = [prod for prod in products if _upToLast(prod.pid)]
+  doc_indexes = collections.defaultdict(list)
+  for index_name, ids in doc_ids:
+    for doc_id in ids:
+      if _upToLast(doc_id):
+        doc_indexes[doc_id].append(index_name)
+  counts = _diff(products, sorted(doc_indexes), doc_indexes)
+
+  for key, n in counts.iteritems():
+    status.counts[key] = status.counts.get(key, 0) + n
+  status.advance(len(products), last)
+  status.put()
+  if status.done:
+    logging.info('reconciliation of range %s done: %s', range_num,
+                 status.counts)
+  elif chunk + 1 < config.RECONCILE_CHUNKS_PER_RUN:
+    _deferChunk(_reconcileChunk, status, range_num, chunk + 1)
+
+
+def _diff(products, doc_ids, doc_indexes):
+  """Merge the sorted products and doc ids, and repair or report the
+  differences.  Return the counts of each kind of drift."""
+  counts = collections.defaultdict(int)
+  repair = config.RECONCILE_REPAIR
+  to_fix = []  # keys of the products with a stale doc id
+  to_delete = collections.defaultdict(list)  # doc ids, by index name
+  orphans = []  # (doc id, index name)
+  i = j = 0
+  while i < len(products) or j < len(doc_ids):
+    pid = products[i].pid if i < len(products) else None
+    doc_id = doc_ids[j] if j < len(doc_ids) else None
+    if doc_id is None or (pid is not None and pid < doc_id):
+      logging.warn('product %s has no document', pid)
+      counts['missing_docs'] += 1
+      i += 1
+    elif pid is None or doc_id < pid:
+      orphans.extend((doc_id, name) for name in doc_indexes[doc_id])
+      j += 1
+    else:  # both
+      prod = products[i]
+      expected = docs.Product.getIndexName(prod.category)
+      indexes = doc_indexes[doc_id]
+      if expected not in indexes:
+        logging.warn('document %s is not in shard %s; run the re-partition '
+                     'job', pid, expected)
+        counts['misplaced_docs'] += 1
+      elif len(indexes) > 1:
+        counts['duplicate_docs'] += 1
+        for name in indexes:
+          if name != expected:
+            to_delete[name].append(doc_id)
+      if prod.doc_id != pid:
+        counts['stale_doc_ids'] += 1
+        to_fix.append(prod.key)
+      i += 1
+      j += 1
+
+  # Documents are indexed before their product entity is written, so only
+  # orphans that haven't been modified lately are deleted.
+  cutoff = datetime.date.today() - datetime.timedelta(
+      days=config.RECONCILE_ORPHAN_MIN_AGE_DAYS)
+  for doc_id, name in orphans:
+    doc = docs.Product.getDocFromIndex(search.Index(name=name), doc_id)
+    updated = doc and docs.Product(doc).getFieldVal(docs.Product.UPDATED)
+    if isinstance(updated, datetime.datetime):
+      updated = updated.date()
+    if doc and (not updated or updated < cutoff):
+      logging.warn('document %s in %s has no product', doc_id, name)
+      counts['orphaned_docs'] += 1
+      to_delete[name].append(doc_id)
+
+  if repair:
+    futures = [_fixDocId(key) for key in to_fix]
+    for future in futures:
+      future.check_success()
+    for name, ids in to_delete.iteritems():
+      search.Index(name=name).delete(ids)
+    counts['repaired'] += len(to_fix) + sum(
+        len(ids) for ids in to_delete.itervalues())
+  return counts
+
+
+@ndb.transactional_tasklet
+def _fixDocId(key):
+  """Set the doc id of the given product to its pid, re-reading it so that
+  the product's other changes since the diff are kept."""
+  prod = yield key.get_async()
+  if prod and prod.doc_id != prod.pid:
+    prod.doc_id = prod.pid
+    yield prod.put_async()
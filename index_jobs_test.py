@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the index rebuild job.  Run with the App Engine SDK on the
+python path, e.g.: python -m unittest index_jobs_test
+"""
+
+import unittest
+
+import docs
+import index_jobs
+import models
+
+from google.appengine.api import search
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+
+class RebuildTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_search_stub()
+    self.testbed.init_taskqueue_stub()
+    ndb.get_context().clear_cache()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _addProduct(self, pid, image_url):
+    """Add a product entity, and a document for it as written by an older
+    version of the app, with the given image url."""
+    models.Product(id=pid, doc_id=pid, user_id='u1', name='Book ' + pid,
+                   category='Books', price=10.0).put()
+    doc = search.Document(doc_id=pid, fields=[
+        search.TextField(name=docs.Product.PID, value=pid),
+        search.TextField(name=docs.Product.PRODUCT_NAME, value='Book ' + pid),
+        search.AtomField(name=docs.Product.CATEGORY, value='Books'),
+        search.TextField(name=docs.Product.USER_ID, value='u1'),
+        search.NumberField(name=docs.Product.PRICE, value=10.0),
+        search.TextField(name=docs.Product.DESCRIPTION, value='A book.'),
+        search.TextField(name=docs.Product.IMAGE_URL, value=image_url)])
+    search.Index(name=docs.Product.getIndexName('Books')).put(doc)
+
+  def testMalformedLegacyDocumentIsSkipped(self):
+    self._addProduct('good', 'http://example.com/good.jpg')
+    self._addProduct('legacy', 'ftp://example.com/legacy.jpg')
+    new_names = dict((name, name + '-new')
+                     for name in docs.Product.getShardNames())
+    models.IndexRebuild(id=index_jobs.REBUILD_JOB, run_id='run',
+                        new_index_names=new_names).put()
+
+    index_jobs._rebuildChunk('run', None, 0)
+
+    rebuild = models.IndexRebuild.get_by_id(index_jobs.REBUILD_JOB)
+    self.assertEqual(1, rebuild.documents)
+    self.assertEqual(1, rebuild.failed)
+    self.assertEqual([0], rebuild.chunks_done)
+    self.assertTrue(rebuild.done)
+    new_index = search.Index(
+        name=new_names[docs.Product.getShardName('Books')])
+    self.assertTrue(docs.Product.getDocFromIndex(new_index, 'good'))
+    self.assertFalse(docs.Product.getDocFromIndex(new_index, 'legacy'))
+
+
+if __name__ == '__main__':
+  unittest.main()
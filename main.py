@@ -15,20 +15,24 @@
 # limitations under the License.
 
 """Defines the routing for the app's non-admin handlers.
+
+Handlers are given by name, so that webapp2 imports their modules only when
+a request is first routed to them; this keeps instance startup lean.  See
+warmup.py for the preloading done before an instance takes user traffic.
 """
 
 
-from handlers import *
 import webapp2
 
 application = webapp2.WSGIApplication(
-    [('/', IndexHandler),
-     ('/psearch', ProductSearchHandler),
-     ('/product', ShowProductHandler),
-     ('/reviews', ShowReviewsHandler),
-     ('/create_review', CreateReviewHandler),
-     ('/order', OrderHandler)
+    [('/', 'handlers.IndexHandler'),
+     ('/psearch', 'handlers.ProductSearchHandler'),
+     ('/product', 'handlers.ShowProductHandler'),
+     ('/reviews', 'handlers.ShowReviewsHandler'),
+     ('/create_review', 'handlers.CreateReviewHandler'),
+     ('/order', 'handlers.OrderHandler'),
+     ('/saved_searches', 'handlers.SavedSearchesHandler'),
+     ('/image', 'handlers.ProductImageHandler'),
+     ('/_ah/warmup', 'warmup.WarmupHandler')
     ],
     debug=True)
-
-
@@ -16,10 +16,16 @@
 
 """ Contains the Datastore model classes used by the app"""
 
+import datetime
+import json
 import logging
+import random
+import string
+import uuid
+import zlib
 
 import categories
-import docs
+import config
 
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
@@ -100,7 +106,8 @@ class Product(ndb.Model):
   """Model for Product data."""
 
   doc_id = ndb.StringProperty()  # the id of the associated product
-  user_id = ndb.IntegerProperty()
+  user_id = ndb.StringProperty()  # the id of the posting user
+  name = ndb.StringProperty()
   location = ndb.StringProperty()
   price = ndb.FloatProperty()
   ppacc = ndb.StringProperty()
@@ -132,6 +139,7 @@ class Product(ndb.Model):
   @classmethod
   def updateProdDocsWithNewRating(cls, pkeys):
     """ Add new rating to a document"""
+    import docs  # docs imports this module; import on first use.
 
     doclist = []
 
@@ -142,7 +150,7 @@ class Product(ndb.Model):
         # update the associated document with the new ratings info
         # and reindex
         modified_doc = docs.Product.updateRatingInDoc(
-            prod.doc_id, prod.avg_rating)
+            prod.doc_id, prod.avg_rating, prod.category)
         if modified_doc:
           doclist.append(modified_doc)
         prod.needs_review_reindex = False
@@ -157,7 +165,8 @@ class Product(ndb.Model):
     """Create a new product """
     prod = cls(
         id=params['pid'], price=params['price'],
-        category=params['category'], doc_id=doc_id)
+        category=params['category'], doc_id=doc_id,
+        user_id=params['user_id'], name=params['name'])
     prod.put()
     return prod
 
@@ -165,13 +174,28 @@ class Product(ndb.Model):
     """Update 'core' values from the given params dict and doc_id."""
     self.populate(
         price=params['price'], category=params['category'],
-        doc_id=doc_id)
+        doc_id=doc_id, user_id=params['user_id'], name=params['name'])
+
+  # the properties returned by the owner dashboard's projection query
+  _DASHBOARD_PROJECTION = ('name', 'category', 'price', 'avg_rating',
+                           'num_reviews')
+
+  @classmethod
+  def getOwnerPage(cls, user_id, page_size, cursor=None):
+    """Return a page of the given user's products, as a (products, cursor,
+    more) tuple.  The products are projections holding only the properties
+    shown on the listings dashboard, served from the composite index on
+    user_id and those properties (see index.yaml)."""
+    return cls.query(cls.user_id == user_id).fetch_page(
+        page_size, start_cursor=cursor,
+        projection=cls._DASHBOARD_PROJECTION)
 
   @classmethod
   def updateProdDocWithNewRating(cls, pid):
     """Given the id of a product entity, see if it is marked as needing
     a document re-index.  This flag is set when a new review is created for
     that product.  If it needs a re-index, call the document method."""
+    import docs  # docs imports this module; import on first use.
 
     def _tx():
       prod = cls.get_by_id(pid)
@@ -184,6 +208,67 @@ class Product(ndb.Model):
     # and reindex
     docs.Product.updateRatingsInfo(doc_id, avg_rating)
 
+class ProductImage(ndb.Model):
+  """An uploaded product image, or one of its resized variants (see
+  product_images.py).  Keyed by '<pid>:<variant>'."""
+
+  data = ndb.BlobProperty()
+  content_type = ndb.StringProperty(indexed=False)
+  digest = ndb.StringProperty(indexed=False)
+  width = ndb.IntegerProperty(indexed=False)
+  height = ndb.IntegerProperty(indexed=False)
+
+
+class ProductViewShard(ndb.Model):
+  """One shard of a product's view counter, keyed by '<pid>:<shard number>'.
+  The counts are written in batches by view_counts.flushViewCounts."""
+
+  count = ndb.IntegerProperty(default=0, indexed=False)
+
+  @classmethod
+  def _shardKeys(cls, pid):
+    return [ndb.Key(cls, '%s:%d' % (pid, i))
+            for i in range(config.VIEW_COUNTER_SHARDS)]
+
+  @classmethod
+  def addCounts(cls, counts):
+    """Add the given {pid: views} counts, each to a random shard of its
+    product's counter.  The shard transactions are run in parallel.  Return
+    the counts whose transaction failed, which were not added."""
+
+    @ndb.tasklet
+    def _tx(key, n):
+      shard = yield key.get_async()
+      if not shard:
+        shard = cls(key=key)
+      shard.count += n
+      yield shard.put_async()
+
+    futures = []
+    for pid, n in counts.iteritems():
+      key = random.choice(cls._shardKeys(pid))
+      futures.append(
+          (pid, ndb.transaction_async(lambda key=key, n=n: _tx(key, n))))
+    failed = {}
+    for pid, future in futures:
+      try:
+        future.check_success()
+      except Exception:
+        logging.exception('could not add the views of product %s', pid)
+        failed[pid] = counts[pid]
+    return failed
+
+  @classmethod
+  def getTotals(cls, pids):
+    """Return a dict of the total view count of each of the given pids."""
+    keys = [key for pid in pids for key in cls._shardKeys(pid)]
+    totals = dict((pid, 0) for pid in pids)
+    for shard in ndb.get_multi(keys):
+      if shard:
+        totals[shard.key.id().rsplit(':', 1)[0]] += shard.count
+    return totals
+
+
 class Review(ndb.Model):
   """Model for Review data. Associated with a product entity via the product
   key."""
@@ -207,17 +292,151 @@ class Review(ndb.Model):
     return ndb.delete_multi(reviews)
 
 class UserInfo(ndb.Model):
+  """A user's profile.  Profiles are read on most pages but rarely change, so
+  reads go through getCached/getCachedMulti, which check a per-request memo
+  dict, then memcache, then the datastore.  Every put writes the new profile
+  through to memcache.  ndb's own memcache caching is turned off for this
+  model, since it would duplicate the cache."""
   # Keyed by user_id
   nickname = ndb.StringProperty()
   email = ndb.StringProperty()
   phoneNumber = ndb.StringProperty()
   meetPoint = ndb.StringProperty()
 
+  _use_memcache = False
+
+  # Bump this when the model's properties change, to stop reading profiles
+  # cached in the old format.
+  _CACHE_VERSION = 1
+  _CACHE_TIME = 24 * 60 * 60
+  _NO_PROFILE = 0  # cached for users without a profile
+  # how long a deleted profile's cache key can't be added to, so that a
+  # profile read before the delete is not cached again.
+  _DELETE_LOCK_TIME = 10
+
+  @classmethod
+  def _cacheKey(cls, user_id):
+    return 'userinfo:%d:%s' % (cls._CACHE_VERSION, user_id)
+
+  @classmethod
+  def getCached(cls, user_id, memo=None):
+    """Return the profile of the given user id, or None."""
+    if not user_id:
+      return None
+    return cls.getCachedMulti([user_id], memo=memo)[user_id]
+
+  @classmethod
+  def getCachedMulti(cls, user_ids, memo=None):
+    """Return a dict mapping each of the given user ids to its profile, or to
+    None.  Profiles found are added to the memo dict, if given."""
+    if memo is None:
+      memo = {}
+    missing = [uid for uid in set(user_ids) if uid and uid not in memo]
+    if missing:
+      cached = memcache.get_multi([cls._cacheKey(uid) for uid in missing])
+      to_fetch = []
+      for uid in missing:
+        value = cached.get(cls._cacheKey(uid))
+        if value is None:
+          to_fetch.append(uid)
+        elif value == cls._NO_PROFILE:
+          memo[uid] = None
+        else:
+          memo[uid] = cls(id=uid, **value)
+      if to_fetch:
+        fetched = ndb.get_multi([ndb.Key(cls, uid) for uid in to_fetch])
+        to_cache = {}
+        for uid, userinfo in zip(to_fetch, fetched):
+          memo[uid] = userinfo
+          to_cache[cls._cacheKey(uid)] = (
+              userinfo.to_dict() if userinfo else cls._NO_PROFILE)
+        # add, rather than set, so that a profile written through by a put
+        # since it was read is not replaced by the older one.
+        memcache.add_multi(to_cache, time=cls._CACHE_TIME)
+    return dict((uid, memo.get(uid)) for uid in user_ids)
+
+  def _post_put_hook(self, future):
+    if future.get_exception() is None:
+      memcache.set(self._cacheKey(self.key.id()), self.to_dict(),
+                   time=self._CACHE_TIME)
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    memcache.delete(cls._cacheKey(key.id()), seconds=cls._DELETE_LOCK_TIME)
+
+
+class SavedSearch(ndb.Model):
+  """A product search saved by a user.  New and updated product documents are
+  matched against all saved searches as they are indexed (see
+  saved_searches.py), so that users don't need to re-run the search to find
+  new listings.  Keyed by the user id and a hash of the normalized search, so
+  that saving the same search twice is a no-op."""
+
+  user_id = ndb.StringProperty()
+  query = ndb.StringProperty(indexed=False)  # the query as the user typed it
+  terms = ndb.StringProperty(repeated=True, indexed=False)  # normalized terms
+  category = ndb.StringProperty(indexed=False)
+  # the rating filter of the search, as in /psearch: matches ratings in
+  # [min_rating, min_rating + 1)
+  min_rating = ndb.IntegerProperty(default=0, indexed=False)
+  date_added = ndb.DateTimeProperty(auto_now_add=True)
+
+  @classmethod
+  def deleteSearch(cls, key):
+    """Deletes a saved search and its matches."""
+    match_keys = SavedSearchMatch.query(ancestor=key).fetch(keys_only=True)
+    ndb.delete_multi(match_keys + [key])
+
+
+class SavedSearchMatch(ndb.Model):
+  """A product that matched a saved search.  Child of the SavedSearch entity,
+  keyed by the product id."""
+
+  pname = ndb.StringProperty(indexed=False)
+  category = ndb.StringProperty(indexed=False)
+  date_matched = ndb.DateTimeProperty(auto_now=True)
+
+  @property
+  def pid(self):
+    return self.key.id()
+
+
+class BookedInterval(ndb.Model):
+  """A reserved [start, end) date interval of a product; the end date is the
+  return date, on which the product can be picked up again."""
+
+  start = ndb.DateProperty()
+  end = ndb.DateProperty()
+  t_id = ndb.StringProperty()  # the id of the booking's Transaction
+
+
+class ProductBookings(ndb.Model):
+  """The reserved date intervals of a product, keyed by the pid.  This is the
+  root of the entity group of the product's Transactions, so that a booking
+  can check availability, reserve its dates and record its Transaction in one
+  transaction (see bookings.py)."""
+
+  intervals = ndb.LocalStructuredProperty(BookedInterval, repeated=True)
+
+  def overlaps(self, start, end):
+    """Whether [start, end) overlaps any reserved interval."""
+    return any(i.start < end and start < i.end for i in self.intervals)
+
+  def pruneBefore(self, day):
+    """Drop the intervals that ended before the given date."""
+    self.intervals = [i for i in self.intervals if i.end >= day]
+
+  def release(self, t_id):
+    """Drop the interval reserved by the given Transaction id."""
+    self.intervals = [i for i in self.intervals if i.t_id != t_id]
+
 
 class Transaction(ndb.Model):
-    # Keyed by user_id
+    # Booking transactions are children of the product's ProductBookings
+    # entity, keyed by '<rentee user id>:<client idempotency token>'.
     t_id = ndb.StringProperty()  # Transaction ID
     doc_id = ndb.StringProperty()
+    product_id = ndb.StringProperty()
     product = ndb.StringProperty()
     rentee_id = ndb.StringProperty()
     renter_id = ndb.StringProperty()
@@ -239,6 +458,161 @@ class Transaction(ndb.Model):
 
     @classmethod
     def deleteTransactions(cls):
-        logging.info("deleteCat()")
-        cats = cls.query().fetch()
-        [c.key.delete() for c in cats]
+        logging.info("deleteTransactions()")
+        ndb.delete_multi(cls.query().fetch(keys_only=True))
+
+    def toArchiveDict(self):
+        """The fields kept when a completed transaction is archived."""
+        return {
+            't_id': self.t_id,
+            'product_id': self.product_id,
+            'product': self.product,
+            'rentee_id': self.rentee_id,
+            'renter_id': self.renter_id,
+            'amount_paid': self.amount_paid,
+            'pickupD': self.pickupD and self.pickupD.isoformat(),
+            'returnD': self.returnD and self.returnD.isoformat(),
+            'dateSent': self.dateSent and self.dateSent.isoformat(),
+            'payment_status': self.payment_status
+        }
+
+
+class TransactionArchive(ndb.Model):
+  """A batch of a user's completed transactions, moved out of the Transaction
+  kind by transaction_jobs.archiveCompleted and stored as zlib-compressed
+  JSON."""
+
+  user_id = ndb.StringProperty()
+  date_archived = ndb.DateTimeProperty(auto_now_add=True)
+  count = ndb.IntegerProperty(indexed=False)
+  data = ndb.BlobProperty()
+
+  @classmethod
+  def create(cls, user_id, transactions):
+    records = [t.toArchiveDict() for t in transactions]
+    return cls(user_id=user_id, count=len(records),
+               data=zlib.compress(json.dumps(records, separators=(',', ':'))))
+
+  def getTransactions(self):
+    """Return the archived transactions, as dicts."""
+    return json.loads(zlib.decompress(self.data))
+
+
+class JobStatus(ndb.Model):
+  """The checkpoint and progress of a chunked background job, keyed by the
+  job's name.  A job works through its stages in order; each chunk records
+  how many items it processed, and the cursor to resume the stage from, so
+  that the job can be resumed where it stopped.  The run id identifies the
+  current run, so that chunks of an earlier run can tell they are stale."""
+
+  run_id = ndb.StringProperty(indexed=False)
+  stages = ndb.StringProperty(repeated=True, indexed=False)
+  stage = ndb.StringProperty(indexed=False)
+  cursor = ndb.StringProperty(indexed=False)
+  counts = ndb.JsonProperty()  # items processed, by stage
+  chunks = ndb.IntegerProperty(default=0, indexed=False)
+  done = ndb.BooleanProperty(default=False, indexed=False)
+  started = ndb.DateTimeProperty(indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+  @classmethod
+  def start(cls, name, stages):
+    """Start a new run of the named job, replacing any earlier run."""
+    status = cls(id=name, run_id=uuid.uuid4().hex, stages=stages,
+                 stage=stages[0], counts={}, started=datetime.datetime.now())
+    status.put()
+    return status
+
+  @classmethod
+  def getRun(cls, name, run_id):
+    """Return the status of the given run of the job, or None if it is
+    finished or has been replaced by another run."""
+    status = cls.get_by_id(name)
+    if status and status.run_id == run_id and not status.done:
+      return status
+    return None
+
+  def advance(self, count, cursor=None):
+    """Record a processed chunk of the current stage.  If a cursor is given,
+    the stage continues from it; otherwise the job moves to the next stage,
+    or is done."""
+    self.counts[self.stage] = self.counts.get(self.stage, 0) + count
+    self.chunks += 1
+    self.cursor = cursor
+    if cursor is None:
+      i = self.stages.index(self.stage)
+      if i + 1 < len(self.stages):
+        self.stage = self.stages[i + 1]
+      else:
+        self.done = True
+
+
+class SearchVocabulary(ndb.Model):
+  """A shard of the vocabulary used to correct misspelled search queries
+  (see query_rewrite.py): the normalized terms of the indexed product names
+  and category fields.  The terms are sharded by their first character, so
+  that concurrent additions of terms mostly write different entities, and so
+  that no entity holds the whole vocabulary.  Each shard holds its terms as
+  compressed newline-separated text.  Terms whose displayed form differs from
+  their normalized form (e.g. accented words) are stored as
+  'normalized\\tform'.  Keyed by 'vocabulary:<shard>'."""
+
+  _SHARDS = string.ascii_lowercase + string.digits + '_'
+
+  terms = ndb.TextProperty(compressed=True)
+  version = ndb.IntegerProperty(default=0, indexed=False)
+
+  @classmethod
+  def shardKey(cls, term):
+    """Return the key of the shard holding the given normalized term."""
+    shard = term[:1] if term[:1] and term[:1] in cls._SHARDS else '_'
+    return ndb.Key(cls, 'vocabulary:' + shard)
+
+  @classmethod
+  def getShards(cls):
+    """Return the existing shards of the vocabulary."""
+    return [s for s in ndb.get_multi(
+        [ndb.Key(cls, 'vocabulary:' + shard) for shard in cls._SHARDS]) if s]
+
+  def getTerms(self):
+    """Return a dict of the vocabulary terms, mapping each normalized term to
+    its displayed form."""
+    terms = {}
+    for line in (self.terms or u'').splitlines():
+      normalized, _, form = line.partition(u'\t')
+      terms[normalized] = form or normalized
+    return terms
+
+  def setTerms(self, terms):
+    self.terms = u'\n'.join(
+        n if n == form else u'%s\t%s' % (n, form)
+        for n, form in sorted(terms.iteritems()))
+
+
+class IndexAlias(ndb.Model):
+  """Maps a product index shard's name (its alias) to the search index that
+  currently serves it.  While the shard is being rebuilt (see
+  index_jobs.startRebuild), documents are also written to the pending index,
+  which replaces the active one when the rebuild is done."""
+
+  index_name = ndb.StringProperty(indexed=False)
+  pending_index_name = ndb.StringProperty(indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class IndexRebuild(ndb.Model):
+  """The progress of a rebuild of the product index shards, keyed by the
+  job's name.  Chunks run in parallel, so the number of chunks is only known
+  once the last one has been reached; the rebuild is done when that many
+  distinct chunks have finished."""
+
+  run_id = ndb.StringProperty(indexed=False)
+  new_index_names = ndb.JsonProperty()  # by alias
+  chunks_total = ndb.IntegerProperty(indexed=False)
+  chunks_done = ndb.IntegerProperty(repeated=True, indexed=False)  # chunk numbers
+  documents = ndb.IntegerProperty(default=0, indexed=False)
+  missing = ndb.IntegerProperty(default=0, indexed=False)
+  failed = ndb.IntegerProperty(default=0, indexed=False)  # skipped documents
+  done = ndb.BooleanProperty(default=False, indexed=False)
+  started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
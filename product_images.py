@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stores uploaded product images and their resized variants.
+
+When a product is created with an uploaded image, the image is validated and
+stored, and fixed-size variants are generated with PIL: a small thumbnail,
+shown in search result rows, and a larger display version for the product
+page.  They are stored as models.ProductImage entities and served by
+handlers.ProductImageHandler.  Image URLs include a digest of the image, so
+that they can be cached by clients and the edge cache indefinitely; a URL
+whose digest is not the stored image's is not served.
+
+The images are stored in the datastore rather than in Cloud Storage or the
+Blobstore, since the app depends on neither the Cloud Storage client library
+nor the Blobstore upload flow, and product images are small.  The price is
+the datastore's 1MB entity limit: uploads are limited to MAX_UPLOAD_BYTES,
+and every stored variant is checked against MAX_STORED_BYTES.
+"""
+
+import hashlib
+import StringIO
+import urllib
+import urlparse
+
+import errors
+import models
+
+from google.appengine.ext import ndb
+
+
+ORIGINAL = 'original'
+THUMBNAIL = 'thumb'
+DISPLAY = 'display'
+# the bounding box sizes of the generated variants
+VARIANT_SIZES = {THUMBNAIL: (200, 200), DISPLAY: (640, 640)}
+
+# Entities are limited to 1MB, so larger uploads are refused, and no stored
+# image data may be larger than MAX_STORED_BYTES (which leaves room for the
+# entity's other properties).
+MAX_UPLOAD_BYTES = 900 * 1024
+MAX_STORED_BYTES = 1000 * 1024
+_CONTENT_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png',
+                  'GIF': 'image/gif'}
+_JPEG_QUALITY = 85
+
+
+def isValidImageUrl(url):
+  """Whether the given image url is empty, a stored image url, or an absolute
+  http(s) url."""
+  if not url:
+    return True
+  parsed = urlparse.urlparse(url)
+  if not parsed.scheme and parsed.path == '/image':
+    return True
+  return parsed.scheme in ('http', 'https') and bool(parsed.netloc)
+
+
+def imageUrl(pid, variant, digest):
+  return '/image?' + urllib.urlencode({'pid': pid, 'v': variant, 'h': digest})
+
+
+def storeUpload(pid, data):
+  """Validate an uploaded image, store it and its resized variants for the
+  given product, and return a dict of their urls, by variant."""
+  # imported here, as only product creation needs it.
+  from PIL import Image
+
+  if len(data) > MAX_UPLOAD_BYTES:
+    raise errors.OperationFailedError(
+        'The image is too large (max %d KB).' % (MAX_UPLOAD_BYTES // 1024))
+  try:
+    Image.open(StringIO.StringIO(data)).verify()
+    # verify() leaves the image unusable, so open it again.
+    image = Image.open(StringIO.StringIO(data))
+  except Exception:
+    raise errors.OperationFailedError('The uploaded file is not an image.')
+  if image.format not in _CONTENT_TYPES:
+    raise errors.OperationFailedError(
+        'Unsupported image format %s.' % image.format)
+
+  images = [_createImage(
+      pid, ORIGINAL, data, _CONTENT_TYPES[image.format], image.size)]
+  if image.mode not in ('RGB', 'L'):
+    image = image.convert('RGB')
+  for variant, size in VARIANT_SIZES.iteritems():
+    resized = image.copy()
+    resized.thumbnail(size, Image.ANTIALIAS)
+    out = StringIO.StringIO()
+    resized.save(out, 'JPEG', quality=_JPEG_QUALITY, optimize=True)
+    images.append(_createImage(
+        pid, variant, out.getvalue(), 'image/jpeg', resized.size))
+  ndb.put_multi(images)
+  return dict((img.key.id().rsplit(':', 1)[1],
+               imageUrl(pid, img.key.id().rsplit(':', 1)[1], img.digest))
+              for img in images)
+
+
+def getImage(pid, variant):
+  """Return the stored image variant of the given product, or None."""
+  return models.ProductImage.get_by_id('%s:%s' % (pid, variant))
+
+
+def deleteImages(pid):
+  """Delete the stored images of the given product."""
+  ndb.delete_multi([ndb.Key(models.ProductImage, '%s:%s' % (pid, variant))
+                    for variant in [ORIGINAL] + VARIANT_SIZES.keys()])
+
+
+def _createImage(pid, variant, data, content_type, size):
+  if len(data) > MAX_STORED_BYTES:
+    raise errors.OperationFailedError(
+        'The %s image is too large to store.' % variant)
+  return models.ProductImage(
+      id='%s:%s' % (pid, variant), data=data, content_type=content_type,
+      digest=hashlib.md5(data).hexdigest()[:16],
+      width=size[0], height=size[1])
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rewrites product search queries that found nothing.
+
+A query that returns no results is rewritten once: each of its plain terms is
+normalized (lower case, accents removed, common plural endings stripped),
+corrected to the closest term of the vocabulary if it isn't in it, and
+searched with the Search API's plural stemming ('~term').  Field restrictions,
+operators and quoted phrases are left as they are.
+
+The vocabulary holds the normalized terms of the indexed product names and
+category fields.  It is built incrementally: the new terms of indexed
+products are queued in the QUEUE_NAME pull queue (see
+docs.Product.buildProduct), and added in batches by one named task per
+config.VOCABULARY_ADD_INTERVAL seconds; the whole vocabulary can also be
+rebuilt from the index.  It is stored in models.SearchVocabulary entities,
+sharded by the terms' first character, and each instance keeps a copy in
+memory, grouped by term length, which it reloads when the stored version
+changes.
+"""
+
+import difflib
+import json
+import logging
+import re
+import string
+import threading
+import time
+import unicodedata
+
+import config
+import models
+
+from google.appengine.api import memcache
+from google.appengine.api import search
+from google.appengine.api import taskqueue
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+
+QUEUE_NAME = 'vocabulary-terms'
+_VERSION_KEY = 'vocabulary:version'
+# terms shorter than this are neither added to the vocabulary nor corrected
+_MIN_TERM_LEN = 3
+_REBUILD_BATCH_SIZE = 500
+# the number of queued term lists leased for each batch of additions
+_TERMS_BATCH_SIZE = 500
+_LEASE_SECONDS = 600
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_TERM_RE = re.compile(r'^\w+$', re.UNICODE)
+_OPERATORS = frozenset(['AND', 'OR', 'NOT'])
+# a field restriction or comparison, e.g. 'category:"Books"' or 'price < 10'
+_RESTRICTION_RE = re.compile(
+    r'[\w.]+\s*(?:[:=]|[<>]=?|!=)\s*(?:"[^"]*"|[^\s()]+)', re.UNICODE)
+_LETTERS = string.ascii_lowercase + string.digits
+
+_lock = threading.Lock()
+_vocabulary = None
+_version = None
+_last_check = 0
+
+
+class _Vocabulary(object):
+  """An instance's in-memory copy of the vocabulary: the normalized terms
+  grouped by length, plus the displayed forms of the few terms whose form
+  differs."""
+
+  def __init__(self, terms):
+    by_length = {}
+    for term in terms:
+      by_length.setdefault(len(term), []).append(term)
+    self.by_length = dict(
+        (n, frozenset(group)) for n, group in by_length.iteritems())
+    self.forms = dict(
+        (term, form) for term, form in terms.iteritems() if term != form)
+
+  def __contains__(self, term):
+    return term in self.by_length.get(len(term), ())
+
+  def getForm(self, term):
+    return self.forms.get(term, term)
+
+  def correct(self, term):
+    """Return the vocabulary term closest to the given normalized term, or
+    None if none is close enough.  Only the terms one edit away are
+    candidates, so the work per term is bounded by the number of its edits,
+    whatever the size of the vocabulary."""
+    if term in self or len(term) < _MIN_TERM_LEN or term.isdigit():
+      return None
+    candidates = [t for t in _edits(term) if t in self]
+    if not candidates:
+      return None
+    matches = difflib.get_close_matches(
+        term, candidates, n=1, cutoff=config.SPELLING_MIN_SIMILARITY)
+    return matches[0] if matches else None
+
+
+def normalizeTerm(term, fold_accents=True):
+  """Return the lower case, singular form of the given term, by default with
+  its accents removed."""
+  term = term.lower()
+  if fold_accents:
+    term = u''.join(c for c in unicodedata.normalize('NFKD', term)
+                    if not unicodedata.combining(c))
+  if len(term) > 4 and term.endswith('ies'):
+    return term[:-3] + 'y'
+  if len(term) > 4 and term.endswith(('ches', 'shes', 'sses', 'xes', 'zes')):
+    return term[:-2]
+  if len(term) > 3 and term.endswith('s') and not term.endswith(
+      ('ss', 'us', 'is')):
+    return term[:-1]
+  return term
+
+
+def rewriteQuery(query):
+  """Return the normalized and spelling-corrected form of the given query, or
+  None if rewriting does not change it."""
+  if not query or u'"' in query:
+    return None
+  vocabulary = getVocabulary()
+  rewritten = []
+  for token in query.split():
+    if not _TERM_RE.match(token) or token in _OPERATORS:
+      rewritten.append(token)  # a field restriction, operator or comparison
+      continue
+    term = normalizeTerm(token)
+    corrected = vocabulary.correct(term)
+    if corrected:
+      logging.info('corrected %r to %r', token, corrected)
+      term = corrected
+    rewritten.append(u'~' + vocabulary.getForm(term))
+  rewritten = u' '.join(rewritten)
+  return rewritten if rewritten != u' '.join(query.split()) else None
+
+
+def hasFreeTextTerms(query):
+  """Return whether the given query has terms, or quoted phrases, that are
+  not field restrictions, i.e. that match the document text."""
+  if not query:
+    return False
+  text = _RESTRICTION_RE.sub(u' ', query)
+  return any(token not in _OPERATORS for token in _TOKEN_RE.findall(text))
+
+
+def getVocabulary():
+  """Return the instance's copy of the vocabulary, reloading it if it has
+  changed since it was last checked.  The stored version is the sum of the
+  shards' versions; it is cached in memcache, and deleted from it when terms
+  are added, so that the instances reload."""
+  global _vocabulary, _version, _last_check
+  if (_vocabulary is not None and
+      time.time() - _last_check < config.VOCABULARY_REFRESH_INTERVAL):
+    return _vocabulary
+  with _lock:
+    if (_vocabulary is not None and
+        time.time() - _last_check < config.VOCABULARY_REFRESH_INTERVAL):
+      return _vocabulary
+    _last_check = time.time()
+    version = memcache.get(_VERSION_KEY)
+    if _vocabulary is not None and version is not None and version == _version:
+      return _vocabulary
+    shards = models.SearchVocabulary.getShards()
+    if not shards:
+      _scheduleRebuild()
+      _vocabulary, _version = _Vocabulary({}), None
+    else:
+      terms = {}
+      for shard in shards:
+        terms.update(shard.getTerms())
+      version = sum(shard.version for shard in shards)
+      memcache.set(_VERSION_KEY, version)
+      _vocabulary, _version = _Vocabulary(terms), version
+    return _vocabulary
+
+
+def queueTerms(texts):
+  """Queue the terms of the given texts that are not in the vocabulary, to
+  be added with the other terms queued in the same interval.  Called when
+  products are indexed."""
+  new_terms = _newTerms(texts)
+  if not new_terms:
+    return
+  taskqueue.Queue(QUEUE_NAME).add(
+      taskqueue.Task(payload=json.dumps(new_terms), method='PULL'))
+  bucket = int(time.time() // config.VOCABULARY_ADD_INTERVAL)
+  try:
+    defer(addQueuedTerms, _name='vocabulary-add-%d' % bucket,
+          _countdown=config.VOCABULARY_ADD_INTERVAL)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def addQueuedTerms():
+  """Lease a batch of queued terms, add them to the vocabulary and delete
+  their tasks.  Chain the next batch if this one was full."""
+  queue = taskqueue.Queue(QUEUE_NAME)
+  tasks = queue.lease_tasks(_LEASE_SECONDS, _TERMS_BATCH_SIZE)
+  if not tasks:
+    return
+  new_terms = {}
+  for task in tasks:
+    for term, form in json.loads(task.payload).iteritems():
+      new_terms.setdefault(term, form)
+  _addTerms(new_terms)
+  queue.delete_tasks(tasks)
+  if len(tasks) == _TERMS_BATCH_SIZE:
+    defer(addQueuedTerms)
+
+
+def _newTerms(texts):
+  """Return a dict of the normalized terms of the given texts that are not
+  in the vocabulary, mapped to their displayed forms."""
+  new_terms = {}
+  for text in texts:
+    if not isinstance(text, unicode):
+      text = str(text).decode('utf-8', 'ignore')
+    for token in _TOKEN_RE.findall(text):
+      term = normalizeTerm(token)
+      if len(term) >= _MIN_TERM_LEN and not term.isdigit():
+        new_terms.setdefault(term, normalizeTerm(token, fold_accents=False))
+  vocabulary = getVocabulary()
+  return dict((t, form) for t, form in new_terms.iteritems()
+              if t not in vocabulary)
+
+
+def _addTerms(new_terms):
+  """Add the given {term: form} dict to the vocabulary, with one
+  transaction per shard."""
+  by_shard = {}
+  for term, form in new_terms.iteritems():
+    by_shard.setdefault(
+        models.SearchVocabulary.shardKey(term), {})[term] = form
+
+  def _tx(key, shard_terms):
+    entity = key.get() or models.SearchVocabulary(key=key)
+    terms = entity.getTerms()
+    added = [t for t in shard_terms if t not in terms]
+    if not added:
+      return False
+    for term in added:
+      terms[term] = shard_terms[term]
+    entity.setTerms(terms)
+    entity.version += 1
+    entity.put()
+    return True
+
+  changed = False
+  for key, shard_terms in by_shard.iteritems():
+    if ndb.transaction(lambda: _tx(key, shard_terms), retries=5):
+      changed = True
+  if changed:
+    memcache.delete(_VERSION_KEY)
+
+
+def rebuildVocabulary(start_id=None, shard=0):
+  """Add the terms of all the indexed products to the vocabulary, one batch
+  of documents of one product index shard per task."""
+  import docs  # imported here, as docs imports this module.
+  index_names = docs.Product.getIndexNames()
+  if shard >= len(index_names):
+    logging.info('vocabulary rebuilt')
+    return
+  index = search.Index(name=index_names[shard])
+  batch = index.get_range(
+      start_id=start_id, include_start_object=False,
+      limit=_REBUILD_BATCH_SIZE)
+  texts = []
+  for doc in batch:
+    texts.extend(docs.Product.getVocabularyText(doc))
+  _addTerms(_newTerms(texts))
+  if len(batch.results) == _REBUILD_BATCH_SIZE:
+    defer(rebuildVocabulary, batch.results[-1].doc_id, shard)
+  else:
+    defer(rebuildVocabulary, None, shard + 1)
+
+
+def _scheduleRebuild():
+  """Start a vocabulary rebuild, at most once a day."""
+  try:
+    defer(rebuildVocabulary,
+          _name='vocabulary-rebuild-%s' % time.strftime('%Y-%m-%d'))
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _edits(term):
+  """Return the strings one deletion, transposition, replacement or insertion
+  away from the given term."""
+  splits = [(term[:i], term[i:]) for i in range(len(term) + 1)]
+  deletes = [a + b[1:] for a, b in splits if b]
+  transposes = [a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1]
+  replaces = [a + c + b[1:] for a, b in splits if b for c in _LETTERS]
+  inserts = [a + c + b for a, b in splits for c in _LETTERS]
+  return set(deletes + transposes + replaces + inserts)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Token bucket rate limiting of expensive requests, per client IP and per
+user (see BaseHandler.rate_limited).
+
+Each route has a budget in config.RATE_LIMITS: a refill rate, in requests
+per second, and a burst size.  A client's requests are checked in two ways:
+  - against a token bucket in the instance, which costs no RPC;
+  - against a per-minute memcache counter, shared by all instances, of at
+    most rate * 60 + burst requests.  Each instance adds its admitted
+    requests to the counters in batches, at most every _SYNC_INTERVAL
+    seconds per client, and remembers the clients found over budget until
+    the end of the minute.
+So a client spreading its requests over several instances may briefly go
+over its budget, by up to a batch per instance.
+"""
+
+import threading
+import time
+
+import config
+
+from google.appengine.api import memcache
+
+
+_SYNC_INTERVAL = 1.0
+_WINDOW = 60
+# the per-instance state is dropped when it tracks more clients than this
+_MAX_CLIENTS = 10000
+
+_lock = threading.Lock()
+# (route, client key) -> [tokens, time of last refill]
+_buckets = {}
+# (route, client key) -> [requests not yet added to memcache, time of last sync]
+_unsynced = {}
+# (route, client key) -> time until which the client is over budget
+_blocked = {}
+
+
+def allow(route, client_keys):
+  """Count a request to the given route by the given clients (e.g. an IP
+  address and a user id), and return 0 if it is allowed, or else the number
+  of seconds after which the client may retry."""
+  rate, burst = config.RATE_LIMITS[route]
+  now = time.time()
+  to_sync = []
+  with _lock:
+    if len(_buckets) > _MAX_CLIENTS:
+      _buckets.clear()
+      _unsynced.clear()
+      _blocked.clear()
+    # check all the clients' buckets before taking a token from any, so a
+    # request refused for one client (e.g. the user) doesn't use up another's
+    # (e.g. the shared IP address's).
+    refilled = {}
+    for client in client_keys:
+      key = (route, client)
+      blocked_until = _blocked.get(key)
+      if blocked_until and blocked_until > now:
+        return int(blocked_until - now) + 1
+      tokens, last = _buckets.get(key, (burst, now))
+      tokens = refilled[key] = min(burst, tokens + (now - last) * rate)
+      if tokens < 1:
+        _buckets[key] = [tokens, now]
+        return int((1 - tokens) / rate) + 1
+    for key, tokens in refilled.iteritems():
+      _buckets[key] = [tokens - 1, now]
+    for client in client_keys:
+      key = (route, client)
+      pending = _unsynced.setdefault(key, [0, 0])
+      pending[0] += 1
+      if now - pending[1] >= _SYNC_INTERVAL:
+        to_sync.append((key, pending[0]))
+        _unsynced[key] = [0, now]
+  if to_sync:
+    return _sync(to_sync, rate * _WINDOW + burst, now)
+  return 0
+
+
+def _sync(to_sync, limit, now):
+  """Add the given clients' unsynced request counts to their memcache
+  counters, and block the clients found over budget."""
+  window = int(now // _WINDOW)
+  counts = dict(('rl:%s:%s:%d' % (route, client, window), n)
+                for (route, client), n in to_sync)
+  try:
+    totals = memcache.offset_multi(counts, initial_value=0)
+  except Exception:  # rate limiting must not fail the request.
+    return 0
+  retry_after = 0
+  window_end = (window + 1) * _WINDOW
+  with _lock:
+    for (route, client), _ in to_sync:
+      total = totals.get('rl:%s:%s:%d' % (route, client, window))
+      if total is not None and total > limit:
+        _blocked[(route, client)] = window_end
+        retry_after = int(window_end - now) + 1
+  return retry_after
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The product rating recompute job, which corrects the avg_rating and
+num_reviews of the models.Product entities from their counted reviews, e.g.
+after an incremental update (utils.updateAverageRating) was lost or applied
+twice.
+
+The active, counted reviews are streamed in product key order by a
+projection query on (product_key, rating) (see index.yaml), in chunks of
+config.RATING_RECOMPUTE_BATCH_SIZE reviews, one chained deferred task
+per chunk, checkpointed in a models.JobStatus entity.  A chunk only keeps
+the rating sum and count of each of its products.  A product whose reviews
+run past the end of a chunk has its partial sum and count carried over to
+the next chunk, in the chained task's arguments, so that a chunk never
+reads more than the batch size.  Each chunk then reads the products in its
+key range, from its first product up to the next chunk's (the carried
+product is left to the next chunk), so products left without counted
+reviews are also corrected.  The products whose rating differs are
+corrected in transactions, which re-read each product and only write it if
+its rating still differs, and their documents are re-indexed in batches.
+
+Reviews counted while the job runs may be missed by its eventually
+consistent query, so the job is best run when few reviews are being added.
+"""
+
+import logging
+
+import config
+import errors
+import models
+
+from google.appengine.api import search
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+
+RECOMPUTE_JOB = 'recompute_ratings'
+_STAGE = 'reviews'
+_CORRECTED = 'corrected products'
+_PUT_BATCH_SIZE = 100  # products corrected in parallel
+
+
+def startRecompute():
+  """Start a new run of the job, replacing any earlier run."""
+  status = models.JobStatus.start(RECOMPUTE_JOB, [_STAGE])
+  _deferChunk(status)
+
+
+def _deferChunk(status, start_key=None, carry=None):
+  # named after the run and chunk number, so a retried chunk doesn't start a
+  # second chain.
+  try:
+    defer(_recomputeChunk, status.run_id, start_key, carry,
+          _name='recompute-ratings-%s-%d' % (status.run_id, status.chunks))
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _recomputeChunk(run_id, start_key=None, carry=None):
+  """Aggregate the ratings of the next chunk of reviews, correct the
+  products of the chunk's key range, which starts at the given urlsafe
+  product key (or at the first product), checkpoint and chain the next
+  chunk.  carry is the [rating sum, review count] of the start product's
+  reviews read by the previous chunks, if it was split."""
+  status = models.JobStatus.getRun(RECOMPUTE_JOB, run_id)
+  if not status:
+    return
+  query = models.Review.query(
+      models.Review.active == True,
+      models.Review.rating_added == True).order(models.Review.product_key)
+  reviews = query.iter(
+      projection=[models.Review.product_key, models.Review.rating],
+      start_cursor=Cursor(urlsafe=status.cursor) if status.cursor else None,
+      produce_cursors=True, batch_size=config.RATING_RECOMPUTE_BATCH_SIZE)
+  start_key = ndb.Key(urlsafe=start_key) if start_key else None
+  totals = {}  # product key -> [rating sum, review count]
+  if carry:
+    totals[start_key] = list(carry)
+  next_key = cursor = next_carry = last_key = None
+  num_reviews = 0
+  for review in reviews:
+    pkey = review.product_key
+    if num_reviews >= config.RATING_RECOMPUTE_BATCH_SIZE:
+      # the next chunk starts with this product, carrying its partial sum
+      # and count if this chunk has read some of its reviews.
+      next_key, cursor = pkey, reviews.cursor_before().urlsafe()
+      if pkey == last_key:
+        next_carry = totals.pop(pkey)
+      break
+    total = totals.setdefault(pkey, [0, 0])
+    total[0] += review.rating or 0
+    total[1] += 1
+    num_reviews += 1
+    last_key = pkey
+  # the last chunk's range runs to the last product.
+  num_corrected = _correctProducts(start_key, next_key, totals)
+  status.advance(num_reviews, cursor)
+  status.counts[_CORRECTED] = status.counts.get(_CORRECTED, 0) + num_corrected
+  status.put()
+  if status.done:
+    logging.info('ratings recomputed: %s', status.counts)
+  else:
+    _deferChunk(status, next_key.urlsafe(), next_carry)
+
+
+def _correctProducts(start_key, end_key, totals):
+  """Correct the rating of the products from start_key (inclusive) to end_key
+  (exclusive), either of which may be None, from the given dict of rating
+  sums and counts.  Return the number of products corrected."""
+  if start_key and start_key == end_key:
+    return 0  # the chunk only read reviews of its (carried) start product
+  query = models.Product.query()
+  if start_key:
+    query = query.filter(models.Product.key >= start_key)
+  if end_key:
+    query = query.filter(models.Product.key < end_key)
+  num_corrected = 0
+  to_correct = []
+  for prod in query.iter(batch_size=_PUT_BATCH_SIZE):
+    rating_sum, count = totals.get(prod.key, (0, 0))
+    avg_rating = rating_sum / float(count) if count else 0.0
+    if _ratingDiffers(prod, avg_rating, count):
+      to_correct.append((prod.key, avg_rating, count))
+    if len(to_correct) == _PUT_BATCH_SIZE:
+      num_corrected += _correctAndReindex(to_correct)
+      to_correct = []
+  if to_correct:
+    num_corrected += _correctAndReindex(to_correct)
+  return num_corrected
+
+
+def _ratingDiffers(prod, avg_rating, count):
+  return (prod.num_reviews != count or
+          abs((prod.avg_rating or 0) - avg_rating) > 1e-6)
+
+
+@ndb.transactional_tasklet
+def _correctProduct(pkey, avg_rating, count):
+  """Set the given product's rating, unless it was corrected meanwhile.
+  Return whether it was written."""
+  prod = yield pkey.get_async()
+  if not prod or not _ratingDiffers(prod, avg_rating, count):
+    raise ndb.Return(False)
+  logging.info('product %s: rating %s over %s reviews, corrected to %s '
+               'over %s', pkey.id(), prod.avg_rating, prod.num_reviews,
+               avg_rating, count)
+  prod.populate(avg_rating=avg_rating, num_reviews=count,
+                needs_review_reindex=True)
+  yield prod.put_async()
+  raise ndb.Return(True)
+
+
+def _correctAndReindex(corrections):
+  """Correct the given products, from a list of (key, avg rating, count),
+  each in its own transaction, and re-index the corrected products'
+  documents in batches.  Return the number of products corrected."""
+  futures = [_correctProduct(*correction) for correction in corrections]
+  keys = [key for (key, _, _), future in zip(corrections, futures)
+          if future.get_result()]
+  batch_size = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+  for i in range(0, len(keys), batch_size):
+    try:
+      models.Product.updateProdDocsWithNewRating(keys[i:i + batch_size])
+    except errors.OperationFailedError:
+      # the products stay marked for re-indexing by the batch ratings update.
+      logging.exception('could not re-index corrected products')
+  return len(keys)
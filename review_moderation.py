@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The review moderation pipeline.
+
+New reviews are published at once, and counted in their product's rating by
+utils.updateAverageRating.  Each is also added, in the transaction creating
+it, to the QUEUE_NAME pull queue.  A cron job leases the queued reviews
+config.MODERATION_BATCH_SIZE at a time and checks them against local rules
+(config.MODERATION_BLOCKED_TERMS and MODERATION_BLOCKED_PATTERNS); the
+reviews breaking a rule are deactivated.  Admins can also activate or
+deactivate reviews in bulk (see admin_handlers.ModerateReviewsHandler).
+
+A review's rating is counted in its product's avg_rating and num_reviews iff
+its rating_added flag is set, which it only is while the review is active.
+setReviewsActive adds or subtracts the ratings of the reviews it changes
+incrementally, in cross-group transactions each holding a product and a few
+of its reviews, then re-indexes the changed products' documents.
+"""
+
+import collections
+import logging
+import re
+
+import config
+import models
+
+from google.appengine.api import taskqueue
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+
+QUEUE_NAME = 'review-moderation'
+# reviews per transaction; with their product, this stays within the limit
+# of 25 entity groups of a cross-group transaction.
+_REVIEWS_PER_TX = 20
+
+_BLOCKED_TERMS_RE = re.compile(
+    r'\b(?:%s)\b' % '|'.join(
+        re.escape(t) for t in config.MODERATION_BLOCKED_TERMS),
+    re.IGNORECASE | re.UNICODE) if config.MODERATION_BLOCKED_TERMS else None
+_BLOCKED_PATTERNS = [re.compile(p, re.IGNORECASE | re.UNICODE)
+                     for p in config.MODERATION_BLOCKED_PATTERNS]
+
+
+def enqueueReview(review_key):
+  """Add the given review to the moderation queue.  Call this within the
+  transaction that creates the review."""
+  taskqueue.Queue(QUEUE_NAME).add(
+      taskqueue.Task(payload=review_key.urlsafe(), method='PULL'),
+      transactional=True)
+
+
+def classifyReview(review):
+  """Return the reason for rejecting the given review, or None if it breaks
+  none of the moderation rules."""
+  comment = review.comment or u''
+  if _BLOCKED_TERMS_RE:
+    match = _BLOCKED_TERMS_RE.search(comment)
+    if match:
+      return 'blocked term %r' % match.group(0)
+  for pattern in _BLOCKED_PATTERNS:
+    if pattern.search(comment):
+      return 'matches %r' % pattern.pattern
+  return None
+
+
+def moderateQueuedReviews():
+  """Lease a batch of queued reviews, deactivate those that break the rules,
+  and delete their tasks.  Chain the next batch if this one was full."""
+  queue = taskqueue.Queue(QUEUE_NAME)
+  tasks = queue.lease_tasks(
+      config.MODERATION_LEASE_SECONDS, config.MODERATION_BATCH_SIZE)
+  if not tasks:
+    return
+  reviews = ndb.get_multi([ndb.Key(urlsafe=t.payload) for t in tasks])
+  rejected = []
+  for review in reviews:
+    if review is None or not review.active:
+      continue
+    reason = classifyReview(review)
+    if reason:
+      logging.info('rejecting review %s: %s', review.key.id(), reason)
+      rejected.append(review.key)
+  if rejected:
+    setReviewsActive(rejected, False)
+  queue.delete_tasks(tasks)
+  logging.info('moderated %s reviews, rejected %s', len(tasks), len(rejected))
+  if len(tasks) == config.MODERATION_BATCH_SIZE:
+    defer(moderateQueuedReviews)
+
+
+def setReviewsActive(review_keys, active):
+  """Activate or deactivate the given reviews, adding their ratings to, or
+  subtracting them from, their products' ratings.  Return the number of
+  reviews changed."""
+  by_product = collections.defaultdict(list)
+  for review in ndb.get_multi(review_keys):
+    if review and review.active != active:
+      by_product[review.product_key].append(review.key)
+  num_changed = 0
+  reindex = []
+  for pkey, rkeys in by_product.iteritems():
+    rating_changed = False
+    for i in range(0, len(rkeys), _REVIEWS_PER_TX):
+      batch = rkeys[i:i + _REVIEWS_PER_TX]
+      n, counted = ndb.transaction(
+          lambda: _setActive(pkey, batch, active), xg=True)
+      num_changed += n
+      rating_changed = rating_changed or counted
+    if rating_changed:
+      reindex.append(pkey)
+  if reindex and not config.BATCH_RATINGS_UPDATE:
+    models.Product.updateProdDocsWithNewRating(reindex)
+  return num_changed
+
+
+def _setActive(pkey, review_keys, active):
+  """Set the active flag of the given reviews of a product, and count their
+  ratings in, or out of, its rating.  Run in a transaction.  Return the
+  number of reviews changed, and whether the product's rating changed."""
+  entities = ndb.get_multi([pkey] + review_keys)
+  product, reviews = entities[0], entities[1:]
+  to_put = []
+  counted = False
+  for review in reviews:
+    if review is None or review.active == active:
+      continue
+    review.active = active
+    to_put.append(review)
+    if product is None or review.rating_added == active:
+      continue
+    review.rating_added = active
+    counted = True
+    if active:
+      product.num_reviews += 1
+      product.avg_rating += (
+          (review.rating - product.avg_rating) / float(product.num_reviews))
+    elif product.num_reviews > 1:
+      product.num_reviews -= 1
+      product.avg_rating -= (
+          (review.rating - product.avg_rating) / float(product.num_reviews))
+    else:
+      product.num_reviews, product.avg_rating = 0, 0.0
+  num_changed = len(to_put)
+  if counted:
+    product.needs_review_reindex = True
+    to_put.append(product)
+  ndb.put_multi(to_put)
+  return num_changed, counted
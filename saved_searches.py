@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Saving product searches, and matching new product documents against them.
+
+Rather than having users re-run the same search to look for new listings,
+each new or updated product document is run once against every saved search,
+percolator-style: the saved searches are loaded in batches and indexed by one
+of their terms, so that each product only needs to be checked against the
+searches that share at least one term with it.  A saved search matches a
+product if all of its terms appear in the product's text fields, and the
+product is in the category (or one of its subcategories) and the rating
+range, if given, as in the search filters of /psearch.
+
+Products indexed one at a time are added to the QUEUE_NAME pull queue, and
+matched in batches by one named task per config.SAVED_SEARCH_MATCH_INTERVAL
+seconds, so that the saved searches are scanned once per batch rather than
+once per product.
+
+The term normalization is deliberately simple (lower case, alphanumeric
+tokens), so it only approximates the Search API's own matching.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import re
+import time
+
+import config
+import models
+
+from google.appengine.api import taskqueue
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+
+QUEUE_NAME = 'saved-search-matching'
+# the number of saved searches loaded into memory for each matching pass
+_SEARCH_BATCH_SIZE = 1000
+# the number of queued products leased for each matching pass
+_PRODUCT_BATCH_SIZE = 500
+_LEASE_SECONDS = 600
+# the index key used for searches that have a category but no terms
+_CATEGORY_ONLY = u'\x00category'
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+  """Return the set of normalized terms in the given text."""
+  if not text:
+    return set()
+  if not isinstance(text, unicode):
+    text = str(text).decode('utf-8', 'ignore')
+  return set(_TOKEN_RE.findall(text.lower()))
+
+
+def saveSearch(user_id, query, category=None, min_rating=0):
+  """Save a search for the given user, and return its entity."""
+  terms = sorted(tokenize(query))
+  category = category or None
+  key_source = u'|'.join(terms + [category or u'', unicode(min_rating)])
+  search_id = '%s:%s' % (
+      user_id, hashlib.sha1(key_source.encode('utf-8')).hexdigest())
+  saved = models.SavedSearch(
+      id=search_id, user_id=user_id, query=query, terms=terms,
+      category=category, min_rating=min_rating)
+  saved.put()
+  return saved
+
+
+def getUserSearches(user_id):
+  """Return the given user's saved searches, newest first."""
+  searches = models.SavedSearch.query(
+      models.SavedSearch.user_id == user_id).fetch()
+  # sorted here, rather than in the query, to avoid a composite index.
+  return sorted(searches, key=lambda s: s.date_added, reverse=True)
+
+
+def queueProduct(record):
+  """Queue the given product record (see docs.Product.getMatchRecord) to be
+  matched against the saved searches with the other products queued in the
+  same interval."""
+  taskqueue.Queue(QUEUE_NAME).add(
+      taskqueue.Task(payload=json.dumps(record), method='PULL'))
+  bucket = int(time.time() // config.SAVED_SEARCH_MATCH_INTERVAL)
+  try:
+    defer(matchQueuedProducts,
+          _name='saved-search-match-%d' % bucket,
+          _countdown=config.SAVED_SEARCH_MATCH_INTERVAL)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def matchQueuedProducts():
+  """Lease a batch of queued product records, match them against the saved
+  searches and delete their tasks.  Chain the next batch if this one was
+  full."""
+  queue = taskqueue.Queue(QUEUE_NAME)
+  tasks = queue.lease_tasks(_LEASE_SECONDS, _PRODUCT_BATCH_SIZE)
+  if not tasks:
+    return
+  # a product indexed several times in the batch is matched once, with its
+  # latest record.
+  records = {}
+  for task in tasks:
+    record = json.loads(task.payload)
+    records[record['pid']] = record
+  matchProducts(records.values())
+  queue.delete_tasks(tasks)
+  if len(tasks) == _PRODUCT_BATCH_SIZE:
+    defer(matchQueuedProducts)
+
+
+def matchProducts(records):
+  """Match the given product records (see docs.Product.getMatchRecord)
+  against all saved searches, and store a SavedSearchMatch for each match.
+  Intended to be run as a deferred task after products are indexed."""
+  if not records:
+    return
+  records = [(r, tokenize(u' '.join(r['text']))) for r in records]
+  query = models.SavedSearch.query()
+  cursor = None
+  more = True
+  num_matches = 0
+  while more:
+    searches, cursor, more = query.fetch_page(
+        _SEARCH_BATCH_SIZE, start_cursor=cursor)
+    matches = _matchBatch(searches, records)
+    ndb.put_multi(matches)
+    num_matches += len(matches)
+  logging.info('%s saved search matches for %s products',
+               num_matches, len(records))
+
+
+def _matchBatch(searches, records):
+  """Return the SavedSearchMatch entities for one batch of saved searches."""
+  by_term = collections.defaultdict(list)
+  for saved in searches:
+    by_term[saved.terms[0] if saved.terms else _CATEGORY_ONLY].append(saved)
+
+  matches = []
+  for record, tokens in records:
+    candidates = by_term.get(_CATEGORY_ONLY, [])
+    for token in tokens:
+      candidates = candidates + by_term.get(token, [])
+    for saved in candidates:
+      if _isMatch(saved, record, tokens):
+        matches.append(models.SavedSearchMatch(
+            parent=saved.key, id=record['pid'],
+            pname=record['name'], category=record['category']))
+  return matches
+
+
+def _isMatch(saved, record, tokens):
+  if saved.category and saved.category not in record.get(
+      'category_path', [record['category']]):
+    return False
+  if saved.min_rating and not _ratingMatches(
+      saved.min_rating, record['avg_rating'] or 0):
+    return False
+  return all(term in tokens for term in saved.terms)
+
+
+def _ratingMatches(rating, avg_rating):
+  """Whether the given average rating is in the range of the rating filter
+  of /psearch (see handlers.ProductSearchHandler._addFacetFilters): [rating,
+  rating + 1), or exactly the max rating."""
+  if rating >= config.RATING_MAX:
+    return avg_rating == rating
+  return rating <= avg_rating < rating + 1
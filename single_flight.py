@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalescing of identical concurrent computations, such as searches.
+
+call() runs a computation once per key at a time within an instance: the
+threads asking for a key while it is being computed wait for its result
+instead of computing it again.  cached() additionally caches the result in
+memcache, and lets a single instance at a time compute it, holding a
+memcache lock; the other instances wait for the cached result for up to the
+lock's lifetime, then compute it themselves.
+"""
+
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+
+_POLL_INTERVAL = 0.05
+
+_lock = threading.Lock()
+# key -> the _Call in flight
+_calls = {}
+
+
+class _Call(object):
+  """A computation in flight, and its outcome once done."""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+def call(key, func):
+  """Return the result of func(), sharing it with the concurrent calls of
+  the instance with the same key.  An exception raised by func is raised in
+  all of them."""
+  with _lock:
+    flight = _calls.get(key)
+    leader = flight is None
+    if leader:
+      flight = _calls[key] = _Call()
+  if not leader:
+    flight.done.wait()
+    if flight.error is not None:
+      raise flight.error
+    return flight.result
+  try:
+    flight.result = func()
+  except Exception as e:
+    flight.error = e
+    raise
+  finally:
+    with _lock:
+      del _calls[key]
+    flight.done.set()
+  return flight.result
+
+
+def cached(key, func, cache_time, lock_time):
+  """Return the result of func(), cached in memcache under the given key for
+  cache_time seconds.  Within an instance, the concurrent calls with the same
+  key share one call of func; across instances, the instance holding the
+  key's lock (for at most lock_time seconds) computes the result while the
+  others wait for it.  A result of None is not cached."""
+  return call(key, lambda: _getOrCompute(key, func, cache_time, lock_time))
+
+
+def _getOrCompute(key, func, cache_time, lock_time):
+  result = memcache.get(key)
+  if result is not None:
+    return result
+  lock_key = 'lock:' + key
+  locked = memcache.add(lock_key, 1, time=lock_time)
+  if not locked:
+    # another instance is computing the result; wait for it.
+    deadline = time.time() + lock_time
+    while time.time() < deadline:
+      time.sleep(_POLL_INTERVAL)
+      result = memcache.get(key)
+      if result is not None:
+        return result
+    logging.info('timed out waiting for %s; computing it', key)
+  try:
+    result = func()
+    if result is not None:
+      try:
+        memcache.set(key, result, time=cache_time)
+      except Exception:  # e.g. too large to cache.
+        logging.exception('could not cache %s', key)
+    return result
+  finally:
+    if locked:
+      memcache.delete(lock_key)
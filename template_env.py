@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Holds the jinja2 environment shared by the request handlers of both the
+main and the admin WSGI applications.
+
+Templates are loaded lazily, on first use, from the modules precompiled by
+compile_templates.py if they were generated before deployment; otherwise they
+are compiled from source, and the compiled bytecode is shared between
+instances through memcache so that a cold instance does not have to recompile
+them.  Run
+  python compile_templates.py
+before 'appcfg.py update' to generate the precompiled modules.
+"""
+
+import os
+import threading
+
+import jinja2
+
+
+_ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(_ROOT_DIR, 'templates')
+COMPILED_TEMPLATE_DIR = os.path.join(_ROOT_DIR, 'templates_compiled')
+
+# These match the webapp2_extras.jinja2 defaults that the templates were
+# written against.
+_ENVIRONMENT_ARGS = {
+    'autoescape': True,
+    'extensions': ['jinja2.ext.autoescape', 'jinja2.ext.with_'],
+    }
+
+_BYTECODE_CACHE_PREFIX = 'jinja2/bytecode/'
+
+_lock = threading.Lock()
+_environment = None
+
+
+def createEnvironment(loader=None, bytecode_cache=None):
+  """Build a jinja2 environment with the settings used by the app.  By default
+  templates are read from source."""
+  return jinja2.Environment(
+      loader=loader or jinja2.FileSystemLoader(TEMPLATE_DIR),
+      bytecode_cache=bytecode_cache,
+      # Deployed templates never change, so don't stat them on each render.
+      auto_reload=_isDevServer(),
+      **_ENVIRONMENT_ARGS)
+
+
+def getEnvironment():
+  """Return the process-wide environment, creating it on first use."""
+  global _environment
+  if _environment is None:
+    with _lock:
+      if _environment is None:
+        _environment = _createServingEnvironment()
+  return _environment
+
+
+def render(filename, template_args):
+  """Render the named template with the given args."""
+  return getEnvironment().get_template(filename).render(**template_args)
+
+
+def _createServingEnvironment():
+  from google.appengine.api import memcache
+
+  loaders = []
+  if os.path.isdir(COMPILED_TEMPLATE_DIR) and not _isDevServer():
+    loaders.append(jinja2.ModuleLoader(COMPILED_TEMPLATE_DIR))
+  loaders.append(jinja2.FileSystemLoader(TEMPLATE_DIR))
+  # The memcache module provides the get/set client interface the cache
+  # expects.  Cache keys include a checksum of the template source, so stale
+  # bytecode from an older deployment is never used.
+  bytecode_cache = jinja2.MemcachedBytecodeCache(
+      memcache, prefix=_BYTECODE_CACHE_PREFIX)
+  return createEnvironment(
+      loader=jinja2.ChoiceLoader(loaders), bytecode_cache=bytecode_cache)
+
+
+def _isDevServer():
+  return os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The transaction maintenance job, run daily from cron, which keeps the
+Transaction kind (and its indexes) small:
+  - unverified transactions older than config.UNVERIFIED_TRANSACTION_TTL_HOURS
+    are deleted, releasing their booked dates;
+  - verified transactions older than config.TRANSACTION_ARCHIVE_AGE_DAYS are
+    moved into compressed per-user models.TransactionArchive entities.
+Each step works through its query in cursor-driven batches of
+config.MAINTENANCE_BATCH_SIZE, one deferred task per batch.
+"""
+
+import collections
+import datetime
+import logging
+
+import bookings
+import config
+import models
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext.deferred import defer
+from google.appengine.ext import ndb
+
+
+def startMaintenance():
+  """Start the job.  The first task is named after the date, so the job
+  runs at most once a day even if triggered again."""
+  try:
+    defer(expireUnverified,
+          _name='transaction-maintenance-%s' % datetime.date.today())
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    logging.info('transaction maintenance already started today')
+
+
+def expireUnverified(cursor=None, num_expired=0):
+  """Delete a batch of expired unverified transactions, then chain the next
+  batch, or start archiving when done."""
+  cutoff = datetime.datetime.now() - datetime.timedelta(
+      hours=config.UNVERIFIED_TRANSACTION_TTL_HOURS)
+  query = models.Transaction.query(
+      models.Transaction.verified == False,
+      models.Transaction.dateSent < cutoff)
+  keys, next_cursor, more = query.fetch_page(
+      config.MAINTENANCE_BATCH_SIZE, keys_only=True,
+      start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+  bookings.cancelMulti(keys)
+  num_expired += len(keys)
+  if more and next_cursor:
+    defer(expireUnverified, next_cursor.urlsafe(), num_expired)
+  else:
+    logging.info('expired %s unverified transactions', num_expired)
+    defer(archiveCompleted)
+
+
+def archiveCompleted(cursor=None, num_archived=0):
+  """Archive a batch of old verified transactions, then chain the next
+  batch."""
+  cutoff = datetime.datetime.now() - datetime.timedelta(
+      days=config.TRANSACTION_ARCHIVE_AGE_DAYS)
+  query = models.Transaction.query(
+      models.Transaction.verified == True,
+      models.Transaction.dateSent < cutoff)
+  transactions, next_cursor, more = query.fetch_page(
+      config.MAINTENANCE_BATCH_SIZE,
+      start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+  by_user = collections.defaultdict(list)
+  for transaction in transactions:
+    by_user[transaction.rentee_id].append(transaction)
+  archives = [models.TransactionArchive.create(user_id, user_transactions)
+              for user_id, user_transactions in by_user.iteritems()]
+  # Write the archives before deleting; a retried batch may then archive a
+  # transaction twice, but never loses one.
+  ndb.put_multi(archives)
+  ndb.delete_multi([t.key for t in transactions])
+  num_archived += len(transactions)
+  if more and next_cursor:
+    defer(archiveCompleted, next_cursor.urlsafe(), num_archived)
+  else:
+    logging.info('archived %s transactions', num_archived)
@@ -32,12 +32,13 @@ def intClamp(v, low, high):
 
 def updateAverageRating(review_key):
   """Helper function for updating the average rating of a product when new
-  review(s) are added."""
+  review(s) are added.  A review deactivated before this runs is not counted
+  (see review_moderation.py)."""
 
   def _tx():
     review = review_key.get()
     product = review.product_key.get()
-    if not review.rating_added:
+    if review.active and not review.rating_added:
       review.rating_added = True
       product.num_reviews += 1
       product.avg_rating = (product.avg_rating +
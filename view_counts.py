@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Counts product page views without a datastore write per view.
+
+Views are counted in three stages:
+  - recordView increments a per-instance counter, and at most once every
+    config.VIEW_LOCAL_FLUSH_INTERVAL seconds adds the instance's counts to
+    per-product memcache counters, in one batch call;
+  - once per config.VIEW_FLUSH_INTERVAL seconds a (named, so unique) deferred
+    task moves the memcache counts into sharded models.ProductViewShard
+    counters, one write per viewed product;
+  - once per config.POPULARITY_FOLD_INTERVAL seconds another task folds the
+    view totals of the products viewed in that interval into their documents'
+    popularity field, which products can be sorted on.
+The products with counts to flush or fold in a given interval ('bucket') are
+recorded in memcache as a list of pid lists, one per contributing flush.
+
+Counts still buffered in an instance when it shuts down, or evicted from
+memcache, are lost; the counts are meant for popularity ranking, not billing.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import config
+import docs
+import models
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext.deferred import defer
+
+
+_COUNT_PREFIX = 'views:count:'
+_FLUSH = 'flush'
+_FOLD = 'fold'
+# how long after the end of its bucket a flush or fold task runs, to let
+# late instance flushes arrive.
+_TASK_GRACE_SECS = 15
+_PENDING_TTL = 24 * 60 * 60
+
+_lock = threading.Lock()
+_local_counts = collections.defaultdict(int)
+_last_local_flush = time.time()
+_scheduled = set()  # the (kind, bucket) tasks this instance has scheduled
+
+
+def recordView(pid):
+  """Count a view of the given product."""
+  global _last_local_flush
+  with _lock:
+    _local_counts[pid] += 1
+    now = time.time()
+    if now - _last_local_flush < config.VIEW_LOCAL_FLUSH_INTERVAL:
+      return
+    counts = dict(_local_counts)
+    _local_counts.clear()
+    _last_local_flush = now
+  try:
+    _pushCounts(counts, now)
+  except Exception:  # counting views must never fail the page.
+    logging.exception('could not push view counts')
+
+
+def _pushCounts(counts, now):
+  """Add an instance's buffered counts to the memcache counters."""
+  memcache.offset_multi(counts, key_prefix=_COUNT_PREFIX, initial_value=0)
+  bucket = int(now // config.VIEW_FLUSH_INTERVAL)
+  _addPending(_FLUSH, bucket, counts.keys())
+  _scheduleOnce(_FLUSH, bucket, flushViewCounts, config.VIEW_FLUSH_INTERVAL)
+
+
+def flushViewCounts(bucket):
+  """Move the memcache counts of the products viewed in the given flush
+  bucket into their sharded counters."""
+  pids = _getPending(_FLUSH, bucket)
+  if not pids:
+    return
+  cached = memcache.get_multi(pids, key_prefix=_COUNT_PREFIX)
+  counts = dict((pid, int(n)) for pid, n in cached.iteritems() if n)
+  if not counts:
+    return
+  # Take the counts out of memcache before writing them, so that a retried
+  # flush can't write them twice; the counts that could not be written are
+  # put back.  Subtract them rather than resetting the counters, so that
+  # views pushed in the meantime are kept for the next flush.
+  left = memcache.offset_multi(
+      dict((pid, -n) for pid, n in counts.iteritems()),
+      key_prefix=_COUNT_PREFIX)
+  failed = models.ProductViewShard.addCounts(counts)
+  if failed:
+    memcache.offset_multi(failed, key_prefix=_COUNT_PREFIX, initial_value=0)
+  logging.info('flushed views for %s products, %s failed',
+               len(counts) - len(failed), len(failed))
+  # flush the views pushed in the meantime, and those put back, with the
+  # current bucket, in case their pids weren't recorded as pending.
+  leftover = set(pid for pid, n in left.iteritems() if n) | set(failed)
+  if leftover:
+    now = time.time()
+    next_bucket = max(bucket + 1, int(now // config.VIEW_FLUSH_INTERVAL))
+    _addPending(_FLUSH, next_bucket, leftover)
+    _scheduleOnce(
+        _FLUSH, next_bucket, flushViewCounts, config.VIEW_FLUSH_INTERVAL)
+
+  fold_bucket = int(time.time() // config.POPULARITY_FOLD_INTERVAL)
+  _addPending(_FOLD, fold_bucket, counts.keys())
+  _scheduleOnce(
+      _FOLD, fold_bucket, foldPopularity, config.POPULARITY_FOLD_INTERVAL)
+
+
+def foldPopularity(bucket):
+  """Update the popularity field of the documents of the products viewed in
+  the given fold bucket."""
+  pids = _getPending(_FOLD, bucket)
+  if pids:
+    docs.Product.updatePopularity(models.ProductViewShard.getTotals(pids))
+
+
+def getViewCounts(pids):
+  """Return a dict of the (flushed) view counts of the given pids."""
+  return models.ProductViewShard.getTotals(pids)
+
+
+def _pendingPrefix(kind, bucket):
+  return 'views:%s:%d:' % (kind, bucket)
+
+
+def _addPending(kind, bucket, pids):
+  prefix = _pendingPrefix(kind, bucket)
+  n = memcache.incr(prefix + 'n', initial_value=0)
+  if n is None:
+    logging.warn('could not record pending %s for bucket %s', kind, bucket)
+    return
+  memcache.set(prefix + str(n), list(pids), time=_PENDING_TTL)
+
+
+def _getPending(kind, bucket):
+  prefix = _pendingPrefix(kind, bucket)
+  n = memcache.get(prefix + 'n') or 0
+  pid_lists = memcache.get_multi(
+      [str(i) for i in range(1, int(n) + 1)], key_prefix=prefix)
+  pids = set()
+  for pid_list in pid_lists.itervalues():
+    pids.update(pid_list)
+  return list(pids)
+
+
+def _scheduleOnce(kind, bucket, func, interval):
+  """Schedule the task for the given bucket, to run after the bucket's end.
+  The task name makes it unique across instances."""
+  with _lock:
+    if (kind, bucket) in _scheduled:
+      return
+    if len(_scheduled) > 1000:
+      _scheduled.clear()
+    _scheduled.add((kind, bucket))
+  countdown = max(0, (bucket + 1) * interval - time.time()) + _TASK_GRACE_SECS
+  try:
+    defer(func, bucket, _name='views-%s-%d' % (kind, bucket),
+          _countdown=int(countdown))
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+  except Exception:
+    # let a later push schedule it.
+    with _lock:
+      _scheduled.discard((kind, bucket))
+    raise
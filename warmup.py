@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The warmup request handler.  App Engine sends /_ah/warmup to a new instance
+before routing user traffic to it; we use it to import the request handler
+modules, which main.py and admin.py only reference by name, and to fill the
+in-memory caches.  The handler reports how long each module took to import, so
+that cold-start cost can be kept within config.COLD_START_IMPORT_BUDGET_MS.
+"""
+
+import logging
+import os
+import sys
+import time
+
+import webapp2
+
+import config
+
+
+def importModules(module_names):
+  """Import the named modules, and return a list of (name, milliseconds)
+  pairs.  Modules that were already imported are reported as taking 0 ms;
+  a module's time includes that of the not-yet-imported modules it imports."""
+  timings = []
+  for name in module_names:
+    start = time.time()
+    __import__(name)
+    timings.append((name, (time.time() - start) * 1000))
+  return timings
+
+
+def preloadCaches():
+  """Fill the per-instance caches that are otherwise built by the first user
+  request to need them."""
+  import docs
+  import models
+  import template_env
+
+  models.Category.getCategoryInfo()
+  docs.Product.getSortMenu()
+  docs.Product.getSortDict()
+  # list the sources directly; the precompiled-module loader can't list them.
+  env = template_env.getEnvironment()
+  for name in os.listdir(template_env.TEMPLATE_DIR):
+    if name.endswith('.html'):
+      env.get_template(name)
+
+
+class WarmupHandler(webapp2.RequestHandler):
+  """Imports the app modules, preloads caches and reports import times."""
+
+  def get(self):
+    preloaded = set(sys.modules)
+    timings = importModules(config.WARMUP_MODULES)
+    total = sum(ms for _, ms in timings)
+
+    lines = ['%-20s %8.1f ms%s' % (
+        name, ms, ' (already imported)' if name in preloaded else '')
+             for name, ms in timings]
+    lines.append('%-20s %8.1f ms (budget %d ms)' % (
+        'total', total, config.COLD_START_IMPORT_BUDGET_MS))
+    report = '\n'.join(lines)
+    if total > config.COLD_START_IMPORT_BUDGET_MS:
+      logging.warn('cold start imports over budget:\n%s', report)
+    else:
+      logging.info('cold start imports:\n%s', report)
+
+    preloadCaches()
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.write(report + '\n')